@@ -0,0 +1,237 @@
+"""
+Async job status and listing views
+
+These plain Django async views serve the polling traffic (status, bulk
+status, listing) with async ORM queries and cache reads, so under ASGI a
+single web process can hold thousands of concurrent status requests
+without tying up a worker thread for each one.
+"""
+import base64
+import json
+import uuid
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Q
+from django.http import JsonResponse
+from django.utils import timezone
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_GET, require_http_methods
+
+from .cache_keys import status_cache_key
+from .models import Job
+from .filters import filter_jobs, parse_timestamp
+
+STATUS_FIELDS = ('id', 'status', 'result_file', 'error_message', 'updated_at')
+LIST_FIELDS = ('id', 'status', 'quality_tier', 'result_file', 'created_at', 'updated_at')
+
+# Jobs in these states never change again, so their status can be cached
+TERMINAL_STATUSES = ('completed', 'failed', 'cancelled')
+
+
+def _result_url(request, row: dict):
+    """Absolute URL of the result file, matching JobStatusSerializer"""
+    if row['result_file'] and row['status'] == 'completed':
+        storage = Job._meta.get_field('result_file').storage
+        return request.build_absolute_uri(storage.url(row['result_file']))
+    return None
+
+
+def _find_removed_results(rows: list) -> list:
+    """
+    Ids of cached rows whose result file the storage sweeper has removed
+
+    The sweeper clears the cache too, but the cache may be local to each
+    process, so the web process checks the files itself. Storage calls
+    block, so the views run this off the event loop, once per batch.
+    """
+    storage = Job._meta.get_field('result_file').storage
+    return [row['id'] for row in rows
+            if row['status'] == 'completed' and row['result_file'] and not storage.exists(row['result_file'])]
+
+
+_removed_results = sync_to_async(_find_removed_results, thread_sensitive=False)
+
+
+def _status_payload(request, row: dict) -> dict:
+    return {
+        'id': str(row['id']),
+        'status': row['status'],
+        'result_url': _result_url(request, row),
+        'error_message': row['error_message'],
+    }
+
+
+def _compact_payload(request, row: dict) -> dict:
+    """Bulk status entry; result_url and error_message only when set"""
+    payload = {'id': str(row['id']), 'status': row['status']}
+    result_url = _result_url(request, row)
+    if result_url:
+        payload['result_url'] = result_url
+    if row['error_message']:
+        payload['error_message'] = row['error_message']
+    return payload
+
+
+def _parse_ids(values) -> list:
+    """Parse job ids, raising ValueError on anything that is not a UUID"""
+    return [uuid.UUID(str(value).strip()) for value in values if str(value).strip()]
+
+
+@require_GET
+async def job_status(request, pk):
+    """Status and result URL of a single job"""
+    row = await cache.aget(status_cache_key(pk))
+    if row is not None and await _removed_results([row]):
+        await cache.adelete(status_cache_key(pk))
+        row = None
+    if row is None:
+        row = await Job.objects.filter(pk=pk).values(*STATUS_FIELDS).afirst()
+        if row is None:
+            return JsonResponse({'detail': 'Not found.'}, status=404)
+        if row['status'] in TERMINAL_STATUSES:
+            await cache.aset(status_cache_key(pk), row, getattr(settings, 'JOB_STATUS_CACHE_SECONDS', 300))
+    return JsonResponse(_status_payload(request, row))
+
+
+@csrf_exempt
+@require_http_methods(['GET', 'POST'])
+async def bulk_job_status(request):
+    """
+    Statuses of many jobs in one request
+
+    Jobs are selected by ``ids`` (a list of job ids), ``client_id`` and/or
+    ``batch_id``, passed as query parameters (ids comma separated) or as a
+    JSON body. With ``since`` (ISO 8601) only jobs updated after that
+    time are returned; the response's ``next_cursor`` is the value to send
+    as ``cursor`` on the next call for a cheap incremental sync. ``more``
+    is true when the result was capped and the client should call again
+    right away. The cursor is an (updated_at, id) keyset, so jobs sharing
+    the timestamp of the last one on a capped page are not skipped.
+    """
+    try:
+        if request.method == 'POST':
+            params = json.loads(request.body or b'{}')
+            ids = _parse_ids(params.get('ids', []))
+        else:
+            params = request.GET
+            ids = _parse_ids(params.get('ids', '').split(','))
+        client_id = params.get('client_id') or ''
+        batch_id = params.get('batch_id') or ''
+        if params.get('cursor'):
+            since, since_pk = _decode_sync_cursor(params['cursor'])
+        else:
+            since, since_pk = (parse_timestamp(params['since']) if params.get('since') else None), None
+    except (ValueError, AttributeError, TypeError, UnicodeDecodeError):
+        return JsonResponse({'error': "ids must be job ids, since an ISO 8601 timestamp and cursor "
+                                      "a next_cursor value"}, status=400)
+
+    if not (ids or client_id or batch_id):
+        return JsonResponse({'error': "Provide ids, client_id or batch_id"}, status=400)
+
+    max_ids = getattr(settings, 'BULK_STATUS_MAX_IDS', 500)
+    if len(ids) > max_ids:
+        return JsonResponse({'error': f"At most {max_ids} ids per request"}, status=400)
+
+    # Taken before querying so updates racing with the query are picked up
+    # by the next incremental call
+    next_cursor = _encode_sync_cursor(timezone.now())
+    rows = []
+    more = False
+
+    if ids and not (client_id or batch_id or since):
+        # Plain id lookup: terminal statuses come from the cache, the rest
+        # are fetched in one query
+        cached = await cache.aget_many([status_cache_key(pk) for pk in ids])
+        removed = [status_cache_key(pk) for pk in await _removed_results(list(cached.values()))]
+        if removed:
+            await cache.adelete_many(removed)
+            cached = {key: row for key, row in cached.items() if key not in removed}
+        rows = list(cached.values())
+        missing = [pk for pk in ids if status_cache_key(pk) not in cached]
+        if missing:
+            async for row in Job.objects.filter(pk__in=missing).values(*STATUS_FIELDS):
+                rows.append(row)
+    else:
+        queryset = Job.objects.all()
+        if ids:
+            queryset = queryset.filter(pk__in=ids)
+        if client_id:
+            queryset = queryset.filter(client_id=client_id)
+        if batch_id:
+            queryset = queryset.filter(batch_id=batch_id)
+        if since_pk:
+            queryset = queryset.filter(Q(updated_at__gt=since) | Q(updated_at=since, id__gt=since_pk))
+        elif since:
+            queryset = queryset.filter(updated_at__gt=since)
+
+        async for row in queryset.order_by('updated_at', 'id').values(*STATUS_FIELDS)[:max_ids + 1]:
+            rows.append(row)
+        if len(rows) > max_ids:
+            rows = rows[:max_ids]
+            more = True
+            next_cursor = _encode_sync_cursor(rows[-1]['updated_at'], rows[-1]['id'])
+
+    return JsonResponse({
+        'jobs': [_compact_payload(request, row) for row in rows],
+        'next_cursor': next_cursor,
+        'more': more,
+    })
+
+
+def _encode_sync_cursor(updated_at, pk=None) -> str:
+    # Full precision; JSON encoding would truncate the timestamp to milliseconds
+    value = f"{updated_at.isoformat()}|{pk or ''}"
+    return base64.urlsafe_b64encode(value.encode()).decode()
+
+
+def _decode_sync_cursor(cursor: str):
+    updated_at, pk = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+    return parse_timestamp(updated_at), uuid.UUID(pk) if pk else None
+
+
+def _encode_cursor(row: dict) -> str:
+    value = f"{row['created_at'].isoformat()}|{row['id']}"
+    return base64.urlsafe_b64encode(value.encode()).decode()
+
+
+def _decode_cursor(cursor: str):
+    created_at, pk = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+    return parse_timestamp(created_at), uuid.UUID(pk)
+
+
+@require_GET
+async def job_list(request):
+    """
+    Jobs newest first, keyset paginated
+
+    Accepts the same ``status`` / ``created_after`` / ``created_before``
+    filters as ``/api/jobs/`` and ``limit`` (1 to ``JOB_LIST_MAX_LIMIT``).
+    Pass the returned ``next_cursor`` as ``cursor`` for the next page; each
+    page is an index range scan from the previous page's last row.
+    """
+    max_limit = getattr(settings, 'JOB_LIST_MAX_LIMIT', 200)
+    try:
+        limit = max(1, min(int(request.GET.get('limit', 50)), max_limit))
+        queryset = filter_jobs(Job.objects.all(), request.GET)
+        if request.GET.get('cursor'):
+            created_at, pk = _decode_cursor(request.GET['cursor'])
+            queryset = queryset.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=pk))
+    except (ValueError, UnicodeDecodeError) as e:
+        return JsonResponse({'error': str(e) or "Invalid cursor"}, status=400)
+
+    rows = []
+    async for row in queryset.order_by('-created_at', '-id').values(*LIST_FIELDS)[:limit + 1]:
+        rows.append(row)
+
+    next_cursor = _encode_cursor(rows[limit - 1]) if len(rows) > limit else None
+    jobs = [{
+        'id': str(row['id']),
+        'status': row['status'],
+        'quality_tier': row['quality_tier'],
+        'created_at': row['created_at'],
+        'updated_at': row['updated_at'],
+        'result_url': _result_url(request, row),
+    } for row in rows[:limit]]
+    return JsonResponse({'jobs': jobs, 'next_cursor': next_cursor})
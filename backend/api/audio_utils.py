@@ -0,0 +1,42 @@
+"""
+Audio file helpers
+"""
+import json
+import logging
+import subprocess
+from typing import Optional
+
+try:
+    import soundfile as sf
+    SOUNDFILE_AVAILABLE = True
+except ImportError:
+    SOUNDFILE_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+
+def probe_duration(path: str) -> Optional[float]:
+    """
+    Return the duration of an audio file in seconds
+
+    Reads the header with soundfile when it understands the format and
+    falls back to ffprobe (e.g. for MP3 on older libsndfile builds).
+
+    Returns:
+        Duration in seconds, or None if it could not be determined
+    """
+    if SOUNDFILE_AVAILABLE:
+        try:
+            return sf.info(path).duration
+        except Exception:
+            pass
+
+    try:
+        result = subprocess.run(
+            ['ffprobe', '-v', 'error', '-show_entries', 'format=duration', '-of', 'json', path],
+            check=True, capture_output=True, timeout=30,
+        )
+        return float(json.loads(result.stdout)['format']['duration'])
+    except Exception as e:
+        logger.warning(f"Could not probe duration of {path}: {e}")
+        return None
@@ -0,0 +1,326 @@
+"""
+Queue-driven autoscaling of Celery worker pools, one pool per stage queue
+"""
+import logging
+import math
+import time
+from typing import Callable, Dict, Optional
+
+from django.conf import settings
+
+from . import metrics
+from .quality import QUALITY_TIERS, get_tier
+
+try:
+    import psutil
+    PSUTIL_AVAILABLE = True
+except ImportError as e:
+    logging.warning(f"psutil not available, autoscaling ignores host headroom: {e}")
+    PSUTIL_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CONFIG = {
+    'interval_seconds': 15,
+    # Pool size bounds per queue; each queue needs its own worker
+    # (e.g. `celery worker -Q voice_clone_draft -n draft@%h`)
+    'queues': {
+        'voice_clone_draft': {'min': 1, 'max': 4},
+        'voice_clone': {'min': 1, 'max': 4},
+        'voice_clone_studio': {'min': 1, 'max': 2},
+    },
+    'target_seconds_per_process': 600,  # backlog one process should carry
+    'max_step': 2,  # most processes added to a queue per tick
+    'scale_down_delay_seconds': 120,  # demand must stay low this long before shrinking
+    'memory_per_process_mb': 2048,
+    'max_cpu_percent': 85,
+}
+
+
+def get_config(overrides: Optional[dict] = None) -> dict:
+    """Merge ``settings.AUTOSCALE`` (and any overrides) over the defaults"""
+    config = dict(DEFAULT_CONFIG)
+    config.update(getattr(settings, 'AUTOSCALE', {}))
+    config.update(overrides or {})
+    return config
+
+
+def host_headroom(config: dict) -> int:
+    """
+    Number of extra worker processes this host can take right now
+
+    Bounded by available memory at ``memory_per_process_mb`` each; zero
+    while CPU use is above ``max_cpu_percent``.
+    """
+    if not PSUTIL_AVAILABLE:
+        return 1 << 16
+    if psutil.cpu_percent(interval=None) >= config['max_cpu_percent']:
+        return 0
+    available_mb = psutil.virtual_memory().available / (1024 * 1024)
+    return int(available_mb // config['memory_per_process_mb'])
+
+
+def queue_backlog_seconds() -> Dict[str, float]:
+    """Estimated compute seconds of queued and running jobs, per Celery queue"""
+    from .throttling import backlog_by_tier
+
+    backlog = {}
+    for tier_name, seconds in backlog_by_tier().items():
+        queue = get_tier(tier_name)['queue']
+        backlog[queue] = backlog.get(queue, 0.0) + seconds
+    return backlog
+
+
+class ScalingPolicy:
+    """
+    Decides the pool size of one queue from its demand
+
+    The wanted size is the backlog divided by ``target_seconds_per_process``
+    (at least one process while anything is queued), clamped to the queue's
+    bounds. Growth is limited to ``max_step`` per tick and to the host's
+    spare capacity; shrinking goes one process at a time.
+    """
+
+    def __init__(self, config: dict):
+        self.config = config
+
+    def desired(self, bounds: dict, current: int, depth: int,
+                backlog_seconds: float, spare: int) -> int:
+        """
+        Return the pool size to move to
+
+        Args:
+            bounds: {'min': int, 'max': int} for the queue
+            current: Current number of processes
+            depth: Messages waiting in the queue
+            backlog_seconds: Estimated compute seconds of queued and running jobs
+            spare: Extra processes the host can take
+        """
+        wanted = math.ceil(backlog_seconds / self.config['target_seconds_per_process'])
+        if depth:
+            wanted = max(wanted, 1)
+        wanted = min(max(wanted, bounds['min']), bounds['max'])
+
+        if wanted > current:
+            wanted = max(min(wanted, current + self.config['max_step'], current + spare), current)
+        elif wanted < current:
+            wanted = current - 1
+        # The minimum is kept regardless of headroom
+        return max(wanted, bounds['min'])
+
+
+class CeleryPools:
+    """Reads and resizes the pools of the workers consuming each queue"""
+
+    def __init__(self, app, queues):
+        self.app = app
+        self.queues = set(queues)
+        self.workers = {}
+
+    def refresh(self) -> Dict[str, int]:
+        """Return the current pool size per queue"""
+        inspect = self.app.control.inspect(timeout=2)
+        active_queues = inspect.active_queues() or {}
+        stats = inspect.stats() or {}
+
+        self.workers = {}
+        for worker, queues in active_queues.items():
+            managed = [q['name'] for q in queues if q['name'] in self.queues]
+            if len(managed) != 1:
+                if managed:
+                    logger.warning(f"Not scaling {worker}: it consumes several managed queues {managed}")
+                continue
+            pool = stats.get(worker, {}).get('pool', {})
+            processes = len(pool.get('processes', [])) or pool.get('max-concurrency', 0)
+            self.workers.setdefault(managed[0], {})[worker] = processes
+
+        return {queue: sum(workers.values()) for queue, workers in self.workers.items()}
+
+    def resize(self, queue: str, current: int, target: int) -> None:
+        """Grow or shrink the workers of ``queue`` one process at a time, evenly"""
+        workers = self.workers.get(queue, {})
+        for _ in range(abs(target - current)):
+            if target > current:
+                worker = min(workers, key=workers.get)
+                self.app.control.pool_grow(1, destination=[worker])
+                workers[worker] += 1
+            else:
+                worker = max(workers, key=workers.get)
+                self.app.control.pool_shrink(1, destination=[worker])
+                workers[worker] -= 1
+
+
+class AutoscaleController:
+    """
+    Periodically resizes each stage queue's worker pool
+
+    Each tick reads the queue depth from the broker, the estimated backlog
+    seconds and the host's spare capacity, then asks the policy for a new
+    size per queue. Queues with the most backlog get first claim on the
+    spare capacity. A pool only shrinks after the policy has asked for
+    fewer processes for ``scale_down_delay_seconds``.
+    """
+
+    def __init__(self, pools, config: Optional[dict] = None, redis_client=None,
+                 backlog_fn: Callable[[], Dict[str, float]] = queue_backlog_seconds,
+                 headroom_fn: Optional[Callable[[], int]] = None,
+                 clock: Callable[[], float] = time.monotonic):
+        self.config = config or get_config()
+        self.policy = ScalingPolicy(self.config)
+        self.pools = pools
+        self.redis_client = redis_client
+        self.backlog_fn = backlog_fn
+        if headroom_fn is None:
+            headroom_fn = lambda: host_headroom(self.config)
+            if PSUTIL_AVAILABLE:
+                # The first non-blocking call only sets the baseline and
+                # returns 0.0; take it now so the first tick sees real CPU use
+                psutil.cpu_percent(interval=None)
+        self.headroom_fn = headroom_fn
+        self.clock = clock
+        self.shrink_wanted_since = {}
+
+    def queue_depth(self, queue: str) -> int:
+        if self.redis_client is None:
+            return metrics.queue_depth(queue)
+        try:
+            return self.redis_client.llen(queue)
+        except Exception as e:
+            logger.warning(f"Failed to read depth of queue {queue}: {e}")
+            return 0
+
+    def tick(self) -> Dict[str, dict]:
+        """Run one scaling round and return what was observed and decided per queue"""
+        concurrency = self.pools.refresh()
+        backlog = self.backlog_fn()
+        spare = self.headroom_fn()
+        now = self.clock()
+
+        decisions = {}
+        queues = sorted(self.config['queues'], key=lambda q: backlog.get(q, 0.0), reverse=True)
+        for queue in queues:
+            if queue not in concurrency:
+                continue
+            current = concurrency[queue]
+            depth = self.queue_depth(queue)
+            target = self.policy.desired(self.config['queues'][queue], current, depth,
+                                         backlog.get(queue, 0.0), spare)
+
+            if target < current:
+                since = self.shrink_wanted_since.setdefault(queue, now)
+                if now - since < self.config['scale_down_delay_seconds']:
+                    target = current
+            else:
+                self.shrink_wanted_since.pop(queue, None)
+
+            if target != current:
+                logger.info(f"Autoscale {queue}: {current} -> {target} processes "
+                            f"(depth {depth}, backlog {backlog.get(queue, 0.0):.0f}s)")
+                self.pools.resize(queue, current, target)
+                metrics.incr(f"autoscale_{'grow' if target > current else 'shrink'}:{queue}")
+                if target < current:
+                    self.shrink_wanted_since.pop(queue, None)
+            spare = max(spare - max(target - current, 0), 0)
+
+            decisions[queue] = {
+                'depth': depth,
+                'backlog_seconds': backlog.get(queue, 0.0),
+                'processes': target,
+            }
+        return decisions
+
+    def run(self, ticks: Optional[int] = None, sleep: Callable[[float], None] = time.sleep) -> None:
+        """Tick every ``interval_seconds``, forever or for ``ticks`` rounds"""
+        count = 0
+        while ticks is None or count < ticks:
+            try:
+                self.tick()
+            except Exception as e:
+                logger.error(f"Autoscale round failed: {str(e)}")
+            count += 1
+            sleep(self.config['interval_seconds'])
+
+
+class InMemoryRedis:
+    """Stand-in for the broker's Redis lists, for simulating the controller locally"""
+
+    def __init__(self):
+        self.lists = {}
+
+    def rpush(self, key: str, *values) -> int:
+        self.lists.setdefault(key, []).extend(values)
+        return len(self.lists[key])
+
+    def lpush(self, key: str, *values) -> int:
+        for value in values:
+            self.lists.setdefault(key, []).insert(0, value)
+        return len(self.lists[key])
+
+    def lpop(self, key: str):
+        items = self.lists.get(key)
+        return items.pop(0) if items else None
+
+    def llen(self, key: str) -> int:
+        return len(self.lists.get(key, []))
+
+    def lrange(self, key: str, start: int, end: int) -> list:
+        items = self.lists.get(key, [])
+        return items[start:] if end == -1 else items[start:end + 1]
+
+
+class SimulatedPools:
+    """
+    Worker pools that drain an InMemoryRedis queue
+
+    Every message is a job's compute seconds; each process works on one job
+    at a time for as many seconds as the simulation advances.
+    """
+
+    def __init__(self, redis_client: InMemoryRedis, sizes: Dict[str, int]):
+        self.redis_client = redis_client
+        self.sizes = dict(sizes)
+        # Remaining seconds of the job each process is working on (None when idle)
+        self.running = {queue: [None] * size for queue, size in sizes.items()}
+        self.completed = {queue: 0 for queue in sizes}
+
+    def refresh(self) -> Dict[str, int]:
+        return dict(self.sizes)
+
+    def resize(self, queue: str, current: int, target: int) -> None:
+        running = self.running[queue]
+        # Jobs held by removed processes go back to the front of the queue
+        while len(running) > target:
+            remaining = running.pop()
+            if remaining is not None:
+                self.redis_client.lpush(queue, remaining)
+        running.extend([None] * (target - len(running)))
+        self.sizes[queue] = target
+
+    def advance(self, seconds: float) -> None:
+        for queue, running in self.running.items():
+            for slot in range(len(running)):
+                budget = seconds
+                while budget > 0:
+                    if running[slot] is None:
+                        job = self.redis_client.lpop(queue)
+                        if job is None:
+                            break
+                        running[slot] = float(job)
+                    work = min(budget, running[slot])
+                    running[slot] -= work
+                    budget -= work
+                    if running[slot] <= 0:
+                        running[slot] = None
+                        self.completed[queue] += 1
+
+    def backlog(self) -> Dict[str, float]:
+        return {
+            queue: (sum(float(v) for v in self.redis_client.lrange(queue, 0, -1)) +
+                    sum(r for r in self.running[queue] if r is not None))
+            for queue in self.sizes
+        }
+
+
+def queue_tier_costs() -> Dict[str, float]:
+    """Compute seconds per audio second of the tier routed to each queue"""
+    return {get_tier(name)['queue']: get_tier(name)['compute_per_audio_second'] for name in QUALITY_TIERS}
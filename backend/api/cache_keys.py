@@ -0,0 +1,8 @@
+"""
+Cache keys shared by the views and the background maintenance code
+"""
+
+
+def status_cache_key(pk) -> str:
+    """Cached status row of a finished job, served by the async status views"""
+    return f"job-status:{pk}"
@@ -0,0 +1,100 @@
+"""
+Durable per-stage checkpoints for resumable pipeline runs
+"""
+import json
+import logging
+import os
+import tempfile
+import time
+from typing import Dict, Optional
+
+from .voice_profile import file_sha256
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_NAME = 'manifest.json'
+
+
+class StageManifest:
+    """
+    Small JSON manifest in a job's work dir listing finished stages
+
+    Each completed stage records its artifacts with their SHA-256 and the
+    parameters it ran with. A stage counts as done only if every artifact
+    is still on disk with the same hash and the parameters match, so a
+    retry never reuses a truncated file or output produced with different
+    settings.
+    """
+
+    def __init__(self, work_dir: str):
+        self.work_dir = work_dir
+        self.path = os.path.join(work_dir, MANIFEST_NAME)
+        self.stages = self._load()
+
+    def _load(self) -> dict:
+        try:
+            with open(self.path) as f:
+                return json.load(f).get('stages', {})
+        except FileNotFoundError:
+            return {}
+        except (ValueError, OSError) as e:
+            logger.warning(f"Ignoring unreadable manifest {self.path}: {e}")
+            return {}
+
+    def _save(self) -> None:
+        os.makedirs(self.work_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.work_dir, suffix='.json.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'stages': self.stages}, f, indent=2)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def completed(self, stage: str, params: Optional[dict] = None) -> Optional[Dict[str, str]]:
+        """
+        Return the artifacts of a finished stage, or None if it must (re)run
+
+        Args:
+            stage: Stage name
+            params: Parameters the stage would run with now
+        """
+        entry = self.stages.get(stage)
+        if entry is None or entry.get('params') != (params or {}):
+            return None
+
+        artifacts = {}
+        for name, info in entry['artifacts'].items():
+            path = os.path.join(self.work_dir, info['file'])
+            if not os.path.exists(path) or file_sha256(path) != info['sha256']:
+                logger.warning(f"Checkpoint for stage {stage} is stale ({info['file']} changed)")
+                return None
+            artifacts[name] = path
+
+        logger.info(f"Resuming past completed stage: {stage}")
+        return artifacts
+
+    def mark_completed(self, stage: str, artifacts: Dict[str, str], params: Optional[dict] = None) -> None:
+        """
+        Record a finished stage and its artifacts
+
+        Args:
+            stage: Stage name
+            artifacts: Mapping of artifact name to path inside the work dir
+            params: Parameters the stage ran with
+        """
+        self.stages[stage] = {
+            'completed_at': time.time(),
+            'params': params or {},
+            'artifacts': {
+                name: {
+                    'file': os.path.relpath(path, self.work_dir),
+                    'sha256': file_sha256(path),
+                }
+                for name, path in artifacts.items()
+            },
+        }
+        self._save()
@@ -0,0 +1,266 @@
+"""
+In-process MDX-Net vocal separation over overlapping windows on all cores
+"""
+import logging
+import math
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
+
+from celery.exceptions import SoftTimeLimitExceeded
+from django.conf import settings
+
+from .exceptions import JobCancelled
+from .inference_server import InferenceServerUnavailable, get_client
+from .worker_resources import current_budget, get_onnx_session
+
+try:
+    import numpy as np
+    import soundfile as sf
+    import torch
+    import onnxruntime  # noqa: F401
+    CHUNKED_SEPARATION_AVAILABLE = True
+except ImportError as e:
+    logging.warning(f"Chunked separation not available: {e}")
+    CHUNKED_SEPARATION_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+SAMPLE_RATE = 44100
+HOP_LENGTH = 1024
+
+# STFT geometry and output gain of the public UVR MDX-Net models (from the
+# UVR model data table). All of them predict the vocal stem.
+MDX_MODEL_PARAMS = {
+    'UVR-MDX-NET-Voc_FT': {'n_fft': 7680, 'dim_f': 3072, 'dim_t': 256, 'compensate': 1.021},
+    'UVR_MDXNET_KARA_2': {'n_fft': 5120, 'dim_f': 2048, 'dim_t': 256, 'compensate': 1.065},
+    'UVR_MDXNET_9482': {'n_fft': 6144, 'dim_f': 2048, 'dim_t': 256, 'compensate': 1.035},
+}
+
+
+def get_model_dir() -> str:
+    """Directory holding the UVR5 ONNX models"""
+    return getattr(settings, 'UVR5_MODEL_PATH', os.path.join(settings.BASE_DIR, 'models', 'uvr5'))
+
+
+def supports_model(model_name: str) -> bool:
+    """True if ``model_name`` can be run by the chunked separator on this host"""
+    return (CHUNKED_SEPARATION_AVAILABLE and model_name in MDX_MODEL_PARAMS and
+            os.path.exists(os.path.join(get_model_dir(), f"{model_name}.onnx")))
+
+
+class MDXSeparator:
+    """
+    Runs an MDX-Net ONNX model over a stereo 44.1 kHz signal
+
+    ``demix`` is thread-safe: the ONNX Runtime session may be shared by
+    several threads, and the STFT helpers hold no mutable state. Sessions
+    are cached per process, so only the first job in a worker pays for
+    loading the model. With a ``client`` the model is not loaded here
+    unless the server goes away: ``demix`` is sent to the inference
+    server, which batches it with other jobs' windows.
+    """
+
+    def __init__(self, model_name: str, intra_op_threads: Optional[int] = 1, batch_size: int = 4,
+                 client=None):
+        self.model_name = model_name
+        self.client = client
+        self.intra_op_threads = intra_op_threads
+        self.batch_size = batch_size
+        self._session_lock = threading.Lock()
+        params = MDX_MODEL_PARAMS[model_name]
+        self.n_fft = params['n_fft']
+        self.dim_f = params['dim_f']
+        self.dim_t = params['dim_t']
+        self.compensate = params['compensate']
+        self.n_bins = self.n_fft // 2 + 1
+        self.chunk_size = HOP_LENGTH * (self.dim_t - 1)
+        self.trim = self.n_fft // 2
+        self.gen_size = self.chunk_size - 2 * self.trim
+        self.window = torch.hann_window(self.n_fft, periodic=True)
+        self.session = None
+        if client is None:
+            self._load_session()
+
+    def _load_session(self):
+        with self._session_lock:
+            if self.session is not None:
+                return
+            session = get_onnx_session(os.path.join(get_model_dir(), f"{self.model_name}.onnx"),
+                                       self.intra_op_threads)
+            model_input = session.get_inputs()[0]
+            self.input_name = model_input.name
+            # Some exports fix the batch dimension; respect it when they do
+            if isinstance(model_input.shape[0], int):
+                self.batch_size = model_input.shape[0]
+            self.session = session
+
+    def _stft(self, x):
+        x = x.reshape([-1, self.chunk_size])
+        x = torch.stft(x, n_fft=self.n_fft, hop_length=HOP_LENGTH, window=self.window,
+                       center=True, return_complex=True)
+        x = torch.view_as_real(x).permute([0, 3, 1, 2])
+        x = x.reshape([-1, 2, 2, self.n_bins, self.dim_t]).reshape([-1, 4, self.n_bins, self.dim_t])
+        return x[:, :, :self.dim_f]
+
+    def _istft(self, x):
+        freq_pad = torch.zeros([x.shape[0], 4, self.n_bins - self.dim_f, self.dim_t])
+        x = torch.cat([x, freq_pad], -2)
+        x = x.reshape([-1, 2, 2, self.n_bins, self.dim_t]).reshape([-1, 2, self.n_bins, self.dim_t])
+        x = torch.view_as_complex(x.permute([0, 2, 3, 1]).contiguous())
+        x = torch.istft(x, n_fft=self.n_fft, hop_length=HOP_LENGTH, window=self.window, center=True)
+        return x.reshape([-1, 2, self.chunk_size])
+
+    def predict_specs(self, specs: 'np.ndarray') -> 'np.ndarray':
+        """Run the model over a batch of spectrogram chunks"""
+        outputs = []
+        for start in range(0, len(specs), self.batch_size):
+            batch = specs[start:start + self.batch_size]
+            outputs.append(self.session.run(None, {self.input_name: batch})[0])
+        return np.concatenate(outputs)
+
+    def mix_to_specs(self, mix: 'np.ndarray') -> 'np.ndarray':
+        """Split a stereo segment into padded chunks and return their spectrograms"""
+        n_sample = mix.shape[1]
+        pad = self.gen_size - n_sample % self.gen_size
+        mix_p = np.concatenate([np.zeros((2, self.trim)), mix, np.zeros((2, pad)),
+                                np.zeros((2, self.trim))], axis=1)
+
+        chunks = [mix_p[:, i:i + self.chunk_size] for i in range(0, n_sample + pad, self.gen_size)]
+        return self._stft(torch.tensor(np.array(chunks), dtype=torch.float32)).numpy()
+
+    def preds_to_vocals(self, pred: 'np.ndarray', n_sample: int) -> 'np.ndarray':
+        """Turn the model output for the chunks of one segment back into audio"""
+        waves = self._istft(torch.from_numpy(pred))
+        vocals = waves[:, :, self.trim:-self.trim].transpose(0, 1).reshape(2, -1).numpy()
+        return vocals[:, :n_sample] * self.compensate
+
+    def demix(self, mix: 'np.ndarray') -> 'np.ndarray':
+        """
+        Predict the vocal stem of a stereo segment
+
+        Args:
+            mix: float32 array of shape (2, samples)
+
+        Returns:
+            Vocal stem with the same shape as ``mix``
+        """
+        client = self.client
+        if client is not None:
+            try:
+                return client.call('demix', self.model_name, mix)
+            except InferenceServerUnavailable as e:
+                logger.warning(f"{e}; separating in-process")
+                self.client = None
+        if self.session is None:
+            self._load_session()
+        return self.preds_to_vocals(self.predict_specs(self.mix_to_specs(mix)), mix.shape[1])
+
+
+def _window_weights(length: int, fade_in: int, fade_out: int) -> 'np.ndarray':
+    """Linear crossfade weights for overlap-adding a window"""
+    weights = np.ones(length, dtype=np.float32)
+    if fade_in:
+        weights[:fade_in] = np.linspace(0, 1, fade_in + 2, dtype=np.float32)[1:-1]
+    if fade_out:
+        weights[-fade_out:] = np.linspace(1, 0, fade_out + 2, dtype=np.float32)[1:-1]
+    return weights
+
+
+def window_seconds_for(duration: float, workers: int, overlap: float, min_seconds: float) -> float:
+    """Window length that splits a song into one window per worker, but no shorter than ``min_seconds``"""
+    overlap = min(max(overlap, 0.0), 0.5)
+    return max(math.ceil(duration / (workers * (1 - overlap) + overlap)), min_seconds)
+
+
+def separate_chunked(audio_path: str, vocals_path: str, instrumental_path: str,
+                     model_name: str, overlap: float = 0.25,
+                     window_seconds: Optional[float] = None,
+                     workers: Optional[int] = None,
+                     cancel_check: Optional[Callable[[], bool]] = None) -> bool:
+    """
+    Separate a song into vocals and instrumental using a pool of threads
+
+    The decoded song is split into windows of ``window_seconds`` that
+    overlap by ``overlap`` (a fraction of the window). By default the
+    window is sized so that there is one window per worker. Windows are
+    separated concurrently and the vocal stems overlap-added back together
+    with linear crossfades; the instrumental is the mix minus the vocals.
+
+    Args:
+        audio_path: Input song
+        vocals_path: Where to write the vocal stem
+        instrumental_path: Where to write the instrumental stem
+        model_name: MDX-Net model (see ``MDX_MODEL_PARAMS``)
+        overlap: Fraction of each window shared with the next one
+        window_seconds: Window length (defaults to the configured value, or
+            the song split evenly across the workers)
+        workers: Pool size (defaults to the process's thread budget)
+        cancel_check: Called between windows; returning True raises JobCancelled
+
+    Returns:
+        bool: True if separation succeeded
+    """
+    if not supports_model(model_name):
+        logger.error(f"Chunked separation not available for model {model_name}")
+        return False
+
+    try:
+        import librosa
+
+        config = getattr(settings, 'UVR_CHUNKED_SEPARATION', {})
+        window_seconds = window_seconds or config.get('window_seconds')
+        workers = workers or config.get('workers') or current_budget()['intra_op']
+
+        mix, _ = librosa.load(audio_path, sr=SAMPLE_RATE, mono=False)
+        if mix.ndim == 1:
+            mix = np.stack([mix, mix])
+        mix = mix.astype(np.float32)
+        n_samples = mix.shape[1]
+        if not window_seconds:
+            window_seconds = window_seconds_for(n_samples / SAMPLE_RATE, workers, overlap,
+                                                config.get('min_window_seconds', 10))
+
+        window = int(window_seconds * SAMPLE_RATE)
+        overlap_len = int(window * min(max(overlap, 0.0), 0.5))
+        step = window - overlap_len
+        starts = list(range(0, max(n_samples - overlap_len, 1), step))
+
+        separator = MDXSeparator(model_name, client=get_client())
+        logger.info(f"Separating {len(starts)} window(s) of {window_seconds}s with {workers} worker(s)")
+
+        def run_window(start):
+            end = min(start + window, n_samples)
+            return start, end, separator.demix(mix[:, start:end])
+
+        vocals = np.zeros_like(mix)
+        weight_sum = np.zeros(n_samples, dtype=np.float32)
+        pool = ThreadPoolExecutor(max_workers=workers)
+        try:
+            for start, end, stem in pool.map(run_window, starts):
+                # Checked here, in the calling thread, so the check may use
+                # the caller's database connection
+                if cancel_check and cancel_check():
+                    raise JobCancelled()
+                fade_in = overlap_len if start > 0 else 0
+                fade_out = overlap_len if end < n_samples else 0
+                weights = _window_weights(end - start, min(fade_in, end - start), min(fade_out, end - start))
+                vocals[:, start:end] += stem * weights
+                weight_sum[start:end] += weights
+        finally:
+            # Drop windows that have not started yet when bailing out early
+            pool.shutdown(wait=True, cancel_futures=True)
+
+        vocals /= np.maximum(weight_sum, 1e-8)
+        instrumental = mix - vocals
+
+        sf.write(vocals_path, vocals.T, SAMPLE_RATE)
+        sf.write(instrumental_path, instrumental.T, SAMPLE_RATE)
+        return True
+
+    except (JobCancelled, SoftTimeLimitExceeded):
+        raise
+    except Exception as e:
+        logger.error(f"Chunked separation failed: {str(e)}")
+        return False
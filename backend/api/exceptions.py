@@ -0,0 +1,11 @@
+"""
+Exceptions shared by the pipeline and the Celery tasks
+"""
+
+
+class JobCancelled(Exception):
+    """Raised at a stage or segment boundary when the job has been cancelled"""
+
+
+class AttemptInterrupted(Exception):
+    """Raised when a job's message is redelivered after the attempt it started was lost"""
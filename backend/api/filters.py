@@ -0,0 +1,40 @@
+"""
+Job list filtering shared by the DRF and async listing views
+"""
+import datetime
+
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .models import Job
+
+
+def parse_timestamp(value: str) -> datetime.datetime:
+    """Parse an ISO 8601 timestamp, assuming UTC when no offset is given"""
+    parsed = parse_datetime(value)
+    if parsed is None:
+        raise ValueError(f"Invalid timestamp: {value}")
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed, datetime.timezone.utc)
+    return parsed
+
+
+def filter_jobs(queryset, params):
+    """
+    Apply the listing filters from query parameters
+
+    Supports ``status`` (comma separated) and the ``created_after`` /
+    ``created_before`` ISO 8601 bounds. Raises ValueError on bad input.
+    """
+    statuses = [s for s in params.get('status', '').split(',') if s]
+    if statuses:
+        valid = {choice for choice, _ in Job.STATUS_CHOICES}
+        unknown = set(statuses) - valid
+        if unknown:
+            raise ValueError(f"Unknown status: {', '.join(sorted(unknown))}")
+        queryset = queryset.filter(status__in=statuses)
+    if params.get('created_after'):
+        queryset = queryset.filter(created_at__gte=parse_timestamp(params['created_after']))
+    if params.get('created_before'):
+        queryset = queryset.filter(created_at__lt=parse_timestamp(params['created_before']))
+    return queryset
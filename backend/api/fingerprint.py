@@ -0,0 +1,378 @@
+"""
+Spectral-peak audio fingerprints for finding already-separated copies of a song
+
+Exact hashes miss the same track re-ripped at another bitrate, resampled
+or trimmed. Constellation hashes (pairs of spectrogram peaks with their
+time gap) survive all of those; a local SQLite inverted index maps each
+hash to the songs and times it occurs at, and a match is the song with
+the most hashes agreeing on a single time offset.
+"""
+import logging
+import os
+import sqlite3
+import time
+from collections import Counter, defaultdict
+from contextlib import closing
+from typing import Dict, List, Optional, Tuple
+
+from celery.exceptions import SoftTimeLimitExceeded
+from django.conf import settings
+
+from . import metrics, stem_cache
+
+try:
+    import numpy as np
+    import soundfile as sf
+    import librosa
+    from scipy.ndimage import maximum_filter
+    from scipy.signal import correlate
+    FINGERPRINT_AVAILABLE = True
+except ImportError as e:
+    logging.warning(f"Audio fingerprinting not available: {e}")
+    FINGERPRINT_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+FINGERPRINT_SR = 11025
+N_FFT = 2048
+HOP_LENGTH = 512
+STEM_SR = 44100
+
+PEAKS_PER_FRAME = 5
+PEAK_NEIGHBOURHOOD = (15, 7)  # frequency bins x frames
+FAN_OUT = 5
+MAX_DT = 63  # frames; fits the 6 bits of the hash
+MAX_DF = 200  # bins
+
+DEFAULT_CONFIG = {
+    'enabled': True,
+    'query_seconds': 30,  # excerpt of the new song looked up in the index
+    'min_matches': 20,  # hashes agreeing on the best offset
+    'min_ratio': 0.05,  # ... as a fraction of the query hashes
+    'min_correlation': 0.9,  # between the new song and the aligned stems
+    'min_coverage': 0.98,  # fraction of the new song the matched stems cover
+    'candidates': 3,
+}
+
+
+def get_config() -> dict:
+    config = dict(DEFAULT_CONFIG)
+    config.update(getattr(settings, 'FINGERPRINT', {}))
+    return config
+
+
+def get_db_path() -> str:
+    return str(getattr(settings, 'FINGERPRINT_DB', os.path.join(settings.MEDIA_ROOT, 'fingerprints.sqlite3')))
+
+
+def _connect() -> sqlite3.Connection:
+    path = get_db_path()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    conn = sqlite3.connect(path, timeout=30)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('CREATE TABLE IF NOT EXISTS songs '
+                 '(id INTEGER PRIMARY KEY, sha256 TEXT UNIQUE NOT NULL, duration REAL, created_at REAL)')
+    conn.execute('CREATE TABLE IF NOT EXISTS hashes '
+                 '(hash INTEGER NOT NULL, song_id INTEGER NOT NULL, offset INTEGER NOT NULL)')
+    conn.execute('CREATE INDEX IF NOT EXISTS hashes_hash ON hashes (hash)')
+    # Evicting a song deletes its hashes by song_id
+    conn.execute('CREATE INDEX IF NOT EXISTS hashes_song ON hashes (song_id)')
+    return conn
+
+
+def find_peaks(audio: 'np.ndarray') -> List[Tuple[int, int]]:
+    """
+    Return the (frame, bin) spectrogram peaks of a mono 11.025 kHz signal
+
+    A peak is a local maximum over ``PEAK_NEIGHBOURHOOD``; only the
+    loudest ``PEAKS_PER_FRAME`` per frame are kept so loud and quiet
+    passages yield a similar density.
+    """
+    spec = np.abs(librosa.stft(audio, n_fft=N_FFT, hop_length=HOP_LENGTH))[:N_FFT // 2]
+    spec_db = librosa.amplitude_to_db(spec, ref=np.max)
+    is_peak = (maximum_filter(spec_db, size=PEAK_NEIGHBOURHOOD) == spec_db) & (spec_db > -70)
+
+    peaks = []
+    bins, frames = np.nonzero(is_peak)
+    values = spec_db[bins, frames]
+    order = np.lexsort((-values, frames))
+    last_frame, taken = -1, 0
+    for idx in order:
+        frame = int(frames[idx])
+        taken = taken + 1 if frame == last_frame else 1
+        last_frame = frame
+        if taken <= PEAKS_PER_FRAME:
+            peaks.append((frame, int(bins[idx])))
+    return peaks
+
+
+def hash_peaks(peaks: List[Tuple[int, int]]) -> List[Tuple[int, int]]:
+    """
+    Pair each anchor peak with the next ``FAN_OUT`` peaks in its target zone
+
+    Returns:
+        List of (hash, anchor frame); the hash packs the two frequency bins
+        (10 bits each) and the frame gap (6 bits)
+    """
+    peaks = sorted(peaks)
+    hashes = []
+    for i, (t1, f1) in enumerate(peaks):
+        paired = 0
+        for t2, f2 in peaks[i + 1:]:
+            dt = t2 - t1
+            if dt > MAX_DT:
+                break
+            if dt < 1 or abs(f2 - f1) > MAX_DF:
+                continue
+            hashes.append(((f1 << 16) | (f2 << 6) | dt, t1))
+            paired += 1
+            if paired == FAN_OUT:
+                break
+    return hashes
+
+
+def fingerprint_file(path: str, start: Optional[float] = None,
+                     duration: Optional[float] = None) -> Tuple[List[Tuple[int, int]], float]:
+    """
+    Fingerprint an audio file (or an excerpt of it)
+
+    Returns:
+        Tuple of (hashes, duration of the whole file in seconds); hash
+        times are frames from the start of the file
+    """
+    total = librosa.get_duration(path=path)
+    audio, _ = librosa.load(path, sr=FINGERPRINT_SR, mono=True, offset=start or 0.0, duration=duration)
+    hashes = hash_peaks(find_peaks(audio))
+    if start:
+        frame_offset = int(round(start * FINGERPRINT_SR / HOP_LENGTH))
+        hashes = [(h, t + frame_offset) for h, t in hashes]
+    return hashes, total
+
+
+def index_song(path: str, sha256: str) -> bool:
+    """
+    Add a song whose stems are in the stem cache to the fingerprint index
+
+    Returns:
+        bool: True if the song is (now) in the index
+    """
+    if not (FINGERPRINT_AVAILABLE and get_config()['enabled']):
+        return False
+    try:
+        with closing(_connect()) as conn:
+            if conn.execute('SELECT 1 FROM songs WHERE sha256 = ?', (sha256,)).fetchone():
+                return True
+            hashes, duration = fingerprint_file(path)
+            with conn:
+                cursor = conn.execute('INSERT OR IGNORE INTO songs (sha256, duration, created_at) VALUES (?, ?, ?)',
+                                      (sha256, duration, time.time()))
+                if cursor.rowcount:
+                    conn.executemany('INSERT INTO hashes (hash, song_id, offset) VALUES (?, ?, ?)',
+                                     [(h, cursor.lastrowid, t) for h, t in hashes])
+        logger.info(f"Indexed {len(hashes)} fingerprint hashes for song {sha256}")
+        return True
+    except Exception as e:
+        logger.warning(f"Failed to fingerprint song {sha256}: {e}")
+        return False
+
+
+def remove_song(sha256: str) -> None:
+    """Drop a song from the index, e.g. when its stems are evicted"""
+    if not FINGERPRINT_AVAILABLE:
+        return
+    try:
+        with closing(_connect()) as conn, conn:
+            row = conn.execute('SELECT id FROM songs WHERE sha256 = ?', (sha256,)).fetchone()
+            if row:
+                conn.execute('DELETE FROM hashes WHERE song_id = ?', row)
+                conn.execute('DELETE FROM songs WHERE id = ?', row)
+    except Exception as e:
+        logger.warning(f"Failed to remove song {sha256} from the fingerprint index: {e}")
+
+
+def match(hashes: List[Tuple[int, int]], exclude: Optional[str] = None, limit: int = 3) -> List[dict]:
+    """
+    Find indexed songs sharing hashes with a query at a consistent offset
+
+    Args:
+        hashes: Query hashes from ``fingerprint_file``
+        exclude: sha256 to leave out (the query song itself)
+        limit: Most candidates to return
+
+    Returns:
+        Candidates, best first: {'sha256', 'offset_seconds', 'matches',
+        'ratio'}; a query time t lines up with time t + offset_seconds of
+        the indexed song
+    """
+    config = get_config()
+    query_times = defaultdict(list)
+    for h, t in hashes:
+        query_times[h].append(t)
+    if not query_times:
+        return []
+
+    votes = Counter()
+    with closing(_connect()) as conn:
+        keys = list(query_times)
+        for start in range(0, len(keys), 900):
+            batch = keys[start:start + 900]
+            rows = conn.execute(f"SELECT hash, song_id, offset FROM hashes WHERE hash IN "
+                                f"({','.join('?' * len(batch))})", batch)
+            for h, song_id, ref_t in rows:
+                for query_t in query_times[h]:
+                    votes[(song_id, ref_t - query_t)] += 1
+
+        best = {}
+        for (song_id, delta), count in votes.most_common():
+            if song_id not in best:
+                best[song_id] = (delta, count)
+            if len(best) >= limit + 1:
+                break
+        # Look up only the candidates rather than the whole songs table
+        songs = dict(conn.execute(f"SELECT id, sha256 FROM songs WHERE id IN ({','.join('?' * len(best))})",
+                                  list(best)).fetchall()) if best else {}
+
+    candidates = []
+    for song_id, (delta, count) in sorted(best.items(), key=lambda item: -item[1][1]):
+        sha256 = songs.get(song_id)
+        ratio = count / len(hashes)
+        if sha256 is None or sha256 == exclude:
+            continue
+        if count < config['min_matches'] or ratio < config['min_ratio']:
+            continue
+        candidates.append({
+            'sha256': sha256,
+            'offset_seconds': delta * HOP_LENGTH / FINGERPRINT_SR,
+            'matches': count,
+            'ratio': ratio,
+        })
+    return candidates[:limit]
+
+
+def _load_stereo(path: str) -> 'np.ndarray':
+    audio, sr = sf.read(path, dtype='float32', always_2d=True)
+    audio = audio.T
+    if sr != STEM_SR:
+        audio = librosa.resample(audio, orig_sr=sr, target_sr=STEM_SR)
+    if audio.shape[0] == 1:
+        audio = np.concatenate([audio, audio])
+    return audio[:2]
+
+
+def _shift(audio: 'np.ndarray', lag: int, length: int) -> Tuple['np.ndarray', int, int]:
+    """Return ``audio`` shifted so out[t] = audio[t + lag], plus the covered range"""
+    out = np.zeros((audio.shape[0], length), dtype=np.float32)
+    lo = max(0, -lag)
+    hi = min(length, audio.shape[1] - lag)
+    if hi > lo:
+        out[:, lo:hi] = audio[:, lo + lag:hi + lag]
+    return out, lo, hi
+
+
+def refine_lag(query: 'np.ndarray', reference: 'np.ndarray', coarse: int, search: int = 4096,
+               excerpt_seconds: float = 5.0) -> int:
+    """
+    Refine a fingerprint offset (one hop, ~46 ms) to the sample
+
+    Cross-correlates a few seconds from the middle of the query with the
+    reference around the coarse lag.
+    """
+    length = int(excerpt_seconds * STEM_SR)
+    start = max((len(query) - length) // 2, 0)
+    excerpt = query[start:start + length]
+    ref_start = start + coarse - search
+    if ref_start < 0 or ref_start + len(excerpt) + 2 * search > len(reference) or len(excerpt) < STEM_SR:
+        return coarse
+    window = reference[ref_start:ref_start + len(excerpt) + 2 * search]
+    corr = correlate(window, excerpt, mode='valid', method='fft')
+    return coarse - search + int(np.argmax(corr))
+
+
+def align_stems(song_path: str, stems: Dict[str, str], offset_seconds: float,
+                out_dir: str) -> Optional[Dict[str, str]]:
+    """
+    Derive stems for a song from the stems of a matching copy
+
+    The matched vocals are shifted by the sample-accurate offset and
+    scaled to the new song's level; the instrumental is the new song minus
+    those vocals, so the mix adds up to exactly what the user uploaded.
+
+    Returns:
+        {'vocals': path, 'instrumental': path} in ``out_dir``, or None if
+        the aligned stems do not explain the song well enough
+    """
+    config = get_config()
+    song, _ = librosa.load(song_path, sr=STEM_SR, mono=False)
+    if song.ndim == 1:
+        song = np.stack([song, song])
+    song = song.astype(np.float32)
+    vocals = _load_stereo(stems['vocals'])
+    reference = vocals + _load_stereo(stems['instrumental'])
+
+    lag = refine_lag(song.mean(0), reference.mean(0), int(round(offset_seconds * STEM_SR)))
+    aligned_mix, lo, hi = _shift(reference, lag, song.shape[1])
+    coverage = (hi - lo) / max(song.shape[1], 1)
+    if coverage < config['min_coverage']:
+        logger.info(f"Fingerprint match covers only {coverage:.0%} of the song")
+        return None
+
+    query = song[:, lo:hi].ravel()
+    ref = aligned_mix[:, lo:hi].ravel()
+    correlation = float(np.corrcoef(query, ref)[0, 1]) if query.std() and ref.std() else 0.0
+    if correlation < config['min_correlation']:
+        logger.info(f"Fingerprint match rejected: aligned correlation {correlation:.3f}")
+        return None
+
+    gain = float(np.dot(query, ref) / max(np.dot(ref, ref), 1e-9))
+    aligned_vocals, _, _ = _shift(vocals, lag, song.shape[1])
+    aligned_vocals *= gain
+
+    os.makedirs(out_dir, exist_ok=True)
+    paths = {name: os.path.join(out_dir, f"{name}.wav") for name in stem_cache.STEM_NAMES}
+    sf.write(paths['vocals'], aligned_vocals.T, STEM_SR)
+    sf.write(paths['instrumental'], (song - aligned_vocals).T, STEM_SR)
+    logger.info(f"Aligned matched stems (lag {lag} samples, gain {gain:.3f}, correlation {correlation:.3f})")
+    return paths
+
+
+def find_reusable_stems(song_path: str, song_sha256: str, model_name: str, overlap: float,
+                        out_dir: str) -> Optional[Dict[str, str]]:
+    """
+    Look the song up in the fingerprint index and reuse a match's stems
+
+    Only matches whose stems were separated with the same model and
+    overlap are used. Lookups, matches and lookup latency are recorded in
+    the metrics as ``fingerprint_lookups`` / ``fingerprint_matches`` and
+    the ``fingerprint_lookup`` stage.
+
+    Returns:
+        Aligned stem paths in ``out_dir``, or None to separate as usual
+    """
+    config = get_config()
+    if not (FINGERPRINT_AVAILABLE and config['enabled']) or not os.path.exists(get_db_path()):
+        return None
+
+    try:
+        metrics.incr('fingerprint_lookups')
+        with metrics.stage_timer('fingerprint_lookup'):
+            total = librosa.get_duration(path=song_path)
+            start = max((total - config['query_seconds']) / 2, 0.0)
+            hashes, _ = fingerprint_file(song_path, start=start, duration=config['query_seconds'])
+            candidates = match(hashes, exclude=song_sha256, limit=config['candidates'])
+
+        for candidate in candidates:
+            stems = stem_cache.lookup(stem_cache.stem_key(candidate['sha256'], model_name, overlap))
+            if not stems:
+                continue
+            aligned = align_stems(song_path, stems, candidate['offset_seconds'], out_dir)
+            if aligned:
+                metrics.incr('fingerprint_matches')
+                logger.info(f"Reusing stems of song {candidate['sha256']} "
+                            f"({candidate['matches']} matching hashes, offset {candidate['offset_seconds']:.2f}s)")
+                return aligned
+        return None
+    except SoftTimeLimitExceeded:
+        raise
+    except Exception as e:
+        logger.warning(f"Fingerprint lookup failed: {e}")
+        return None
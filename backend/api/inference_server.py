@@ -0,0 +1,347 @@
+"""
+Host-wide inference server holding the models once and batching requests across jobs
+
+Run with ``python manage.py run_inference_server``. When
+``INFERENCE_SERVER['socket']`` is set and the server answers on it, task
+processes send it their separation windows and conversions over a Unix
+socket instead of loading the models themselves. While it does not (or if
+it goes away mid-job) they load the models and run inference in-process. Separation windows that
+arrive within ``max_wait_ms`` of each other, from any job, are run through
+the MDX-Net model as one batch. Conversions and voice profiles run
+concurrently on a small pool of RVC model copies.
+"""
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+from typing import Any, Callable, Dict, List, Optional
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CONFIG = {
+    'socket': None,  # Unix socket path; None keeps inference in the task processes
+    'authkey': '',  # shared secret, or read from 'authkey_file'
+    'authkey_file': '',
+    'max_batch': 4,  # separation windows per batch
+    'max_wait_ms': 20,  # how long a window waits for others to batch with
+    'model_batch': 16,  # spectrogram chunks per MDX-Net run
+    'threads': None,  # defaults to every core
+    'rvc_copies': None,  # RVC model copies serving conversions; defaults to threads // rvc_threads
+    'rvc_threads': 4,  # torch threads per conversion when rvc_copies is derived
+}
+
+_client = None
+_serving = False
+
+
+class InferenceServerError(Exception):
+    """The inference server failed a request"""
+
+
+class InferenceServerUnavailable(InferenceServerError):
+    """The inference server could not be reached; callers fall back to in-process inference"""
+
+
+def get_config() -> dict:
+    config = dict(DEFAULT_CONFIG)
+    config.update(getattr(settings, 'INFERENCE_SERVER', {}))
+    return config
+
+
+def rvc_copies(config: dict, threads: int) -> int:
+    """Number of RVC model copies, so concurrent conversions together use ``threads``"""
+    if config.get('rvc_copies'):
+        return max(int(config['rvc_copies']), 1)
+    return max(threads // max(config.get('rvc_threads') or 1, 1), 1)
+
+
+def _authkey(config: Optional[dict] = None) -> bytes:
+    """
+    Secret shared by the server and its clients
+
+    Requests are unpickled by the server, so anyone able to connect can
+    run code in it; the key has its own setting rather than reusing
+    ``SECRET_KEY``, which is often left at its development default.
+
+    Raises:
+        ImproperlyConfigured: If neither ``authkey`` nor ``authkey_file`` is set
+    """
+    config = config or get_config()
+    key = config.get('authkey') or ''
+    if not key and config.get('authkey_file'):
+        with open(config['authkey_file']) as f:
+            key = f.read().strip()
+    if not key:
+        raise ImproperlyConfigured("Set INFERENCE_SERVER_AUTHKEY or INFERENCE_SERVER_AUTHKEY_FILE "
+                                   "to use the inference server")
+    return key.encode()
+
+
+def get_client() -> Optional['InferenceClient']:
+    """
+    Return the shared client, or None when inference runs in-process
+
+    The server is pinged rather than trusting the socket file, which a
+    killed server leaves behind.
+    """
+    global _client
+    config = get_config()
+    socket_path = config['socket']
+    if _serving or not socket_path or not os.path.exists(socket_path):
+        return None
+    if _client is None or _client.address != socket_path:
+        try:
+            _client = InferenceClient(socket_path, _authkey(config))
+        except (ImproperlyConfigured, OSError) as e:
+            logger.warning(f"Not using the inference server: {e}")
+            return None
+    return _client if _client.ping() else None
+
+
+class InferenceClient:
+    """
+    Sends requests to the inference server
+
+    Each thread (and each forked process) gets its own connection, so the
+    windows of a chunked separation are submitted concurrently and can be
+    batched together as well as with other jobs' windows.
+    """
+
+    def __init__(self, address: str, authkey: bytes):
+        self.address = address
+        self.authkey = authkey
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = Client(self.address, family='AF_UNIX', authkey=self.authkey)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def call(self, op: str, *args) -> Any:
+        """Run ``op`` on the server and return its result"""
+        try:
+            conn = self._connection()
+            conn.send((op, args))
+            status, value = conn.recv()
+        except (OSError, EOFError, AuthenticationError) as e:
+            self._local.conn = None
+            raise InferenceServerUnavailable(f"Inference server unavailable: {e}")
+        if status != 'ok':
+            raise InferenceServerError(value)
+        return value
+
+    def ping(self) -> bool:
+        """True if the server answers"""
+        try:
+            return self.call('ping')
+        except InferenceServerUnavailable:
+            return False
+
+
+class Batcher:
+    """
+    Groups requests submitted from many threads into batches for one model
+
+    A batch is run as soon as it holds ``max_batch`` requests or its first
+    request has waited ``max_wait`` seconds.
+    """
+
+    def __init__(self, name: str, run_batch: Callable[[List[Any]], List[Any]],
+                 max_batch: int, max_wait: float):
+        self.name = name
+        self.run_batch = run_batch
+        self.max_batch = max(max_batch, 1)
+        self.max_wait = max_wait
+        self.queue = queue.Queue()
+        threading.Thread(target=self._loop, name=f"batcher-{name}", daemon=True).start()
+
+    def submit(self, item) -> Future:
+        future = Future()
+        self.queue.put((item, future))
+        return future
+
+    def _loop(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            items = [item for item, _ in batch]
+            try:
+                with metrics.stage_timer(f"inference_{self.name}"):
+                    results = self.run_batch(items)
+                for (_, future), result in zip(batch, results):
+                    future.set_result(result)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+            metrics.incr('inference_batches')
+            metrics.incr('inference_batched_requests', len(batch))
+
+
+class InferenceServer:
+    """
+    Owns the loaded models and serves ``demix``, ``voice_profile`` and ``convert``
+
+    ``demix`` requests are batched per separation model. RVC's conversion
+    runs a whole file through HuBERT, RMVPE and the synthesizer inside the
+    RVC package, so it cannot be batched across requests; instead
+    ``convert`` and ``voice_profile`` requests each take one of up to
+    ``rvc_copies`` model copies, loaded as concurrent requests need them.
+    """
+
+    def __init__(self, address: Optional[str] = None, config: Optional[dict] = None):
+        global _serving
+        # Models loaded in this process must not be forwarded to itself
+        _serving = True
+        self.config = config or get_config()
+        self.address = address or self.config['socket']
+        if not self.address:
+            raise ValueError("No socket configured for the inference server")
+        self.authkey = _authkey(self.config)
+        self._batchers: Dict[str, Batcher] = {}
+        self._batchers_lock = threading.Lock()
+        self.rvc_copies = rvc_copies(self.config, self.config['threads'] or os.cpu_count() or 1)
+        self._cloners = queue.LifoQueue()
+        self._cloners_created = 0
+        self._cloners_lock = threading.Lock()
+
+    def _separation_batcher(self, model_name: str) -> Batcher:
+        import numpy as np
+
+        from .chunked_separation import MDXSeparator
+
+        with self._batchers_lock:
+            batcher = self._batchers.get(model_name)
+            if batcher is None:
+                separator = MDXSeparator(model_name, intra_op_threads=self.config['threads'],
+                                         batch_size=self.config['model_batch'])
+
+                def run_batch(mixes):
+                    specs = [separator.mix_to_specs(mix) for mix in mixes]
+                    preds = separator.predict_specs(np.concatenate(specs))
+                    results, start = [], 0
+                    for mix, spec in zip(mixes, specs):
+                        results.append(separator.preds_to_vocals(preds[start:start + len(spec)], mix.shape[1]))
+                        start += len(spec)
+                    return results
+
+                batcher = Batcher(model_name, run_batch, self.config['max_batch'],
+                                  self.config['max_wait_ms'] / 1000)
+                self._batchers[model_name] = batcher
+                logger.info(f"Loaded separation model {model_name}")
+            return batcher
+
+    def _new_cloner(self):
+        from .rvc_integration import RVCVoiceCloner
+
+        return RVCVoiceCloner()
+
+    def _checkout_cloner(self):
+        try:
+            return self._cloners.get_nowait()
+        except queue.Empty:
+            pass
+        with self._cloners_lock:
+            if self._cloners_created < self.rvc_copies:
+                self._cloners_created += 1
+                logger.info(f"Creating RVC model copy {self._cloners_created} of {self.rvc_copies}")
+                return self._new_cloner()
+        return self._cloners.get()
+
+    @contextmanager
+    def _rvc(self, model_path: str):
+        """Borrow an RVC model copy with ``model_path`` loaded"""
+        cloner = self._checkout_cloner()
+        try:
+            if model_path and model_path != cloner.current_model and not cloner.load_model(model_path):
+                raise InferenceServerError(f"Failed to load model {model_path}")
+            yield cloner
+        finally:
+            self._cloners.put(cloner)
+
+    def handle(self, op: str, args: tuple) -> Any:
+        if op == 'ping':
+            return True
+        if op == 'demix':
+            model_name, mix = args
+            return self._separation_batcher(model_name).submit(mix).result()
+        if op == 'convert':
+            model_path, input_audio, params = args
+            with self._rvc(model_path) as cloner, metrics.stage_timer('inference_convert'):
+                return cloner.vc.vc_inference(input_audio_path=input_audio, **params)
+        if op == 'voice_profile':
+            model_path, voice_sample_path = args
+            with self._rvc(model_path) as cloner:
+                return cloner.build_voice_profile(voice_sample_path)
+        raise InferenceServerError(f"Unknown operation {op}")
+
+    def _serve_connection(self, conn):
+        with conn:
+            while True:
+                try:
+                    op, args = conn.recv()
+                except (EOFError, OSError):
+                    return
+                try:
+                    reply = ('ok', self.handle(op, args))
+                except Exception as e:
+                    logger.error(f"Inference request {op} failed: {str(e)}")
+                    reply = ('error', f"{op} failed: {e}")
+                try:
+                    conn.send(reply)
+                except OSError:
+                    return
+
+    def preload(self, model_path: Optional[str] = None, separation_models: tuple = ()) -> None:
+        """Load models up front so the first jobs do not wait for them"""
+        for model_name in separation_models:
+            self._separation_batcher(model_name)
+        if model_path:
+            with self._rvc(model_path):
+                pass
+
+    def serve_forever(self) -> None:
+        if os.path.exists(self.address):
+            os.remove(self.address)
+        os.makedirs(os.path.dirname(os.path.abspath(self.address)), exist_ok=True)
+        # Only the server's user may connect; the umask covers the moment
+        # between bind and chmod
+        umask = os.umask(0o177)
+        try:
+            listener = Listener(self.address, family='AF_UNIX', authkey=self.authkey)
+        finally:
+            os.umask(umask)
+        os.chmod(self.address, 0o600)
+        logger.info(f"Inference server listening on {self.address}")
+        try:
+            while True:
+                try:
+                    conn = listener.accept()
+                except Exception as e:
+                    # A client with the wrong key, or one that hung up mid-handshake
+                    logger.warning(f"Rejected inference connection: {e}")
+                    continue
+                threading.Thread(target=self._serve_connection, args=(conn,), daemon=True).start()
+        finally:
+            listener.close()
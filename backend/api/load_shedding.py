@@ -0,0 +1,124 @@
+"""
+Load shedding: downgrade quality of newly started jobs while the queue is backed up
+"""
+import logging
+import time
+from typing import Optional, Tuple
+
+from django.conf import settings
+
+from . import metrics
+from .quality import downgrade_tier
+
+logger = logging.getLogger(__name__)
+
+LEVEL_KEY = 'load_shedding:level'
+CHANGED_AT_KEY = 'load_shedding:changed_at'
+
+DEFAULT_CONFIG = {
+    'enabled': True,
+    'queues': ['voice_clone', 'voice_clone_draft', 'voice_clone_studio'],
+    'latency_stages': ['separation', 'conversion'],
+    'high_queue_depth': 20,
+    'low_queue_depth': 5,
+    'high_stage_latency': 600,  # seconds, sum of recent stage medians
+    'low_stage_latency': 240,
+    'max_level': 2,
+    'min_seconds_between_changes': 60,
+}
+
+
+class LoadSheddingController:
+    """
+    Hysteresis controller over queue depth and recent stage latency
+
+    The shedding level is shared by all workers through Redis. Each level
+    moves newly started jobs one quality tier down (studio -> standard ->
+    draft). The level steps up while either signal is above its high
+    threshold and steps back down only once both are below their low
+    thresholds, at most once per ``min_seconds_between_changes``.
+    """
+
+    def __init__(self, config: Optional[dict] = None):
+        self.config = dict(DEFAULT_CONFIG)
+        self.config.update(config if config is not None else getattr(settings, 'LOAD_SHEDDING', {}))
+
+    def observe(self) -> dict:
+        """Return the current queue depth and recent stage latency"""
+        depth = sum(metrics.queue_depth(q) for q in self.config['queues'])
+        latency = 0.0
+        for stage in self.config['latency_stages']:
+            latency += metrics.recent_latency(stage) or 0.0
+        return {'queue_depth': depth, 'stage_latency': latency}
+
+    def current_level(self) -> int:
+        """Return the shedding level currently in force"""
+        client = metrics.get_redis()
+        if client is None:
+            return 0
+        try:
+            return int(client.get(LEVEL_KEY) or 0)
+        except Exception as e:
+            logger.warning(f"Failed to read load shedding level: {e}")
+            return 0
+
+    def update(self) -> int:
+        """Re-evaluate the signals and return the (possibly changed) level"""
+        level = self.current_level()
+        if not self.config['enabled']:
+            return 0
+
+        client = metrics.get_redis()
+        if client is None:
+            return level
+
+        signals = self.observe()
+        overloaded = (signals['queue_depth'] >= self.config['high_queue_depth'] or
+                      signals['stage_latency'] >= self.config['high_stage_latency'])
+        drained = (signals['queue_depth'] <= self.config['low_queue_depth'] and
+                   signals['stage_latency'] <= self.config['low_stage_latency'])
+
+        if overloaded:
+            new_level = min(level + 1, self.config['max_level'])
+        elif drained:
+            new_level = max(level - 1, 0)
+        else:
+            new_level = level
+
+        if new_level == level:
+            return level
+
+        try:
+            changed_at = float(client.get(CHANGED_AT_KEY) or 0)
+            if time.time() - changed_at < self.config['min_seconds_between_changes']:
+                return level
+            client.set(LEVEL_KEY, new_level)
+            client.set(CHANGED_AT_KEY, time.time())
+        except Exception as e:
+            logger.warning(f"Failed to update load shedding level: {e}")
+            return level
+
+        logger.info(f"Load shedding level {level} -> {new_level} "
+                    f"(queue depth {signals['queue_depth']}, stage latency {signals['stage_latency']:.0f}s)")
+        metrics.incr("load_shedding_level_changes")
+        return new_level
+
+    def select_tier(self, requested_tier: str) -> Tuple[str, str]:
+        """
+        Pick the tier a newly started job should actually run at
+
+        Args:
+            requested_tier: Tier the job was submitted with
+
+        Returns:
+            Tuple of (effective_tier, downgrade_reason); the reason is empty
+            when the job runs at the requested tier
+        """
+        level = self.update()
+        effective_tier = downgrade_tier(requested_tier, level)
+        if effective_tier == requested_tier:
+            return requested_tier, ''
+
+        metrics.incr('jobs_downgraded')
+        metrics.incr(f"jobs_downgraded:{requested_tier}->{effective_tier}")
+        return effective_tier, f"Load shedding level {level}: {requested_tier} downgraded to {effective_tier}"
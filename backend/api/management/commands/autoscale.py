@@ -0,0 +1,87 @@
+import json
+import math
+import random
+
+from django.core.management.base import BaseCommand
+
+from api.autoscale import (AutoscaleController, CeleryPools, InMemoryRedis, SimulatedPools,
+                           get_config, queue_tier_costs)
+
+
+class Command(BaseCommand):
+    help = ("Grow and shrink the worker pool of each stage queue with its backlog. "
+            "With --simulate, run the controller against an in-memory broker instead.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ticks', type=int, default=None,
+                            help="Stop after this many rounds (default: run forever, or 240 when simulating)")
+        parser.add_argument('--simulate', action='store_true',
+                            help="Drive simulated pools from a stand-in Redis instead of real workers")
+        parser.add_argument('--arrivals', type=float, default=0.2,
+                            help="Simulation: mean jobs per queue per round during the burst")
+        parser.add_argument('--memory-mb', type=int, default=16384,
+                            help="Simulation: host memory available to worker processes")
+        parser.add_argument('--seed', type=int, default=0, help="Simulation: random seed")
+
+    def handle(self, *args, **options):
+        config = get_config()
+        if options['simulate']:
+            self.simulate(config, options)
+            return
+
+        from music_voice_clone.celery import app
+
+        controller = AutoscaleController(CeleryPools(app, config['queues']), config)
+        self.stdout.write(f"Autoscaling {', '.join(config['queues'])} every {config['interval_seconds']}s")
+        controller.run(ticks=options['ticks'])
+
+    def simulate(self, config, options):
+        """
+        Feed a burst of jobs then a quiet spell through the controller
+
+        Arrivals run for the first half of the rounds; each job's compute
+        seconds are a 2-5 minute song at its queue's tier cost. Prints one
+        JSON line per round.
+        """
+        rng = random.Random(options['seed'])
+        ticks = options['ticks'] or 240
+        interval = config['interval_seconds']
+        costs = queue_tier_costs()
+
+        redis_client = InMemoryRedis()
+        pools = SimulatedPools(redis_client, {q: bounds['min'] for q, bounds in config['queues'].items()})
+        clock = {'now': 0.0}
+
+        def headroom():
+            used = sum(pools.sizes.values()) * config['memory_per_process_mb']
+            return max(options['memory_mb'] - used, 0) // config['memory_per_process_mb']
+
+        controller = AutoscaleController(pools, config, redis_client=redis_client,
+                                         backlog_fn=pools.backlog, headroom_fn=headroom,
+                                         clock=lambda: clock['now'])
+
+        for tick in range(ticks):
+            if tick < ticks // 2:
+                for queue in config['queues']:
+                    for _ in range(self.poisson(rng, options['arrivals'])):
+                        redis_client.rpush(queue, rng.uniform(120, 300) * costs.get(queue, 1.0))
+
+            decisions = controller.tick()
+            self.stdout.write(json.dumps({
+                't': clock['now'],
+                'queues': {q: {'depth': d['depth'], 'backlog_seconds': round(d['backlog_seconds']),
+                               'processes': d['processes'], 'completed': pools.completed[q]}
+                           for q, d in decisions.items()},
+            }))
+
+            pools.advance(interval)
+            clock['now'] += interval
+
+    @staticmethod
+    def poisson(rng, mean):
+        """Knuth's method; fine for the small means used here"""
+        limit, count, product = math.exp(-mean), 0, rng.random()
+        while product > limit:
+            count += 1
+            product *= rng.random()
+        return count
@@ -0,0 +1,131 @@
+import json
+import os
+import secrets
+import tempfile
+import threading
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from .benchmark_quantization import stand_in_layer
+
+
+class StandInCloner:
+    """Takes the place of an RVC model copy: a HuBERT-sized encoder run over 10 s of frames per conversion"""
+
+    def __init__(self):
+        import torch
+
+        torch.manual_seed(0)
+        self.encoder = torch.nn.Sequential(*[stand_in_layer() for _ in range(12)]).eval()
+        self.frames = torch.randn(1, 500, 768)
+        self.vc = self
+        self.current_model = None
+
+    def load_model(self, model_path: str) -> bool:
+        self.current_model = model_path
+        return True
+
+    def vc_inference(self, input_audio_path=None, **params):
+        import torch
+
+        with torch.no_grad():
+            return 16000, self.encoder(self.frames).numpy(), None, None
+
+
+class Command(BaseCommand):
+    help = ("Measure conversion throughput through the inference server for several numbers of "
+            "RVC model copies, with concurrent clients submitting conversions as workers would.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--input', help="Vocals to convert; without it (or without RVC) a "
+                                            "HuBERT-sized stand-in encoder is benchmarked")
+        parser.add_argument('--model', help="RVC model (default: RVC_MODEL_PATH)")
+        parser.add_argument('--clients', type=int, default=4, help="Concurrent clients (worker processes)")
+        parser.add_argument('--requests', type=int, default=3, help="Conversions per client")
+        parser.add_argument('--threads', type=int, help="Inference threads (default: every core)")
+        parser.add_argument('--copies', help="Comma-separated RVC copy counts to compare "
+                                             "(default: 1 and the configured count)")
+
+    def handle(self, *args, **options):
+        import torch
+
+        from api.inference_server import InferenceClient, InferenceServer, get_config, rvc_copies
+        from api.rvc_integration import RVC_AVAILABLE, default_model_path
+        from api.worker_resources import available_cores
+
+        threads = options['threads'] or len(available_cores())
+        config = get_config()
+        config.update({'threads': threads, 'authkey': secrets.token_hex(16)})
+        if options['copies']:
+            copy_counts = [int(value) for value in options['copies'].split(',')]
+        else:
+            copy_counts = sorted({1, rvc_copies(config, threads)})
+
+        stand_in = not (options['input'] and RVC_AVAILABLE)
+        if options['input'] and stand_in:
+            self.stderr.write("RVC not available; benchmarking the stand-in encoder instead")
+        model_path = None if stand_in else (options['model'] or default_model_path())
+        params = {'sid': 0, 'f0_method': 'rmvpe'}
+
+        results = []
+        socket_dir = tempfile.mkdtemp()
+        for copies in copy_counts:
+            config['rvc_copies'] = copies
+            address = os.path.join(socket_dir, f"inference-{copies}.sock")
+            server = InferenceServer(address=address, config=dict(config))
+            if stand_in:
+                server._new_cloner = StandInCloner
+            # Concurrent conversions split the cores between them
+            torch.set_num_threads(max(threads // copies, 1))
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            while not os.path.exists(address):
+                time.sleep(0.01)
+
+            client = InferenceClient(address, config['authkey'].encode())
+            # Load every copy before timing
+            self.run_clients(client, min(copies, options['clients']), 1, model_path, options['input'], params)
+            elapsed = self.run_clients(client, options['clients'], options['requests'],
+                                       model_path, options['input'], params)
+            conversions = options['clients'] * options['requests']
+            results.append({
+                'rvc_copies': copies,
+                'torch_threads': torch.get_num_threads(),
+                'seconds': round(elapsed, 3),
+                'conversions_per_second': round(conversions / elapsed, 3),
+            })
+
+        baseline = results[0]['conversions_per_second']
+        for result in results:
+            result['speedup'] = round(result['conversions_per_second'] / baseline, 2)
+        self.stdout.write(json.dumps({
+            'model': 'stand-in HuBERT-base encoder' if stand_in else model_path,
+            'threads': threads,
+            'clients': options['clients'],
+            'requests_per_client': options['requests'],
+            'results': results,
+        }, indent=2))
+
+    @staticmethod
+    def run_clients(client, clients: int, requests: int, model_path, input_audio, params) -> float:
+        """Run ``clients`` threads of ``requests`` conversions each; returns the wall time"""
+        errors = []
+
+        def work():
+            try:
+                for _ in range(requests):
+                    _, _, _, error = client.call('convert', model_path, input_audio, params)
+                    if error:
+                        errors.append(error)
+            except Exception as e:
+                errors.append(str(e))
+
+        workers = [threading.Thread(target=work) for _ in range(clients)]
+        start = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        if errors:
+            raise CommandError(f"Conversion failed: {errors[0]}")
+        return time.perf_counter() - start
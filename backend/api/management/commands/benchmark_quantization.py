@@ -0,0 +1,152 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+
+def snr_db(reference, test) -> float:
+    """Signal-to-noise ratio of ``test`` against ``reference`` in dB"""
+    import numpy as np
+
+    reference = np.asarray(reference, dtype=np.float64).ravel()
+    test = np.asarray(test, dtype=np.float64).ravel()[:len(reference)]
+    noise = np.sum((reference[:len(test)] - test) ** 2)
+    if noise == 0:
+        return float('inf')
+    return float(10 * np.log10(np.sum(reference ** 2) / noise))
+
+
+def timed(fn, repeats: int):
+    """Run ``fn`` once to warm up, then return (median seconds, last output)"""
+    import statistics
+
+    output = fn()
+    durations = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        output = fn()
+        durations.append(time.perf_counter() - start)
+    return statistics.median(durations), output
+
+
+def stand_in_layer():
+    """A post-norm transformer layer built from plain Linear projections, like fairseq's HuBERT"""
+    import torch
+    import torch.nn.functional as F
+
+    class Layer(torch.nn.Module):
+        def __init__(self, dim=768, heads=12, ffn_dim=3072):
+            super().__init__()
+            self.heads = heads
+            self.q_proj = torch.nn.Linear(dim, dim)
+            self.k_proj = torch.nn.Linear(dim, dim)
+            self.v_proj = torch.nn.Linear(dim, dim)
+            self.out_proj = torch.nn.Linear(dim, dim)
+            self.norm1 = torch.nn.LayerNorm(dim)
+            self.fc1 = torch.nn.Linear(dim, ffn_dim)
+            self.fc2 = torch.nn.Linear(ffn_dim, dim)
+            self.norm2 = torch.nn.LayerNorm(dim)
+
+        def forward(self, x):
+            batch, frames, dim = x.shape
+
+            def split(t):
+                return t.view(batch, frames, self.heads, dim // self.heads).transpose(1, 2)
+
+            attn = F.scaled_dot_product_attention(split(self.q_proj(x)), split(self.k_proj(x)),
+                                                  split(self.v_proj(x)))
+            x = self.norm1(x + self.out_proj(attn.transpose(1, 2).reshape(batch, frames, dim)))
+            return self.norm2(x + self.fc2(F.gelu(self.fc1(x))))
+
+    return Layer()
+
+
+class Command(BaseCommand):
+    help = ("A/B benchmark of FP32 against dynamically quantized INT8 inference on the CPU: "
+            "reports the speedup and the SNR of the INT8 output against FP32.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--input', help="Vocals to convert; without it (or without RVC) a "
+                                            "HuBERT-sized stand-in encoder is benchmarked")
+        parser.add_argument('--model', help="RVC model (default: RVC_MODEL_PATH)")
+        parser.add_argument('--repeats', type=int, default=3)
+
+    def handle(self, *args, **options):
+        from api.rvc_integration import RVC_AVAILABLE
+
+        if options['input'] and RVC_AVAILABLE:
+            report = self.benchmark_rvc(options)
+        else:
+            if options['input']:
+                self.stderr.write("RVC not available; benchmarking the stand-in encoder instead")
+            report = self.benchmark_stand_in(options)
+        self.stdout.write(json.dumps(report, indent=2))
+
+    def benchmark_rvc(self, options):
+        """Content features and full conversion of ``--input``, FP32 then INT8"""
+        import torch
+        from rvc.lib.audio import load_audio
+
+        from api.quantization import quantize_loaded_models
+        from api.rvc_integration import RVCVoiceCloner, default_model_path
+        from api.voice_profile import load_hubert_model
+
+        model_path = options['model'] or default_model_path()
+        cloner = RVCVoiceCloner()
+        # Load the float models without the automatic swap
+        cloner.vc.get_vc(model_path)
+        load_hubert_model(cloner.vc)
+
+        audio = torch.from_numpy(load_audio(options['input'], 16000)).float().view(1, -1)
+        padding_mask = torch.zeros_like(audio, dtype=torch.bool)
+
+        def features():
+            with torch.no_grad():
+                return cloner.vc.hubert_model.extract_features(
+                    source=audio, padding_mask=padding_mask, output_layer=12)[0].numpy()
+
+        def convert():
+            _, audio_opt, _, error = cloner.vc.vc_inference(sid=0, input_audio_path=options['input'],
+                                                            f0_method='rmvpe')
+            if error:
+                raise CommandError(f"Conversion failed: {error}")
+            return audio_opt
+
+        fp32 = {'features': timed(features, options['repeats']), 'conversion': timed(convert, options['repeats'])}
+        if not quantize_loaded_models(cloner.vc, model_path):
+            raise CommandError("Quantization failed")
+        int8 = {'features': timed(features, options['repeats']), 'conversion': timed(convert, options['repeats'])}
+
+        return {
+            'model': model_path,
+            'input': options['input'],
+            'stages': {stage: self.compare(fp32[stage], int8[stage]) for stage in fp32},
+        }
+
+    def benchmark_stand_in(self, options):
+        """Twelve transformer layers the size of HuBERT base over 10 s of 50 Hz frames"""
+        import torch
+
+        from api.quantization import quantize_module
+
+        torch.manual_seed(0)
+        encoder = torch.nn.Sequential(*[stand_in_layer() for _ in range(12)]).eval()
+        frames = torch.randn(1, 500, 768)
+
+        def run(module):
+            with torch.no_grad():
+                return module(frames).numpy()
+
+        fp32 = timed(lambda: run(encoder), options['repeats'])
+        quantized = quantize_module(encoder)
+        int8 = timed(lambda: run(quantized), options['repeats'])
+        return {'model': 'stand-in HuBERT-base encoder', 'stages': {'features': self.compare(fp32, int8)}}
+
+    @staticmethod
+    def compare(fp32, int8) -> dict:
+        return {
+            'fp32_seconds': round(fp32[0], 4),
+            'int8_seconds': round(int8[0], 4),
+            'speedup': round(fp32[0] / int8[0], 2),
+            'snr_db': round(snr_db(fp32[1], int8[1]), 2),
+        }
@@ -0,0 +1,91 @@
+import asyncio
+import json
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = ("Stream audio through the WebSocket conversion endpoint in-process and report "
+            "per-chunk latency and the real-time factor.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--input', help="Audio to stream (default: 10 s of a synthetic vowel)")
+        parser.add_argument('--sample-rate', type=int, default=16000)
+        parser.add_argument('--frame-ms', type=int, default=20, help="Audio per WebSocket message")
+        parser.add_argument('--realtime', action='store_true',
+                            help="Send frames at the pace they would be recorded")
+        parser.add_argument('--output', help="Write the converted stream to this WAV file")
+
+    def handle(self, *args, **options):
+        import numpy as np
+
+        sample_rate = options['sample_rate']
+        if options['input']:
+            import librosa
+            audio, _ = librosa.load(options['input'], sr=sample_rate, mono=True)
+        else:
+            t = np.arange(10 * sample_rate) / sample_rate
+            pitch = 180 + 40 * np.sin(2 * np.pi * 0.5 * t)
+            audio = 0.2 * np.sin(2 * np.pi * np.cumsum(pitch) / sample_rate) * (1 + 0.3 * np.sin(2 * np.pi * 3 * t))
+        audio = audio.astype(np.float32)
+
+        output, summary = asyncio.run(self.stream(audio, options))
+        if summary is None:
+            raise CommandError("The endpoint refused the connection")
+
+        from api.streaming import get_engine
+        if get_engine().name == 'stand_in':
+            # The stand-in passes audio through, delayed by one crossfade
+            delay = len(output) - len(audio)
+            summary['passthrough_max_error'] = float(np.abs(output[delay:] - audio).max())
+        if options['output']:
+            import soundfile as sf
+            sf.write(options['output'], output, sample_rate)
+        self.stdout.write(json.dumps(summary, indent=2))
+
+    async def stream(self, audio, options):
+        import numpy as np
+
+        from api.streaming import STREAM_PATH, websocket_application
+
+        inbox = asyncio.Queue()
+        received = []
+        done = asyncio.Event()
+        result = {'summary': None}
+
+        async def receive():
+            return await inbox.get()
+
+        async def send(event):
+            if event['type'] == 'websocket.send':
+                if event.get('bytes') is not None:
+                    received.append(np.frombuffer(event['bytes'], dtype='<f4'))
+                else:
+                    message = json.loads(event['text'])
+                    if message['type'] == 'summary':
+                        result['summary'] = message
+                        done.set()
+            elif event['type'] == 'websocket.close':
+                done.set()
+
+        scope = {'type': 'websocket', 'path': STREAM_PATH,
+                 'query_string': f"sample_rate={options['sample_rate']}".encode()}
+        app = asyncio.create_task(websocket_application(scope, receive, send))
+        await inbox.put({'type': 'websocket.connect'})
+
+        frame = int(options['sample_rate'] * options['frame_ms'] / 1000)
+        started = time.perf_counter()
+        for index, start in enumerate(range(0, len(audio), frame)):
+            if options['realtime']:
+                await asyncio.sleep(max(started + start / options['sample_rate'] - time.perf_counter(), 0))
+            await inbox.put({'type': 'websocket.receive', 'bytes': audio[start:start + frame].astype('<f4').tobytes()})
+            # Let the endpoint take each frame as it arrives
+            await asyncio.sleep(0)
+        await inbox.put({'type': 'websocket.receive', 'text': json.dumps({'type': 'flush'})})
+        await done.wait()
+        await inbox.put({'type': 'websocket.disconnect', 'code': 1000})
+        await app
+
+        output = np.concatenate(received) if received else np.zeros(0, dtype=np.float32)
+        return output, result['summary']
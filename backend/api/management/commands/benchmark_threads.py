@@ -0,0 +1,142 @@
+import json
+import multiprocessing
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api.worker_resources import available_cores, configure_process
+
+STAGES = ('separation', 'content_encoder')
+SEGMENT_SECONDS = 10
+
+
+def build_workload(stage: str, model_name: str):
+    """
+    Return a callable running one unit of ``stage``, or None if it cannot run here
+
+    ``separation`` runs the MDX-Net ONNX model over a 10 s stereo segment.
+    ``content_encoder`` runs four transformer layers the size of HuBERT
+    base over 10 s of 50 Hz frames, standing in for content feature
+    extraction when the RVC weights are not at hand.
+    """
+    import numpy as np
+    import torch
+
+    if stage == 'separation':
+        from api.chunked_separation import MDXSeparator, SAMPLE_RATE, supports_model
+        if not supports_model(model_name):
+            return None
+        separator = MDXSeparator(model_name)
+        mix = np.random.default_rng(0).standard_normal((2, SEGMENT_SECONDS * SAMPLE_RATE)).astype(np.float32) * 0.1
+        return lambda: separator.demix(mix)
+
+    if stage == 'content_encoder':
+        layer = torch.nn.TransformerEncoderLayer(768, 12, 3072, batch_first=True)
+        encoder = torch.nn.TransformerEncoder(layer, 4, enable_nested_tensor=False).eval()
+        frames = torch.randn(1, SEGMENT_SECONDS * 50, 768)
+
+        def run():
+            with torch.no_grad():
+                encoder(frames)
+        return run
+
+    return None
+
+
+def bench_process(stage, model_name, index, threads, pin, seconds, ready, start_event, results):
+    """Pool process stand-in: apply the thread budget, warm up, then run for ``seconds``"""
+    if pin:
+        from django.conf import settings
+        settings.WORKER_RESOURCES = dict(getattr(settings, 'WORKER_RESOURCES', {}), pin_cores=True)
+    configure_process(index, {'processes': None, 'intra_op': threads, 'inter_op': 1})
+
+    try:
+        workload = build_workload(stage, model_name)
+        if workload is not None:
+            workload()
+    except Exception as e:
+        print(f"{stage} failed: {e}", file=sys.stderr)
+        workload = None
+    ready.put(workload is not None)
+    if workload is None:
+        return
+    start_event.wait()
+
+    count = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        workload()
+        count += 1
+    results.put(count)
+
+
+class Command(BaseCommand):
+    help = ("Measure per-stage throughput for different process x thread splits of the cores, "
+            "as the prefork pool would run them.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--stages', default=','.join(STAGES),
+                            help=f"Comma separated stages to run ({', '.join(STAGES)})")
+        parser.add_argument('--splits', default=None,
+                            help="Comma separated PROCESSESxTHREADS splits (default: every power-of-two split of the cores)")
+        parser.add_argument('--seconds', type=float, default=20, help="Measurement time per split")
+        parser.add_argument('--model', default='UVR-MDX-NET-Voc_FT', help="MDX-Net model for the separation stage")
+        parser.add_argument('--pin', action='store_true', help="Pin each process to its own cores")
+
+    def handle(self, *args, **options):
+        cores = len(available_cores())
+        if options['splits']:
+            try:
+                splits = [tuple(int(v) for v in split.split('x')) for split in options['splits'].split(',')]
+            except ValueError:
+                raise CommandError("Splits look like 2x4,4x2")
+        else:
+            splits = []
+            processes = 1
+            while processes <= cores:
+                splits.append((processes, cores // processes))
+                processes *= 2
+        # Oversubscribed for comparison: every process using every core
+        if cores > 1 and not options['splits']:
+            splits.append((cores, cores))
+
+        # Fork so the children inherit Django's settings; the parent never
+        # touches torch, so no thread pool state is copied
+        context = multiprocessing.get_context('fork')
+        report = {'cores': cores, 'segment_seconds': SEGMENT_SECONDS, 'results': []}
+
+        for stage in options['stages'].split(','):
+            for processes, threads in splits:
+                ready = context.Queue()
+                start_event = context.Event()
+                results = context.Queue()
+                children = [context.Process(target=bench_process,
+                                            args=(stage, options['model'], index, threads, options['pin'],
+                                                  options['seconds'], ready, start_event, results))
+                            for index in range(processes)]
+                for child in children:
+                    child.start()
+                # All children finish warming up before the clock starts
+                available = all([ready.get() for _ in children])
+                start_event.set()
+                counts = [results.get() for _ in children] if available else []
+                for child in children:
+                    child.join()
+
+                if not available:
+                    self.stderr.write(f"Skipping {stage}: not available on this host")
+                    break
+
+                segments_per_second = sum(counts) / options['seconds']
+                entry = {
+                    'stage': stage,
+                    'processes': processes,
+                    'threads_per_process': threads,
+                    'segments_per_second': round(segments_per_second, 3),
+                    'audio_seconds_per_second': round(segments_per_second * SEGMENT_SECONDS, 2),
+                }
+                report['results'].append(entry)
+                self.stderr.write(json.dumps(entry))
+
+        self.stdout.write(json.dumps(report, indent=2))
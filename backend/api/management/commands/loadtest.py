@@ -0,0 +1,439 @@
+import io
+import json
+import math
+import random
+import threading
+import time
+from collections import defaultdict
+from urllib.parse import urlparse
+
+from django.core.management.base import BaseCommand, CommandError
+
+PROFILES = ('uploader', 'poller', 'downloader')
+PERCENTILES = (50, 90, 95, 99)
+
+
+def synthetic_wav(seconds: float, seed: int, sample_rate: int = 44100) -> bytes:
+    """A seeded stereo WAV of a few detuned tones and noise"""
+    import numpy as np
+    import soundfile as sf
+
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds * sample_rate)) / sample_rate
+    audio = sum(0.1 * np.sin(2 * np.pi * f * t) for f in rng.uniform(110, 880, size=4))
+    audio = audio + 0.01 * rng.standard_normal(len(t))
+    buffer = io.BytesIO()
+    sf.write(buffer, np.stack([audio, audio]).T.astype(np.float32), sample_rate, format='WAV', subtype='PCM_16')
+    return buffer.getvalue()
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    rank = max(math.ceil(pct / 100 * len(sorted_values)) - 1, 0)
+    return sorted_values[rank]
+
+
+def parse_profiles(value: str) -> dict:
+    """'uploader=2,poller=8' -> {'uploader': 2, 'poller': 8, 'downloader': 0}"""
+    profiles = dict.fromkeys(PROFILES, 0)
+    for part in value.split(','):
+        name, _, count = part.partition('=')
+        if name not in profiles or not count.isdigit():
+            raise CommandError(f"Profiles look like uploader=2,poller=8,downloader=2 (got {part!r})")
+        profiles[name] = int(count)
+    return profiles
+
+
+class InProcessTransport:
+    """
+    Requests through Django's test client, in this process
+
+    Each thread gets its own client. Result downloads are served by the
+    media route, which only exists with DEBUG on.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def _client(self):
+        from django.test import Client
+
+        if not hasattr(self._local, 'client'):
+            self._local.client = Client()
+        return self._local.client
+
+    def upload(self, song: bytes, voice: bytes):
+        from django.core.files.uploadedfile import SimpleUploadedFile
+
+        response = self._client().post('/api/upload/', {
+            'song_file': SimpleUploadedFile('song.wav', song, content_type='audio/wav'),
+            'voice_file': SimpleUploadedFile('voice.wav', voice, content_type='audio/wav'),
+            'consent_accepted': 'true',
+        })
+        return response.status_code, response.json() if response.status_code == 201 else None
+
+    def status(self, job_id):
+        response = self._client().get(f'/api/job/{job_id}/')
+        return response.status_code, response.json() if response.status_code == 200 else None
+
+    def download(self, url):
+        response = self._client().get(urlparse(url).path)
+        if response.status_code == 200 and response.streaming:
+            b''.join(response.streaming_content)
+        return response.status_code, None
+
+
+class HTTPTransport:
+    """Requests to a running server at ``base_url``"""
+
+    def __init__(self, base_url: str, timeout: float):
+        import requests
+
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self._local = threading.local()
+        self._requests = requests
+
+    def _session(self):
+        if not hasattr(self._local, 'session'):
+            self._local.session = self._requests.Session()
+        return self._local.session
+
+    def upload(self, song: bytes, voice: bytes):
+        response = self._session().post(f'{self.base_url}/api/upload/', timeout=self.timeout,
+                                        data={'consent_accepted': 'true'},
+                                        files={'song_file': ('song.wav', song, 'audio/wav'),
+                                               'voice_file': ('voice.wav', voice, 'audio/wav')})
+        return response.status_code, response.json() if response.status_code == 201 else None
+
+    def status(self, job_id):
+        response = self._session().get(f'{self.base_url}/api/job/{job_id}/', timeout=self.timeout)
+        return response.status_code, response.json() if response.status_code == 200 else None
+
+    def download(self, url):
+        response = self._session().get(url, timeout=self.timeout)
+        return response.status_code, None
+
+
+class StandInWorker:
+    """
+    Completes queued jobs in place of Celery and the RVC pipeline
+
+    Each job takes ``work_seconds``, then gets a copy of its own song as
+    the result, so the status and download paths see realistic traffic.
+    """
+
+    def __init__(self, work_seconds: float, threads: int):
+        import queue
+
+        self.work_seconds = work_seconds
+        self.queue = queue.Queue()
+        self._stop = threading.Event()
+        self.threads = [threading.Thread(target=self._run, daemon=True) for _ in range(threads)]
+        for thread in self.threads:
+            thread.start()
+
+    def apply_async(self, args=None, **options):
+        import uuid
+        from types import SimpleNamespace
+
+        self.queue.put(args[0])
+        return SimpleNamespace(id=str(uuid.uuid4()))
+
+    def _run(self):
+        from django.core.files.base import ContentFile
+        from django.db import connection
+        from django.utils import timezone
+
+        from api.models import Job
+
+        while True:
+            job_id = self.queue.get()
+            if self._stop.is_set():
+                return
+            try:
+                Job.objects.filter(pk=job_id).update(status='processing', updated_at=timezone.now())
+                time.sleep(self.work_seconds)
+                job = Job.objects.get(pk=job_id)
+                with job.song_file.open('rb') as f:
+                    job.result_file.save('result.mp3', ContentFile(f.read()), save=False)
+                job.status = 'completed'
+                job.save(update_fields=['result_file', 'status', 'updated_at'])
+            except Exception:
+                Job.objects.filter(pk=job_id).update(status='failed', updated_at=timezone.now())
+            finally:
+                connection.close()
+
+    def stop(self):
+        """Finish the jobs in progress and drop the rest of the queue"""
+        self._stop.set()
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+
+class RSSSampler:
+    """
+    Samples the resident memory of the server processes every ``interval`` seconds
+
+    The first sample is the baseline, taken once the synthetic audio exists
+    and just before the clients start; ``growth_mb`` is the peak above it.
+    """
+
+    def __init__(self, pids, interval: float = 0.5):
+        import psutil
+
+        self.processes = [psutil.Process(pid) for pid in pids]
+        self.interval = interval
+        self.samples = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def rss(self) -> int:
+        total = 0
+        for process in self.processes:
+            try:
+                total += process.memory_info().rss
+                # Prefork workers and uvicorn/gunicorn children
+                total += sum(child.memory_info().rss for child in process.children(recursive=True))
+            except Exception:
+                pass
+        return total
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.samples.append(self.rss())
+
+    def __enter__(self):
+        self.samples.append(self.rss())
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.samples.append(self.rss())
+
+    def report(self) -> dict:
+        mb = 1024 * 1024
+        return {'start_mb': round(self.samples[0] / mb, 1), 'peak_mb': round(max(self.samples) / mb, 1),
+                'end_mb': round(self.samples[-1] / mb, 1),
+                'growth_mb': round((max(self.samples) - self.samples[0]) / mb, 1)}
+
+
+class Command(BaseCommand):
+    help = ("Load test the upload, status and download endpoints with concurrent client profiles. "
+            "Runs in-process against a stand-in worker (or the real task in Celery eager mode), "
+            "or against a running server with --base-url. Prints a JSON report of latency "
+            "percentiles, error rates and RSS growth.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--profiles', default='uploader=2,poller=8,downloader=2',
+                            help="Concurrent clients per profile (uploader, poller, downloader)")
+        parser.add_argument('--duration', type=float, default=30, help="Seconds to run the load for")
+        parser.add_argument('--song-seconds', type=float, default=30, help="Length of the synthetic songs")
+        parser.add_argument('--voice-seconds', type=float, default=10, help="Length of the synthetic voices")
+        parser.add_argument('--think-ms', type=float, default=0, help="Pause between a client's requests")
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--base-url', help="Target a running server instead of this process")
+        parser.add_argument('--server-pid', type=int, action='append', default=[],
+                            help="With --base-url: server process to sample RSS from (repeatable)")
+        parser.add_argument('--worker', choices=('stand-in', 'eager'), default='stand-in',
+                            help="In-process: complete jobs with a stand-in worker, or run the real "
+                                 "task inline in Celery eager mode")
+        parser.add_argument('--work-seconds', type=float, default=2, help="Stand-in worker time per job")
+        parser.add_argument('--keep', action='store_true', help="In-process: keep the created jobs and files")
+        parser.add_argument('--timeout', type=float, default=30, help="HTTP request timeout")
+        parser.add_argument('--output', help="Also write the report to this file")
+        parser.add_argument('--compare', help="Earlier report to show p95 latency and throughput changes against")
+
+    def handle(self, *args, **options):
+        profiles = parse_profiles(options['profiles'])
+        if not any(profiles.values()):
+            raise CommandError("No clients to run")
+
+        rng = random.Random(options['seed'])
+        songs = [synthetic_wav(options['song_seconds'], options['seed'] * 100 + i) for i in range(4)]
+        voices = [synthetic_wav(options['voice_seconds'], options['seed'] * 100 + 50 + i) for i in range(2)]
+
+        restore = []
+        if options['base_url']:
+            transport = HTTPTransport(options['base_url'], options['timeout'])
+            pids = options['server_pid']
+        else:
+            transport = InProcessTransport()
+            restore = self.setup_in_process(options)
+            import os
+            pids = [os.getpid()]
+
+        jobs, completed = [], []
+        lock = threading.Lock()
+        stats = defaultdict(lambda: {'latencies': [], 'statuses': defaultdict(int), 'errors': 0})
+        deadline = time.monotonic() + options['duration']
+
+        def record(endpoint, started, status_code):
+            elapsed = time.perf_counter() - started
+            with lock:
+                entry = stats[endpoint]
+                entry['latencies'].append(elapsed)
+                entry['statuses'][str(status_code)] += 1
+                if not 200 <= status_code < 400:
+                    entry['errors'] += 1
+
+        def call(endpoint, fn, *fn_args):
+            started = time.perf_counter()
+            try:
+                status_code, body = fn(*fn_args)
+            except Exception:
+                status_code, body = 0, None  # connection error or timeout
+            record(endpoint, started, status_code)
+            return body
+
+        def client(profile, client_rng):
+            while time.monotonic() < deadline:
+                idle = False
+                if profile == 'uploader':
+                    body = call('upload', transport.upload, client_rng.choice(songs), client_rng.choice(voices))
+                    if body:
+                        with lock:
+                            jobs.append(body['id'])
+                elif profile == 'poller':
+                    with lock:
+                        job_id = client_rng.choice(jobs) if jobs else None
+                    idle = job_id is None
+                    if job_id:
+                        body = call('status', transport.status, job_id)
+                        if body and body.get('result_url'):
+                            with lock:
+                                if body['result_url'] not in completed:
+                                    completed.append(body['result_url'])
+                else:
+                    with lock:
+                        url = client_rng.choice(completed) if completed else None
+                    idle = url is None
+                    if url:
+                        call('download', transport.download, url)
+                if options['think_ms'] or idle:
+                    # Nothing to poll or download yet: wait rather than spin
+                    time.sleep(max(options['think_ms'] / 1000, 0.01))
+
+        threads = [threading.Thread(target=client, args=(profile, random.Random(rng.random())), daemon=True)
+                   for profile, count in profiles.items() for _ in range(count)]
+        try:
+            with RSSSampler(pids) as sampler:
+                started = time.monotonic()
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                elapsed = time.monotonic() - started
+        finally:
+            for undo in restore:
+                undo()
+            if not options['base_url'] and not options['keep']:
+                self.cleanup(jobs)
+
+        report = self.build_report(options, profiles, stats, elapsed, sampler if pids else None,
+                                   len(jobs), len(completed))
+        if options['compare']:
+            report['comparison'] = self.compare(report, options['compare'])
+        output = json.dumps(report, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output)
+        self.stdout.write(output)
+
+    def setup_in_process(self, options):
+        """Let the test client in and route new jobs to the chosen worker; returns undo callables"""
+        from django.conf import settings
+
+        from api import views
+        from music_voice_clone.celery import app
+
+        restore = []
+        if 'testserver' not in settings.ALLOWED_HOSTS and '*' not in settings.ALLOWED_HOSTS:
+            settings.ALLOWED_HOSTS = list(settings.ALLOWED_HOSTS) + ['testserver']
+            restore.append(lambda: settings.ALLOWED_HOSTS.remove('testserver'))
+        if options['worker'] == 'stand-in':
+            task = views.process_voice_clone
+            worker = StandInWorker(options['work_seconds'], threads=4)
+            views.process_voice_clone = worker
+            restore.append(lambda: setattr(views, 'process_voice_clone', task))
+            restore.append(worker.stop)
+        else:
+            eager = app.conf.task_always_eager
+            app.conf.task_always_eager = True
+            restore.append(lambda: setattr(app.conf, 'task_always_eager', eager))
+        if not settings.DEBUG:
+            self.stderr.write("DEBUG is off, so media is not served in-process; downloads will 404")
+        return restore
+
+    @staticmethod
+    def cleanup(job_ids):
+        from api.models import Job
+
+        for job in Job.objects.filter(pk__in=job_ids):
+            for field in (job.song_file, job.voice_file, job.result_file):
+                if field:
+                    field.delete(save=False)
+            job.delete()
+
+    @staticmethod
+    def build_report(options, profiles, stats, elapsed, sampler, jobs_created, jobs_completed) -> dict:
+        endpoints = {}
+        for endpoint, entry in sorted(stats.items()):
+            latencies = sorted(entry['latencies'])
+            count = len(latencies)
+            endpoints[endpoint] = {
+                'requests': count,
+                'requests_per_second': round(count / elapsed, 2),
+                'error_rate': round(entry['errors'] / count, 4) if count else 0,
+                'status_codes': dict(entry['statuses']),
+                'latency_ms': {f"p{pct}": round(percentile(latencies, pct) * 1000, 1) for pct in PERCENTILES},
+                'max_latency_ms': round(latencies[-1] * 1000, 1),
+            }
+        report = {
+            # Everything that shapes the load, so reports are only compared like for like
+            'config': {
+                'target': options['base_url'] or f"in-process ({options['worker']} worker)",
+                'profiles': profiles,
+                'duration_seconds': options['duration'],
+                'song_seconds': options['song_seconds'],
+                'voice_seconds': options['voice_seconds'],
+                'think_ms': options['think_ms'],
+                'seed': options['seed'],
+            },
+            'elapsed_seconds': round(elapsed, 2),
+            'jobs_created': jobs_created,
+            'jobs_completed': jobs_completed,
+            'endpoints': endpoints,
+        }
+        # In-process the sampled process also runs the clients, so it is not
+        # reported as the server's memory
+        report['server_rss' if options['base_url'] else 'process_rss'] = sampler.report() if sampler else None
+        return report
+
+    @staticmethod
+    def compare(report: dict, baseline_path: str) -> dict:
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+        if baseline.get('config') != report['config']:
+            return {'warning': 'baseline was run with a different configuration', 'baseline': baseline_path}
+        changes = {}
+        for endpoint, current in report['endpoints'].items():
+            before = baseline['endpoints'].get(endpoint)
+            if not before:
+                continue
+            changes[endpoint] = {
+                'p95_ms_change': round(current['latency_ms']['p95'] - before['latency_ms']['p95'], 1),
+                'requests_per_second_change': round(current['requests_per_second'] - before['requests_per_second'], 2),
+                'error_rate_change': round(current['error_rate'] - before['error_rate'], 4),
+            }
+        comparison = {'baseline': baseline_path, 'endpoints': changes}
+        for key in ('server_rss', 'process_rss'):
+            if report.get(key) and baseline.get(key):
+                comparison['rss_growth_mb_change'] = round(report[key]['growth_mb'] - baseline[key]['growth_mb'], 1)
+        return comparison
@@ -0,0 +1,50 @@
+import os
+
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand, CommandError
+
+from api.inference_server import InferenceServer, get_config, rvc_copies
+from api.worker_resources import available_cores, configure_process
+
+
+class Command(BaseCommand):
+    help = ("Run the host's inference server: loads the separation and RVC models once and "
+            "serves every worker process on this host over a Unix socket, batching "
+            "separation windows across jobs.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--socket', help="Unix socket to listen on (default: INFERENCE_SERVER['socket'])")
+        parser.add_argument('--threads', type=int, help="Inference threads (default: every core)")
+        parser.add_argument('--model', help="RVC model to load at startup (default: RVC_MODEL_PATH)")
+        parser.add_argument('--no-preload', action='store_true', help="Load models on first use instead")
+
+    def handle(self, *args, **options):
+        from api.chunked_separation import supports_model
+        from api.quality import TIER_ORDER, get_tier
+        from api.rvc_integration import default_model_path
+
+        config = get_config()
+        config['socket'] = options['socket'] or config['socket']
+        if not config['socket']:
+            raise CommandError("Set INFERENCE_SERVER['socket'] or pass --socket")
+        config['threads'] = options['threads'] or config['threads'] or len(available_cores())
+        # The server is the only process doing inference, so it gets every
+        # core, split between the RVC copies converting concurrently
+        copies = rvc_copies(config, config['threads'])
+        configure_process(None, {'processes': 1, 'intra_op': max(config['threads'] // copies, 1),
+                                 'inter_op': 1})
+
+        try:
+            server = InferenceServer(config=config)
+        except ImproperlyConfigured as e:
+            raise CommandError(str(e))
+        if not options['no_preload']:
+            separation_models = sorted({get_tier(name)['separation_model'] for name in TIER_ORDER
+                                        if supports_model(get_tier(name)['separation_model'])})
+            model_path = options['model'] or default_model_path()
+            server.preload(model_path if os.path.exists(model_path) else None, tuple(separation_models))
+            self.stdout.write(f"Loaded separation models: {', '.join(separation_models) or 'none'}")
+
+        self.stdout.write(f"Serving inference with {config['threads']} thread(s) and up to {copies} "
+                          f"RVC model copies on {config['socket']}")
+        server.serve_forever()
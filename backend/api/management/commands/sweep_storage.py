@@ -0,0 +1,16 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from api.storage_lifecycle import sweep
+
+
+class Command(BaseCommand):
+    help = ("Apply the storage retention periods and disk budget now and report the bytes "
+            "reclaimed (the Celery beat task sweep_storage does the same hourly).")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help="Report what would be removed")
+
+    def handle(self, *args, **options):
+        self.stdout.write(json.dumps(sweep(dry_run=options['dry_run']), indent=2))
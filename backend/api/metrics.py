@@ -0,0 +1,116 @@
+"""
+Lightweight Redis-backed metrics shared by the web and worker processes
+"""
+import logging
+import statistics
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+from django.conf import settings
+
+try:
+    import redis
+    REDIS_AVAILABLE = True
+except ImportError as e:
+    logging.warning(f"Redis client not available, metrics disabled: {e}")
+    REDIS_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = 'metrics:'
+COUNTERS_KEY = KEY_PREFIX + 'counters'
+LATENCY_SAMPLES = 50
+
+_client = None
+
+
+def get_redis():
+    """Return a shared Redis client, or None if Redis is unavailable"""
+    global _client
+    if not REDIS_AVAILABLE:
+        return None
+    if _client is None:
+        url = getattr(settings, 'METRICS_REDIS_URL', settings.CELERY_BROKER_URL)
+        _client = redis.Redis.from_url(url, socket_timeout=2, socket_connect_timeout=2)
+    return _client
+
+
+def incr(name: str, amount: int = 1) -> None:
+    """Increment a named counter"""
+    client = get_redis()
+    if client is None:
+        return
+    try:
+        client.hincrby(COUNTERS_KEY, name, amount)
+    except Exception as e:
+        logger.warning(f"Failed to increment metric {name}: {e}")
+
+
+def record_latency(stage: str, seconds: float) -> None:
+    """Record a stage duration, keeping the most recent samples"""
+    client = get_redis()
+    if client is None:
+        return
+    key = f"{KEY_PREFIX}latency:{stage}"
+    try:
+        pipe = client.pipeline()
+        pipe.lpush(key, f"{seconds:.3f}")
+        pipe.ltrim(key, 0, LATENCY_SAMPLES - 1)
+        pipe.execute()
+    except Exception as e:
+        logger.warning(f"Failed to record latency for {stage}: {e}")
+
+
+def recent_latency(stage: str) -> Optional[float]:
+    """Return the median of the recent durations of a stage, if any"""
+    client = get_redis()
+    if client is None:
+        return None
+    try:
+        samples = [float(v) for v in client.lrange(f"{KEY_PREFIX}latency:{stage}", 0, -1)]
+    except Exception as e:
+        logger.warning(f"Failed to read latency for {stage}: {e}")
+        return None
+    return statistics.median(samples) if samples else None
+
+
+@contextmanager
+def stage_timer(stage: str):
+    """Context manager recording how long a pipeline stage took"""
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        record_latency(stage, time.monotonic() - start)
+
+
+def queue_depth(queue: str) -> int:
+    """Return the number of messages waiting in a Celery queue on the Redis broker"""
+    client = get_redis()
+    if client is None:
+        return 0
+    try:
+        return client.llen(queue)
+    except Exception as e:
+        logger.warning(f"Failed to read depth of queue {queue}: {e}")
+        return 0
+
+
+def snapshot() -> dict:
+    """Return all counters and recent stage latencies"""
+    client = get_redis()
+    if client is None:
+        return {'counters': {}, 'latency': {}}
+    try:
+        counters = {k.decode(): int(v) for k, v in client.hgetall(COUNTERS_KEY).items()}
+        latency_keys = client.keys(f"{KEY_PREFIX}latency:*")
+    except Exception as e:
+        logger.warning(f"Failed to read metrics: {e}")
+        return {'counters': {}, 'latency': {}}
+
+    latency = {}
+    for key in latency_keys:
+        stage = key.decode()[len(KEY_PREFIX + 'latency:'):]
+        latency[stage] = recent_latency(stage)
+    return {'counters': counters, 'latency': latency}
@@ -0,0 +1,56 @@
+# Generated by Django 5.2.6 on 2026-10-19 09:15
+
+import api.models
+import django.db.models.deletion
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SongUpload',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('song_file', models.FileField(upload_to=api.models.song_upload_path)),
+                ('sha256', models.CharField(blank=True, max_length=64)),
+                ('quality_tier', models.CharField(choices=[('draft', 'Draft'), ('standard', 'Standard'), ('studio', 'Studio')], default='standard', max_length=20)),
+                ('separation_status', models.CharField(choices=[('pending', 'Pending'), ('processing', 'Processing'), ('ready', 'Ready'), ('failed', 'Failed')], default='pending', max_length=20)),
+                ('duration_seconds', models.FloatField(blank=True, null=True)),
+                ('task_id', models.CharField(blank=True, max_length=255)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Job',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('song_file', models.FileField(upload_to=api.models.song_upload_path)),
+                ('voice_file', models.FileField(upload_to=api.models.voice_upload_path)),
+                ('consent_accepted', models.BooleanField(default=False)),
+                ('quality_tier', models.CharField(choices=[('draft', 'Draft'), ('standard', 'Standard'), ('studio', 'Studio')], default='standard', max_length=20)),
+                ('effective_tier', models.CharField(blank=True, choices=[('draft', 'Draft'), ('standard', 'Standard'), ('studio', 'Studio')], max_length=20)),
+                ('downgrade_reason', models.CharField(blank=True, max_length=255)),
+                ('result_file', models.FileField(blank=True, null=True, upload_to=api.models.output_path)),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('processing', 'Processing'), ('completed', 'Completed'), ('failed', 'Failed'), ('cancelled', 'Cancelled')], default='queued', max_length=20)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('error_message', models.TextField(blank=True, null=True)),
+                ('client_id', models.CharField(blank=True, max_length=64)),
+                ('batch_id', models.CharField(blank=True, max_length=64)),
+                ('task_id', models.CharField(blank=True, max_length=255)),
+                ('duration_seconds', models.FloatField(blank=True, null=True)),
+                ('song_upload', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='jobs', to='api.songupload')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['-created_at', '-id'], name='job_created_idx'), models.Index(fields=['status', '-created_at'], name='job_status_created_idx'), models.Index(fields=['updated_at'], name='job_updated_idx'), models.Index(fields=['client_id', 'updated_at'], name='job_client_updated_idx'), models.Index(fields=['batch_id', 'updated_at'], name='job_batch_updated_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.6 on 2026-10-19 09:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0002_job_attempts'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='songupload',
+            name='prepaid_job',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.6 on 2026-10-19 09:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0003_songupload_prepaid_job'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='song_sha256',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+    ]
@@ -1,24 +1,58 @@
 from django.db import models
 import uuid
 import os
+from .quality import QUALITY_TIER_CHOICES, DEFAULT_QUALITY_TIER
+
+def sharded_path(category, filename):
+    """Place a file two directory levels deep by its name, e.g. songs/3f/a2/3fa2....mp3"""
+    return os.path.join(category, filename[:2], filename[2:4], filename)
 
 def song_upload_path(instance, filename):
     """Generate file path for uploaded song files"""
     ext = filename.split('.')[-1]
     filename = f"{uuid.uuid4()}.{ext}"
-    return os.path.join('songs', filename)
+    return sharded_path('songs', filename)
 
 def voice_upload_path(instance, filename):
     """Generate file path for uploaded voice files"""
     ext = filename.split('.')[-1]
     filename = f"{uuid.uuid4()}.{ext}"
-    return os.path.join('voices', filename)
+    return sharded_path('voices', filename)
 
 def output_path(instance, filename):
     """Generate file path for result files"""
     ext = 'mp3'  # Always save as mp3
     filename = f"{uuid.uuid4()}.{ext}"
-    return os.path.join('outputs', filename)
+    return sharded_path('outputs', filename)
+
+class SongUpload(models.Model):
+    """A song uploaded ahead of its job, separated speculatively into the stem cache"""
+    
+    SEPARATION_STATUS_CHOICES = (
+        ('pending', 'Pending'),
+        ('processing', 'Processing'),
+        ('ready', 'Ready'),
+        ('failed', 'Failed'),
+    )
+    
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    song_file = models.FileField(upload_to=song_upload_path)
+    sha256 = models.CharField(max_length=64, blank=True)
+    # Tier whose separation settings are used for the speculative run
+    quality_tier = models.CharField(max_length=20, choices=QUALITY_TIER_CHOICES,
+                                    default=DEFAULT_QUALITY_TIER)
+    separation_status = models.CharField(max_length=20, choices=SEPARATION_STATUS_CHOICES,
+                                         default='pending')
+    duration_seconds = models.FloatField(null=True, blank=True)
+    task_id = models.CharField(max_length=255, blank=True)
+    # A rate limit token was taken at upload for the job this song is for;
+    # the first job created from it is not charged again
+    prepaid_job = models.BooleanField(default=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    def __str__(self):
+        return f"SongUpload {self.id} - {self.separation_status}"
 
 class Job(models.Model):
     """Job model to track voice cloning processes"""
@@ -28,17 +62,49 @@ class Job(models.Model):
         ('processing', 'Processing'),
         ('completed', 'Completed'),
         ('failed', 'Failed'),
+        ('cancelled', 'Cancelled'),
     )
     
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     song_file = models.FileField(upload_to=song_upload_path)
     voice_file = models.FileField(upload_to=voice_upload_path)
     consent_accepted = models.BooleanField(default=False)
+    quality_tier = models.CharField(max_length=20, choices=QUALITY_TIER_CHOICES,
+                                    default=DEFAULT_QUALITY_TIER)
+    # Tier the job actually ran at; lower than quality_tier when load shedding kicked in
+    effective_tier = models.CharField(max_length=20, choices=QUALITY_TIER_CHOICES, blank=True)
+    downgrade_reason = models.CharField(max_length=255, blank=True)
     result_file = models.FileField(upload_to=output_path, null=True, blank=True)
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='queued')
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     error_message = models.TextField(blank=True, null=True)
+    # Optional caller-supplied tags so batch users can track their jobs in bulk
+    client_id = models.CharField(max_length=64, blank=True)
+    batch_id = models.CharField(max_length=64, blank=True)
+    # Celery task id, used to revoke the task when the job is cancelled
+    task_id = models.CharField(max_length=255, blank=True)
+    # Task attempts that have started the job; a redelivered message whose
+    # attempt already started does not run the pipeline again
+    attempts = models.PositiveIntegerField(default=0)
+    # Hash of the song, which keys its cached stems; set when the task starts
+    song_sha256 = models.CharField(max_length=64, blank=True)
+    # Probed song duration, used to derive the task time limits
+    duration_seconds = models.FloatField(null=True, blank=True)
+    # Set when the song was uploaded ahead of the job; its stems may be cached already
+    song_upload = models.ForeignKey(SongUpload, null=True, blank=True, on_delete=models.SET_NULL,
+                                    related_name='jobs')
+    
+    class Meta:
+        # Cover the listing sort and filters and the incremental status sync,
+        # so they stay range scans as the table grows
+        indexes = [
+            models.Index(fields=['-created_at', '-id'], name='job_created_idx'),
+            models.Index(fields=['status', '-created_at'], name='job_status_created_idx'),
+            models.Index(fields=['updated_at'], name='job_updated_idx'),
+            models.Index(fields=['client_id', 'updated_at'], name='job_client_updated_idx'),
+            models.Index(fields=['batch_id', 'updated_at'], name='job_batch_updated_idx'),
+        ]
     
     def __str__(self):
         return f"Job {self.id} - {self.status}"
@@ -0,0 +1,14 @@
+from rest_framework.pagination import CursorPagination
+
+
+class JobCursorPagination(CursorPagination):
+    """
+    Keyset pagination over jobs, newest first
+
+    Each page is a range scan on the created_at index starting from the
+    cursor, so page latency does not depend on table size or page depth.
+    """
+    ordering = '-created_at'
+    page_size = 50
+    page_size_query_param = 'page_size'
+    max_page_size = 200
@@ -0,0 +1,90 @@
+"""
+Quality tiers trading separation and pitch accuracy for throughput
+"""
+from django.conf import settings
+
+DEFAULT_QUALITY_TIER = 'standard'
+
+# Each tier picks the separation model and window overlap, pitch extraction
+# method, output bitrate and the Celery queue its jobs are routed to. Draft
+# uses the lighter MDX-Net model and the parselmouth ('pm') pitch tracker,
+# which together run several times faster than the standard settings on CPU.
+# compute_per_audio_second is the rough worker time per second of audio,
+# used to estimate the queued backlog for admission control.
+QUALITY_TIERS = {
+    'draft': {
+        'separation_model': 'UVR_MDXNET_9482',
+        'separation_overlap': 0.05,
+        'f0_method': 'pm',
+        'bitrate': '128k',
+        'queue': 'voice_clone_draft',
+        'compute_per_audio_second': 0.5,
+    },
+    'standard': {
+        'separation_model': 'UVR-MDX-NET-Voc_FT',
+        'separation_overlap': 0.1,
+        'f0_method': 'rmvpe',
+        'bitrate': '192k',
+        'queue': 'voice_clone',
+        'compute_per_audio_second': 2.0,
+    },
+    'studio': {
+        'separation_model': 'UVR-MDX-NET-Voc_FT',
+        'separation_overlap': 0.25,
+        'f0_method': 'rmvpe',
+        'bitrate': '320k',
+        'queue': 'voice_clone_studio',
+        'compute_per_audio_second': 3.0,
+    },
+}
+
+# Cheapest first; used to step jobs down a tier under load
+TIER_ORDER = ['draft', 'standard', 'studio']
+
+QUALITY_TIER_CHOICES = (
+    ('draft', 'Draft'),
+    ('standard', 'Standard'),
+    ('studio', 'Studio'),
+)
+
+
+def get_tier(name: str) -> dict:
+    """
+    Return the settings for a quality tier
+
+    Entries in ``settings.QUALITY_TIERS`` override the defaults above key by
+    key, so a deployment can e.g. point the draft tier at another queue.
+    Unknown names fall back to the default tier.
+    """
+    if name not in QUALITY_TIERS:
+        name = DEFAULT_QUALITY_TIER
+    tier = dict(QUALITY_TIERS[name])
+    tier.update(getattr(settings, 'QUALITY_TIERS', {}).get(name, {}))
+    tier['name'] = name
+    return tier
+
+
+def get_time_limits(duration_seconds, tier_name: str):
+    """
+    Return (soft, hard) Celery time limits in seconds for a job
+
+    Limits grow linearly with the song duration at the tier's cost per
+    audio second (``settings.JOB_TIME_LIMITS``); unknown durations get the
+    maximum. The hard limit leaves a grace period after the soft one for
+    the task to clean up.
+    """
+    limits = getattr(settings, 'JOB_TIME_LIMITS', {})
+    max_seconds = limits.get('max_seconds', 3 * 3600)
+    if duration_seconds is None:
+        soft = max_seconds
+    else:
+        per_second = limits.get('seconds_per_audio_second', {}).get(tier_name, 5)
+        soft = min(limits.get('base_seconds', 120) + per_second * duration_seconds, max_seconds)
+    return int(soft), int(soft + limits.get('hard_grace_seconds', 60))
+
+
+def downgrade_tier(name: str, steps: int) -> str:
+    """Return the tier ``steps`` levels cheaper than ``name`` (never below draft)"""
+    if name not in TIER_ORDER:
+        name = DEFAULT_QUALITY_TIER
+    return TIER_ORDER[max(TIER_ORDER.index(name) - steps, 0)]
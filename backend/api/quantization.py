@@ -0,0 +1,155 @@
+"""
+Dynamic INT8 quantization of the HuBERT content encoder and RVC synthesizer for CPU hosts
+"""
+import logging
+import os
+import tempfile
+from typing import Optional
+
+from celery.exceptions import SoftTimeLimitExceeded
+from django.conf import settings
+
+from .voice_profile import file_sha256
+
+logger = logging.getLogger(__name__)
+
+# Bump when the quantization recipe changes so cached weights are rebuilt
+QUANTIZATION_VERSION = 1
+
+
+def get_quantized_root() -> str:
+    """Directory holding cached quantized models"""
+    return getattr(settings, 'RVC_QUANTIZED_ROOT',
+                   os.path.join(settings.BASE_DIR, 'models', 'quantized'))
+
+
+def quantization_enabled(vc) -> bool:
+    """
+    Whether INT8 models should be used for ``vc``
+
+    ``RVC_CPU_QUANTIZATION`` is 'auto' (quantize when the models run on the
+    CPU), True or False. Quantized kernels only exist for the CPU, so GPU
+    devices always keep the float models.
+    """
+    mode = getattr(settings, 'RVC_CPU_QUANTIZATION', 'auto')
+    if not mode:
+        return False
+    device = str(getattr(getattr(vc, 'config', None), 'device', 'cpu'))
+    if not device.startswith('cpu'):
+        if mode is True:
+            logger.warning(f"INT8 quantization requested but models run on {device}; keeping float models")
+        return False
+    try:
+        import torch
+        return bool(torch.backends.quantized.supported_engines)
+    except ImportError:
+        return False
+
+
+def quantize_module(module):
+    """
+    Return a dynamically quantized copy of ``module``
+
+    Weights of every ``nn.Linear`` are stored as INT8 and activations are
+    quantized on the fly, so no calibration data is needed. The layers
+    that benefit are HuBERT's transformer projections and the
+    synthesizer's phone embedding; convolutions stay in FP32.
+    """
+    import torch
+
+    module = module.float().eval()
+    return torch.ao.quantization.quantize_dynamic(module, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def _cache_path(kind: str, source_path: str, cache_root: Optional[str] = None) -> str:
+    import torch
+
+    digest = file_sha256(source_path)
+    torch_version = torch.__version__.split('+')[0]
+    return os.path.join(cache_root or get_quantized_root(),
+                        f"{kind}_{digest}_torch{torch_version}_q{QUANTIZATION_VERSION}.pt")
+
+
+def load_cached(kind: str, source_path: str, cache_root: Optional[str] = None):
+    """Return the cached quantized module built from ``source_path``, or None"""
+    import torch
+
+    path = _cache_path(kind, source_path, cache_root)
+    if not os.path.exists(path):
+        return None
+    try:
+        # Written by save_cached below; the whole module is pickled so the
+        # float weights never have to be loaded
+        module = torch.load(path, map_location='cpu', weights_only=False)
+        logger.info(f"Loaded quantized {kind} from {path}")
+        return module
+    except Exception as e:
+        logger.warning(f"Ignoring unreadable quantized {kind} cache {path}: {e}")
+        return None
+
+
+def save_cached(kind: str, source_path: str, module, cache_root: Optional[str] = None) -> None:
+    """Write a quantized module to the cache atomically"""
+    import torch
+
+    path = _cache_path(kind, source_path, cache_root)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.pt.tmp')
+    os.close(fd)
+    try:
+        torch.save(module, tmp_path)
+        os.replace(tmp_path, path)
+        logger.info(f"Cached quantized {kind}: {path}")
+    except Exception as e:
+        logger.warning(f"Failed to cache quantized {kind}: {e}")
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def get_quantized(kind: str, source_path: str, module_factory, cache_root: Optional[str] = None):
+    """
+    Return the quantized version of a model, from the cache when possible
+
+    Args:
+        kind: 'hubert' or 'synthesizer'; part of the cache key
+        source_path: Float weights the module was loaded from; their
+            SHA-256 keys the cache so a new checkpoint is re-quantized
+        module_factory: Returns the loaded float module on a cache miss
+    """
+    module = load_cached(kind, source_path, cache_root)
+    if module is None:
+        logger.info(f"Quantizing {kind} from {source_path}")
+        module = quantize_module(module_factory())
+        save_cached(kind, source_path, module, cache_root)
+    return module
+
+
+def quantize_loaded_models(vc, model_path: str) -> bool:
+    """
+    Swap the loaded synthesizer and HuBERT of ``vc`` for their INT8 versions
+
+    HuBERT is shared by every voice model, so it is only swapped once; if
+    its quantized copy is cached the float checkpoint is never loaded.
+
+    Args:
+        vc: RVC ``VC`` instance with ``get_vc`` already called
+        model_path: Synthesizer checkpoint ``vc`` was loaded from
+
+    Returns:
+        bool: True if the quantized models are in place
+    """
+    try:
+        from .voice_profile import get_hubert_path, load_hubert_model
+
+        vc.net_g = get_quantized('synthesizer', model_path, lambda: vc.net_g)
+        hubert_path = get_hubert_path()
+        if not getattr(vc, 'hubert_quantized', False) and os.path.exists(hubert_path):
+            vc.hubert_model = get_quantized('hubert', hubert_path, lambda: load_hubert_model(vc))
+            vc.hubert_quantized = True
+        return True
+    except SoftTimeLimitExceeded:
+        raise
+    except Exception as e:
+        logger.error(f"Failed to quantize models, keeping FP32: {str(e)}")
+        return False
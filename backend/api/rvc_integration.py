@@ -6,10 +6,15 @@ import logging
 import subprocess
 import tempfile
 from pathlib import Path
-from typing import Optional, Tuple
+from typing import Callable, Optional, Tuple
 
+from celery.exceptions import SoftTimeLimitExceeded
 from django.conf import settings
 
+from .exceptions import JobCancelled
+from .inference_server import InferenceServerUnavailable, get_client
+from .metrics import stage_timer
+
 # Try to import RVC modules, fall back to mock implementations if not available
 RVC_AVAILABLE = False
 VC = None
@@ -69,6 +74,13 @@ except ImportError as e:
 
 logger = logging.getLogger(__name__)
 
+
+def default_model_path() -> str:
+    """Return the configured RVC model path"""
+    return getattr(settings, 'RVC_MODEL_PATH',
+                   os.path.join(settings.BASE_DIR, 'models', 'rvc_model.pth'))
+
+
 class RVCVoiceCloner:
     """
     Wrapper class for RVC voice cloning functionality
@@ -90,11 +102,18 @@ class RVCVoiceCloner:
                 self.uvr = None
         self.model_loaded = False
         self.current_model = None
+        # Weights loaded in this process; differs from current_model while
+        # the inference server holds them instead
+        self.local_model = None
+        self.quantized = False
         
     def load_model(self, model_path: str) -> bool:
         """
         Load RVC model for voice conversion
         
+        With a reachable inference server only the path is recorded; the
+        weights are loaded here later if the server goes away.
+        
         Args:
             model_path: Path to the .pth model file
             
@@ -108,29 +127,178 @@ class RVCVoiceCloner:
         try:
             if not os.path.exists(model_path):
                 raise FileNotFoundError(f"Model file not found: {model_path}")
+            
+            if get_client() is not None:
+                # The inference server loads the weights, once for the host
+                self.current_model = model_path
+                self.model_loaded = True
+                logger.info(f"Using model {model_path} through the inference server")
+                return True
                 
-            self.vc.get_vc(model_path)
+            self._load_local(model_path)
             self.current_model = model_path
             self.model_loaded = True
-            logger.info(f"Successfully loaded model: {model_path}")
             return True
             
+        except SoftTimeLimitExceeded:
+            raise
         except Exception as e:
             logger.error(f"Failed to load model {model_path}: {str(e)}")
             self.model_loaded = False
             return False
     
-    def separate_vocals(self, audio_path: str, output_dir: str) -> Tuple[Optional[str], Optional[str]]:
+    def _load_local(self, model_path: str) -> None:
+        """Load the weights into this process's VC instance"""
+        self.vc.get_vc(model_path)
+        
+        from .quantization import quantization_enabled, quantize_loaded_models
+        self.quantized = quantization_enabled(self.vc) and quantize_loaded_models(self.vc, model_path)
+        
+        self.local_model = model_path
+        logger.info(f"Successfully loaded model: {model_path}{' (INT8)' if self.quantized else ''}")
+    
+    def _ensure_local_model(self) -> None:
+        """Load the current model here when it was only loaded on the inference server"""
+        if self.local_model != self.current_model:
+            self._load_local(self.current_model)
+    
+    def _call_server(self, op: str, *args) -> Tuple[bool, object]:
+        """
+        Run ``op`` on the inference server if there is one
+        
+        Returns:
+            Tuple of (served, result); served is False when the caller
+            should run the operation in-process
+        """
+        client = get_client()
+        if client is None:
+            return False, None
+        try:
+            return True, client.call(op, *args)
+        except InferenceServerUnavailable as e:
+            logger.warning(f"{e}; running {op} in-process")
+            return False, None
+    
+    def run_inference(self, input_audio: str, params: dict):
+        """
+        Run RVC inference on the inference server, or in-process without one
+        
+        Returns:
+            RVC's (tgt_sr, audio, times, error) tuple
+        """
+        served, result = self._call_server('convert', self.current_model, input_audio, params)
+        if served:
+            return result
+        self._ensure_local_model()
+        return self.vc.vc_inference(input_audio_path=input_audio, **params)
+    
+    def preload_shared(self, model_path: str) -> bool:
+        """
+        Load all inference weights in the current process for sharing with forks
+        
+        Meant to run in the Celery parent process before the prefork pool
+        starts. Loads the RVC weights, HuBERT and RMVPE (via a short warm-up
+        inference), moves every tensor into shared memory and freezes the
+        garbage collector so forked children attach to a single read-only
+        copy instead of each loading their own.
+        
+        Args:
+            model_path: Path to the .pth model file
+            
+        Returns:
+            bool: True if the weights were preloaded
+        """
+        if not RVC_AVAILABLE:
+            logger.error("RVC modules not available")
+            return False
+            
+        try:
+            import gc
+            import torch
+            
+            device = str(getattr(self.vc.config, 'device', 'cpu'))
+            if device.startswith('cuda'):
+                # CUDA contexts do not survive fork; children load their own
+                logger.warning("Skipping shared preload on CUDA device; CUDA cannot be forked")
+                return False
+            
+            # Loaded here even with an inference server: the point is a local copy
+            if model_path != self.local_model:
+                self._load_local(model_path)
+                self.current_model = model_path
+                self.model_loaded = True
+            
+            from .voice_profile import load_hubert_model
+            load_hubert_model(self.vc)
+            
+            # A short inference loads the lazily created models (RMVPE) through
+            # the same code path real jobs use
+            if AUDIO_LIBS_AVAILABLE:
+                with tempfile.TemporaryDirectory() as tmp_dir:
+                    warmup_path = os.path.join(tmp_dir, 'warmup.wav')
+                    sf.write(warmup_path, np.zeros(16000, dtype=np.float32), 16000)
+                    self.vc.vc_inference(sid=0, input_audio_path=warmup_path, f0_method='rmvpe')
+            
+            candidates = list(vars(self.vc).values())
+            if getattr(self.vc, 'pipeline', None) is not None:
+                candidates += list(vars(self.vc.pipeline).values())
+            
+            shared = 0
+            for value in candidates:
+                # RMVPE wraps its network in a plain object with a .model attribute
+                module = value if isinstance(value, torch.nn.Module) else getattr(value, 'model', None)
+                if isinstance(module, torch.nn.Module):
+                    module.eval()
+                    module.requires_grad_(False)
+                    module.share_memory()
+                    shared += 1
+            
+            # Move everything allocated so far out of the collector's reach so
+            # GC passes in the children do not dirty the inherited pages
+            gc.collect()
+            gc.freeze()
+            
+            logger.info(f"Preloaded {shared} shared model(s) from {model_path}")
+            return True
+            
+        except Exception as e:
+            logger.error(f"Failed to preload shared models: {str(e)}")
+            return False
+    
+    def separate_vocals(self, audio_path: str, output_dir: str,
+                        model_name: str = "UVR-MDX-NET-Voc_FT",
+                        overlap: float = 0.25,
+                        cancel_check: Optional[Callable[[], bool]] = None) -> Tuple[Optional[str], Optional[str]]:
         """
         Separate vocals and instrumental from audio file
         
+        With ``UVR_SEPARATION_MODE = 'chunked'`` the ONNX model is run
+        in-process over overlapping windows on all cores; otherwise (or if
+        the model is not available as ONNX) the RVC UVR5 wrapper is used.
+        
         Args:
             audio_path: Path to input audio file
             output_dir: Directory to save separated files
+            model_name: UVR5 separation model to use
+            overlap: Window overlap for chunked separation
+            cancel_check: Polled between chunked separation windows
             
         Returns:
             Tuple of (vocals_path, instrumental_path) or (None, None) if failed
         """
+        from . import chunked_separation
+        
+        if (getattr(settings, 'UVR_SEPARATION_MODE', 'uvr') == 'chunked' and
+                chunked_separation.supports_model(model_name)):
+            os.makedirs(output_dir, exist_ok=True)
+            vocals_path = os.path.join(output_dir, "vocals.wav")
+            instrumental_path = os.path.join(output_dir, "instrumental.wav")
+            if chunked_separation.separate_chunked(audio_path, vocals_path, instrumental_path,
+                                                   model_name=model_name, overlap=overlap,
+                                                   cancel_check=cancel_check):
+                return vocals_path, instrumental_path
+            return None, None
+        
         if not RVC_AVAILABLE:
             logger.error("RVC modules not available")
             return None, None
@@ -145,7 +313,7 @@ class RVCVoiceCloner:
             # Call UVR separation
             self.uvr.uvr_wrapper(
                 audio_path=Path(audio_path),
-                model_name="UVR-MDX-NET-Voc_FT",  # Default vocal separation model
+                model_name=model_name,
                 temp_dir=Path(output_dir)
             )
             
@@ -161,10 +329,38 @@ class RVCVoiceCloner:
                 
             return vocals_path, instrumental_path
             
+        except SoftTimeLimitExceeded:
+            raise
         except Exception as e:
             logger.error(f"Failed to separate vocals: {str(e)}")
             return None, None
     
+    def build_voice_profile(self, voice_sample_path: str) -> Optional[str]:
+        """
+        Build (or reuse) the FAISS retrieval index for a target voice sample
+        
+        Args:
+            voice_sample_path: Path to the uploaded voice sample
+            
+        Returns:
+            Path to the index file, or None if unavailable
+        """
+        if not RVC_AVAILABLE:
+            logger.error("RVC modules not available")
+            return None
+            
+        if not self.model_loaded:
+            logger.error("No model loaded. Call load_model() first.")
+            return None
+        
+        served, index_file = self._call_server('voice_profile', self.current_model, voice_sample_path)
+        if served:
+            return index_file
+        
+        self._ensure_local_model()
+        from .voice_profile import get_voice_index
+        return get_voice_index(self.vc, voice_sample_path)
+    
     def convert_voice(self, 
                      input_audio: str, 
                      target_voice_sample: str,
@@ -175,7 +371,8 @@ class RVCVoiceCloner:
         
         Args:
             input_audio: Path to input audio (vocals)
-            target_voice_sample: Path to target voice sample (for reference)
+            target_voice_sample: Path to target voice sample, used to build
+                the retrieval index unless ``index_file`` is given
             output_path: Path to save converted audio
             **kwargs: Additional RVC parameters
             
@@ -190,12 +387,18 @@ class RVCVoiceCloner:
             if not self.model_loaded:
                 raise ValueError("No model loaded. Call load_model() first.")
             
+            if 'index_file' in kwargs:
+                index_file = kwargs['index_file']
+            else:
+                index_file = self.build_voice_profile(target_voice_sample) if target_voice_sample else None
+            
             # Default RVC parameters
             params = {
                 'sid': kwargs.get('sid', 0),
                 'f0_up_key': kwargs.get('f0_up_key', 0),
                 'f0_method': kwargs.get('f0_method', 'rmvpe'),
-                'index_rate': kwargs.get('index_rate', 0.75),
+                'index_file': index_file,
+                'index_rate': kwargs.get('index_rate', 0.75) if index_file else 0,
                 'filter_radius': kwargs.get('filter_radius', 3),
                 'resample_sr': kwargs.get('resample_sr', 0),
                 'rms_mix_rate': kwargs.get('rms_mix_rate', 0.25),
@@ -203,10 +406,7 @@ class RVCVoiceCloner:
             }
             
             # Perform voice conversion
-            tgt_sr, audio_opt, times, error = self.vc.vc_inference(
-                input_audio_path=input_audio,
-                **params
-            )
+            tgt_sr, audio_opt, times, error = self.run_inference(input_audio, params)
             
             if error:
                 raise Exception(f"RVC inference failed: {error}")
@@ -220,6 +420,8 @@ class RVCVoiceCloner:
             logger.info(f"Voice conversion completed: {output_path}")
             return True
             
+        except SoftTimeLimitExceeded:
+            raise
         except Exception as e:
             logger.error(f"Voice conversion failed: {str(e)}")
             return False
@@ -278,6 +480,8 @@ class RVCVoiceCloner:
             logger.info(f"Audio mixing completed: {output_path}")
             return True
             
+        except SoftTimeLimitExceeded:
+            raise
         except Exception as e:
             logger.error(f"Audio mixing failed: {str(e)}")
             return False
@@ -287,20 +491,40 @@ class RVCVoiceCloner:
                              voice_sample_path: str, 
                              output_path: str,
                              work_dir: str,
-                             model_path: str = None) -> bool:
+                             model_path: str = None,
+                             separation_model: str = "UVR-MDX-NET-Voc_FT",
+                             separation_overlap: float = 0.25,
+                             f0_method: str = 'rmvpe',
+                             manifest=None,
+                             cancel_check: Optional[Callable[[], bool]] = None) -> bool:
         """
         Complete voice cloning pipeline
         
+        When a ``StageManifest`` is given, stages it records as completed
+        (with unchanged artifacts and parameters) are skipped and every
+        newly finished stage is checkpointed, so a rerun resumes where the
+        previous attempt stopped.
+        
         Args:
             song_path: Input song file
             voice_sample_path: Target voice sample
             output_path: Final output file
             work_dir: Working directory for intermediate files
             model_path: RVC model path (if different from current)
+            separation_model: UVR5 model used for vocal separation
+            separation_overlap: Window overlap for chunked separation
+            f0_method: Pitch extraction method used for conversion
+            manifest: Optional StageManifest for the work dir
+            cancel_check: Polled at stage and segment boundaries; returning
+                True raises JobCancelled
             
         Returns:
             bool: True if entire pipeline successful
         """
+        def check_cancelled():
+            if cancel_check and cancel_check():
+                raise JobCancelled()
+        
         if not RVC_AVAILABLE:
             logger.error("RVC modules not available. Voice cloning disabled.")
             return False
@@ -315,25 +539,68 @@ class RVCVoiceCloner:
             os.makedirs(work_dir, exist_ok=True)
             
             # Step 1: Separate vocals and instrumental
-            logger.info("Step 1: Separating vocals and instrumental...")
-            vocals_path, instrumental_path = self.separate_vocals(song_path, work_dir)
-            if not vocals_path or not instrumental_path:
-                return False
-            
-            # Step 2: Convert vocals to target voice
-            logger.info("Step 2: Converting vocals...")
-            converted_vocals_path = os.path.join(work_dir, "converted_vocals.wav")
-            if not self.convert_voice(vocals_path, voice_sample_path, converted_vocals_path):
-                return False
-            
-            # Step 3: Mix converted vocals with instrumental
-            logger.info("Step 3: Mixing final audio...")
-            if not self.mix_audio(converted_vocals_path, instrumental_path, output_path):
-                return False
+            separation_params = {'model': separation_model, 'overlap': separation_overlap}
+            done = manifest.completed('separation', separation_params) if manifest else None
+            if done:
+                vocals_path, instrumental_path = done['vocals'], done['instrumental']
+            else:
+                check_cancelled()
+                logger.info("Step 1: Separating vocals and instrumental...")
+                with stage_timer('separation'):
+                    vocals_path, instrumental_path = self.separate_vocals(song_path, work_dir,
+                                                                          model_name=separation_model,
+                                                                          overlap=separation_overlap,
+                                                                          cancel_check=cancel_check)
+                if not vocals_path or not instrumental_path:
+                    return False
+                if manifest:
+                    manifest.mark_completed('separation', {'vocals': vocals_path,
+                                                           'instrumental': instrumental_path},
+                                            separation_params)
+            
+            # Steps 2 and 3: Build the voice profile and convert vocals to the
+            # target voice (the profile is cached by voice hash, so it is only
+            # rebuilt here when conversion itself has to rerun)
+            conversion_params = dict(separation_params, f0_method=f0_method, model=self.current_model)
+            done = manifest.completed('conversion', conversion_params) if manifest else None
+            if done:
+                converted_vocals_path = done['converted_vocals']
+            else:
+                check_cancelled()
+                logger.info("Step 2: Building voice profile...")
+                with stage_timer('voice_profile'):
+                    index_file = self.build_voice_profile(voice_sample_path)
+                
+                check_cancelled()
+                logger.info("Step 3: Converting vocals...")
+                converted_vocals_path = os.path.join(work_dir, "converted_vocals.wav")
+                with stage_timer('conversion'):
+                    converted = self.convert_voice(vocals_path, voice_sample_path, converted_vocals_path,
+                                                   index_file=index_file, f0_method=f0_method)
+                if not converted:
+                    return False
+                if manifest:
+                    manifest.mark_completed('conversion', {'converted_vocals': converted_vocals_path},
+                                            conversion_params)
+            
+            # Step 4: Mix converted vocals with instrumental
+            done = manifest.completed('mixing', conversion_params) if manifest else None
+            if not done:
+                check_cancelled()
+                logger.info("Step 4: Mixing final audio...")
+                with stage_timer('mixing'):
+                    mixed = self.mix_audio(converted_vocals_path, instrumental_path, output_path)
+                if not mixed:
+                    return False
+                if manifest:
+                    manifest.mark_completed('mixing', {'output': output_path}, conversion_params)
             
             logger.info("Voice cloning pipeline completed successfully!")
             return True
             
+        except (JobCancelled, SoftTimeLimitExceeded):
+            # The task decides what to do about these
+            raise
         except Exception as e:
             logger.error(f"Full pipeline failed: {str(e)}")
             return False
@@ -1,5 +1,18 @@
 from rest_framework import serializers
-from .models import Job
+from .models import Job, SongUpload
+
+class SongUploadSerializer(serializers.ModelSerializer):
+    """Serializer for songs uploaded ahead of their job"""
+    
+    class Meta:
+        model = SongUpload
+        fields = ['id', 'song_file', 'quality_tier', 'separation_status', 'duration_seconds', 'created_at']
+        read_only_fields = ['id', 'separation_status', 'duration_seconds', 'created_at']
+    
+    def validate_song_file(self, value):
+        if not value.name.lower().endswith(('.mp3', '.wav')):
+            raise serializers.ValidationError("Song file must be in MP3 or WAV format.")
+        return value
 
 class JobSerializer(serializers.ModelSerializer):
     """Serializer for Job model"""
@@ -7,9 +20,13 @@ class JobSerializer(serializers.ModelSerializer):
     
     class Meta:
         model = Job
-        fields = ['id', 'song_file', 'voice_file', 'consent_accepted', 
+        fields = ['id', 'song_file', 'song_upload', 'voice_file', 'consent_accepted', 'quality_tier',
+                  'client_id', 'batch_id', 'effective_tier', 'downgrade_reason',
                   'status', 'created_at', 'updated_at', 'result_url']
-        read_only_fields = ['id', 'status', 'created_at', 'updated_at', 'result_url']
+        read_only_fields = ['id', 'effective_tier', 'downgrade_reason',
+                            'status', 'created_at', 'updated_at', 'result_url']
+        # Either the song itself or the handle of a song uploaded earlier
+        extra_kwargs = {'song_file': {'required': False}}
     
     def get_result_url(self, obj):
         """Return the URL of the result file if available"""
@@ -29,6 +46,9 @@ class JobSerializer(serializers.ModelSerializer):
         song_file = data.get('song_file')
         voice_file = data.get('voice_file')
         
+        if bool(song_file) == bool(data.get('song_upload')):
+            raise serializers.ValidationError("Provide either song_file or song_upload.")
+        
         if song_file and not song_file.name.lower().endswith(('.mp3', '.wav')):
             raise serializers.ValidationError("Song file must be in MP3 or WAV format.")
         
@@ -36,6 +56,13 @@ class JobSerializer(serializers.ModelSerializer):
             raise serializers.ValidationError("Voice sample must be in WAV format.")
             
         return data
+    
+    def create(self, validated_data):
+        """Jobs created from a song upload share its stored song file"""
+        song_upload = validated_data.get('song_upload')
+        if song_upload:
+            validated_data['song_file'] = song_upload.song_file.name
+        return super().create(validated_data)
 
 class JobStatusSerializer(serializers.ModelSerializer):
     """Simplified serializer for checking job status"""
@@ -0,0 +1,172 @@
+"""
+Shared cache of separated stems, keyed by song content and separation settings
+"""
+import logging
+import os
+import shutil
+import tempfile
+import time
+from typing import Callable, Dict, Optional
+
+from django.conf import settings
+
+from .exceptions import JobCancelled
+
+logger = logging.getLogger(__name__)
+
+STEM_NAMES = ('vocals', 'instrumental')
+LOCK_NAME = '.lock'
+
+
+def get_config() -> dict:
+    config = {'wait_seconds': 900, 'poll_seconds': 2, 'lock_timeout_seconds': 3600}
+    config.update(getattr(settings, 'STEM_CACHE', {}))
+    return config
+
+
+def get_stem_root() -> str:
+    """Directory holding cached stems"""
+    return str(getattr(settings, 'STEM_CACHE_ROOT', os.path.join(settings.MEDIA_ROOT, 'stems')))
+
+
+def stem_key(song_sha256: str, model_name: str, overlap: float) -> str:
+    """Cache key of a song separated with ``model_name`` at ``overlap``"""
+    return f"{song_sha256}_{model_name}_o{overlap:g}"
+
+
+def _shard_dir(key: str) -> str:
+    # Keys start with the song hash, so the first two characters spread
+    # entries evenly over 256 subdirectories
+    return os.path.join(get_stem_root(), key[:2])
+
+
+def _entry_dir(key: str) -> str:
+    return os.path.join(_shard_dir(key), key)
+
+
+def _lock_path(key: str) -> str:
+    return os.path.join(_shard_dir(key), f"{key}{LOCK_NAME}")
+
+
+def lookup(key: str) -> Optional[Dict[str, str]]:
+    """Return the cached stem paths for ``key``, or None"""
+    entry = _entry_dir(key)
+    paths = {name: os.path.join(entry, f"{name}.wav") for name in STEM_NAMES}
+    if all(os.path.exists(path) for path in paths.values()):
+        # The entry's mtime is its last use for the storage lifecycle's LRU
+        try:
+            os.utime(entry)
+        except OSError:
+            pass
+        return paths
+    return None
+
+
+def in_progress(key: str) -> bool:
+    """True while some worker holds the separation lock for ``key``"""
+    try:
+        age = time.time() - os.path.getmtime(_lock_path(key))
+    except FileNotFoundError:
+        return False
+    # A worker that died mid-separation never releases its lock
+    return age < get_config()['lock_timeout_seconds']
+
+
+def acquire(key: str) -> bool:
+    """Claim the separation of ``key``; False if another worker holds it"""
+    os.makedirs(_shard_dir(key), exist_ok=True)
+    path = _lock_path(key)
+    if os.path.exists(path) and not in_progress(key):
+        logger.warning(f"Breaking stale stem lock {path}")
+        release(key)
+    try:
+        fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+    with os.fdopen(fd, 'w') as f:
+        f.write(str(os.getpid()))
+    return True
+
+
+def release(key: str) -> None:
+    try:
+        os.remove(_lock_path(key))
+    except FileNotFoundError:
+        pass
+
+
+def _link_or_copy(src: str, dst: str) -> None:
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+def store(key: str, stems: Dict[str, str]) -> Optional[Dict[str, str]]:
+    """
+    Add separated stems to the cache
+
+    Files are hard-linked (or copied across filesystems) into a temp dir
+    that is renamed into place, so readers never see half an entry.
+
+    Args:
+        key: Cache key from ``stem_key``
+        stems: {'vocals': path, 'instrumental': path}
+
+    Returns:
+        The cached stem paths, or None if they could not be stored
+    """
+    cached = lookup(key)
+    if cached:
+        return cached
+
+    root = get_stem_root()
+    os.makedirs(root, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=root, prefix='.tmp-')
+    try:
+        for name in STEM_NAMES:
+            _link_or_copy(stems[name], os.path.join(tmp_dir, f"{name}.wav"))
+        try:
+            os.makedirs(_shard_dir(key), exist_ok=True)
+            os.rename(tmp_dir, _entry_dir(key))
+        except OSError:
+            # Another worker stored the same stems first
+            pass
+        return lookup(key)
+    except Exception as e:
+        logger.warning(f"Failed to cache stems for {key}: {e}")
+        return None
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def wait(key: str, cancel_check: Optional[Callable[[], bool]] = None,
+         timeout: Optional[float] = None) -> Optional[Dict[str, str]]:
+    """
+    Wait for a separation running elsewhere, then return its stems
+
+    Returns None straight away when nobody is separating ``key``, and when
+    the other worker fails or does not finish within ``timeout``.
+    """
+    config = get_config()
+    deadline = time.monotonic() + (timeout if timeout is not None else config['wait_seconds'])
+    while in_progress(key) and time.monotonic() < deadline:
+        if cancel_check and cancel_check():
+            raise JobCancelled()
+        time.sleep(config['poll_seconds'])
+    return lookup(key)
+
+
+def copy_into(stems: Dict[str, str], work_dir: str) -> Dict[str, str]:
+    """
+    Copy cached stems into a job's work dir
+
+    Copied rather than linked, so neither eviction from the cache nor a
+    rerun of separation in the work dir can touch the other's files.
+    """
+    os.makedirs(work_dir, exist_ok=True)
+    paths = {}
+    for name in STEM_NAMES:
+        paths[name] = os.path.join(work_dir, f"{name}.wav")
+        shutil.copyfile(stems[name], paths[name])
+    return paths
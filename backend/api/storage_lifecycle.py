@@ -0,0 +1,272 @@
+"""
+Retention and disk budget for uploads, results and the on-disk caches
+
+Each category of stored file has a retention period after its last use.
+On top of that, when everything together exceeds the disk budget, the
+least recently used entries are evicted, caches before originals before
+results. Files referenced by queued or running jobs, and the cached stems
+of their songs, are never removed.
+"""
+import logging
+import os
+import shutil
+import time
+from typing import Dict, List, Optional, Set
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Q
+from django.utils import timezone
+
+from . import fingerprint, stem_cache
+from .cache_keys import status_cache_key
+from .models import Job, SongUpload
+from .voice_profile import get_index_root
+
+logger = logging.getLogger(__name__)
+
+# Originals and results live under MEDIA_ROOT in these upload_to directories
+MEDIA_CATEGORIES = ('songs', 'voices', 'outputs')
+CATEGORIES = MEDIA_CATEGORIES + ('stems', 'indices')
+ACTIVE_STATUSES = ('queued', 'processing')
+
+DEFAULT_CONFIG = {
+    # Days after last use; None keeps a category until the budget evicts it
+    'retention_days': {'songs': 7, 'voices': 7, 'outputs': 30, 'stems': 30, 'indices': 90},
+    'disk_budget_gb': None,
+    # Evicted first to last when over budget: caches can be rebuilt, and
+    # results are what users come back for
+    'eviction_order': ('stems', 'indices', 'songs', 'voices', 'outputs'),
+    # Nothing used more recently than this is evicted for the budget
+    'min_idle_seconds': 3600,
+}
+
+
+def get_config() -> dict:
+    config = dict(DEFAULT_CONFIG)
+    config.update(getattr(settings, 'STORAGE_LIFECYCLE', {}))
+    config['retention_days'] = dict(DEFAULT_CONFIG['retention_days'], **config['retention_days'])
+    return config
+
+
+def category_root(category: str) -> str:
+    if category == 'stems':
+        return stem_cache.get_stem_root()
+    if category == 'indices':
+        return str(get_index_root())
+    return os.path.join(settings.MEDIA_ROOT, category)
+
+
+def _file_entry(category: str, path: str) -> Optional[dict]:
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return {'category': category, 'path': path, 'size': stat.st_size,
+            'last_used': max(stat.st_mtime, stat.st_atime)}
+
+
+def _stem_entry(path: str) -> Optional[dict]:
+    size = 0
+    for name in stem_cache.STEM_NAMES:
+        try:
+            size += os.path.getsize(os.path.join(path, f"{name}.wav"))
+        except FileNotFoundError:
+            pass
+    try:
+        # lookup() touches the entry on every use
+        last_used = os.path.getmtime(path)
+    except FileNotFoundError:
+        return None
+    return {'category': 'stems', 'path': path, 'size': size, 'last_used': last_used,
+            'key': os.path.basename(path)}
+
+
+def scan(category: str) -> List[dict]:
+    """
+    List the stored entries of a category
+
+    Stem cache entries are whole directories; everything else is a file.
+    Temporary files, locks and hidden entries are skipped.
+    """
+    root = category_root(category)
+    entries = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+        if category == 'stems':
+            if dirpath == root:
+                continue
+            if any(f"{name}.wav" in filenames for name in stem_cache.STEM_NAMES):
+                entry = _stem_entry(dirpath)
+                if entry:
+                    entries.append(entry)
+                dirnames[:] = []
+            continue
+        for filename in filenames:
+            if filename.startswith('.') or filename.endswith('.tmp'):
+                continue
+            if category == 'indices' and not filename.endswith('.index'):
+                continue
+            entry = _file_entry(category, os.path.join(dirpath, filename))
+            if entry:
+                entries.append(entry)
+    return entries
+
+
+def protected_paths() -> Set[str]:
+    """Absolute paths of files that queued or running work still needs"""
+    media_root = str(settings.MEDIA_ROOT)
+    names = set()
+    for row in Job.objects.filter(status__in=ACTIVE_STATUSES).values_list('song_file', 'voice_file', 'result_file'):
+        names.update(row)
+    uploads = SongUpload.objects.filter(Q(separation_status__in=('pending', 'processing')) |
+                                        Q(jobs__status__in=ACTIVE_STATUSES))
+    names.update(uploads.values_list('song_file', flat=True))
+    return {os.path.join(media_root, name) for name in names if name}
+
+
+def protected_stem_songs() -> Set[str]:
+    """Hashes of the songs whose cached stems queued or running work may reuse"""
+    jobs = Job.objects.filter(status__in=ACTIVE_STATUSES)
+    hashes = set(jobs.values_list('song_sha256', flat=True))
+    hashes.update(jobs.values_list('song_upload__sha256', flat=True))
+    hashes.update(SongUpload.objects.filter(separation_status__in=('pending', 'processing'))
+                  .values_list('sha256', flat=True))
+    return {sha256 for sha256 in hashes if sha256}
+
+
+def _stems_in_use(entry: dict, protected_songs: Set[str]) -> bool:
+    sha256 = entry['key'].split('_', 1)[0]
+    if sha256 in protected_songs or stem_cache.in_progress(entry['key']):
+        return True
+    try:
+        # lookup() touches the entry, so a job copying these stems (or
+        # aligning them after a fingerprint match) has used it since the scan
+        if os.path.getmtime(entry['path']) > entry['last_used']:
+            return True
+    except FileNotFoundError:
+        return False
+    # A job may have been queued with this song since the scan
+    return Job.objects.filter(Q(song_sha256=sha256) | Q(song_upload__sha256=sha256),
+                              status__in=ACTIVE_STATUSES).exists()
+
+
+def _in_use(entry: dict, protected: Set[str], protected_songs: Set[str]) -> bool:
+    if entry['category'] == 'stems':
+        return _stems_in_use(entry, protected_songs)
+    if entry['path'] in protected:
+        return True
+    if entry['category'] in ('songs', 'voices'):
+        # A job may have been queued with this file since the scan
+        name = os.path.relpath(entry['path'], settings.MEDIA_ROOT)
+        field = 'song_file' if entry['category'] == 'songs' else 'voice_file'
+        return Job.objects.filter(status__in=ACTIVE_STATUSES, **{field: name}).exists()
+    return False
+
+
+def _forget(entry: dict) -> None:
+    """Clear database and cache references to a removed entry"""
+    if entry['category'] == 'stems':
+        return
+    if entry['category'] not in MEDIA_CATEGORIES:
+        return
+    name = os.path.relpath(entry['path'], settings.MEDIA_ROOT)
+    if entry['category'] == 'outputs':
+        pks = list(Job.objects.filter(result_file=name).values_list('pk', flat=True))
+        Job.objects.filter(pk__in=pks).update(result_file=None, error_message='Result file expired',
+                                              updated_at=timezone.now())
+        cache.delete_many([status_cache_key(pk) for pk in pks])
+    elif entry['category'] == 'songs':
+        Job.objects.filter(song_file=name).update(song_file='')
+        SongUpload.objects.filter(song_file=name).update(song_file='')
+    else:
+        Job.objects.filter(voice_file=name).update(voice_file='')
+
+
+def remove(entry: dict) -> bool:
+    """Delete an entry and the references to it; True if it was removed"""
+    try:
+        if entry['category'] == 'stems':
+            shutil.rmtree(entry['path'])
+        else:
+            os.remove(entry['path'])
+    except FileNotFoundError:
+        return False
+    except OSError as e:
+        logger.warning(f"Failed to remove {entry['path']}: {e}")
+        return False
+    _forget(entry)
+    return True
+
+
+def sweep(dry_run: bool = False, now: Optional[float] = None) -> dict:
+    """
+    Apply the retention periods, then evict down to the disk budget
+
+    Args:
+        dry_run: Report what would be removed without removing anything
+        now: Current time (for tests and simulations)
+
+    Returns:
+        Report with the bytes reclaimed, the entries removed per category
+        and the usage per category after the sweep
+    """
+    config = get_config()
+    now = now or time.time()
+    protected = protected_paths()
+    protected_songs = protected_stem_songs()
+    entries = {category: scan(category) for category in CATEGORIES}
+    removed: Dict[str, dict] = {category: {'entries': 0, 'bytes': 0} for category in CATEGORIES}
+    removed_stem_songs = set()
+
+    def drop(entry, reason):
+        if _in_use(entry, protected, protected_songs):
+            return False
+        if not dry_run and not remove(entry):
+            return False
+        removed[entry['category']]['entries'] += 1
+        removed[entry['category']]['bytes'] += entry['size']
+        if entry['category'] == 'stems':
+            removed_stem_songs.add(entry['key'].split('_', 1)[0])
+        logger.info(f"{'Would remove' if dry_run else 'Removed'} {entry['path']} ({reason})")
+        return True
+
+    # Retention
+    for category in CATEGORIES:
+        days = config['retention_days'].get(category)
+        if days is None:
+            continue
+        cutoff = now - days * 86400
+        entries[category] = [entry for entry in entries[category]
+                             if not (entry['last_used'] < cutoff and drop(entry, 'retention'))]
+
+    # Disk budget
+    budget = int(config['disk_budget_gb'] * 1024 ** 3) if config['disk_budget_gb'] else None
+    usage = sum(entry['size'] for category in CATEGORIES for entry in entries[category])
+    if budget is not None and usage > budget:
+        order = {category: rank for rank, category in enumerate(config['eviction_order'])}
+        idle_cutoff = now - config['min_idle_seconds']
+        candidates = sorted((entry for category in CATEGORIES if category in order
+                             for entry in entries[category] if entry['last_used'] < idle_cutoff),
+                            key=lambda entry: (order[entry['category']], entry['last_used']))
+        for entry in candidates:
+            if usage <= budget:
+                break
+            if drop(entry, 'disk budget'):
+                usage -= entry['size']
+                entries[entry['category']].remove(entry)
+
+    # Songs with no stems left cannot be reused through the fingerprint index
+    remaining_songs = {entry['key'].split('_', 1)[0] for entry in entries['stems']}
+    if not dry_run:
+        for sha256 in removed_stem_songs - remaining_songs:
+            fingerprint.remove_song(sha256)
+
+    return {
+        'dry_run': dry_run,
+        'reclaimed_bytes': sum(r['bytes'] for r in removed.values()),
+        'removed': removed,
+        'usage_bytes': {category: sum(entry['size'] for entry in entries[category]) for category in CATEGORIES},
+        'budget_bytes': budget,
+        'over_budget': budget is not None and usage > budget,
+    }
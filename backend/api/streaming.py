@@ -0,0 +1,328 @@
+"""
+Streaming voice conversion over a WebSocket on the ASGI app
+
+A client connects to ``/ws/convert/?sample_rate=16000``, sends mono
+float32 little-endian PCM as binary messages and receives the converted
+audio back the same way, one chunk at a time. Each converted chunk is
+followed by a JSON text message with its latency and real-time factor;
+sending ``{"type": "flush"}`` converts what is left and returns a summary.
+
+Each chunk is converted together with the audio just before it (the
+context) so the model sees continuous speech, and consecutive chunks are
+crossfaded. Output lags input by one chunk plus one crossfade, plus the
+conversion time.
+"""
+import asyncio
+import json
+import logging
+import os
+import statistics
+import tempfile
+import threading
+import time
+from typing import List
+from urllib.parse import parse_qs
+
+from django.conf import settings
+
+from . import metrics
+
+try:
+    import numpy as np
+    STREAMING_AVAILABLE = True
+except ImportError as e:
+    logging.warning(f"Streaming conversion not available: {e}")
+    STREAMING_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+STREAM_PATH = '/ws/convert/'
+MIN_SAMPLE_RATE = 8000
+MAX_SAMPLE_RATE = 48000
+MAX_MESSAGE_SECONDS = 10
+
+DEFAULT_CONFIG = {
+    'engine': 'auto',  # 'rvc', 'stand_in', or 'auto' (RVC when its model is available)
+    'chunk_seconds': 0.5,
+    'context_seconds': 0.5,
+    'crossfade_seconds': 0.05,
+    'max_sessions': 4,  # per web process; more are refused with close code 1013
+    'f0_method': 'rmvpe',
+    'stand_in_compute_factor': 0.0,  # seconds the stand-in engine sleeps per second of audio
+}
+
+_sessions = 0
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_config() -> dict:
+    config = dict(DEFAULT_CONFIG)
+    config.update(getattr(settings, 'STREAMING_CONVERSION', {}))
+    return config
+
+
+class StandInEngine:
+    """
+    Returns its input unchanged, optionally after sleeping to mimic model compute
+
+    Lets the streaming path (chunking, crossfades, latency accounting) be
+    exercised without the RVC weights; a passthrough stream comes back as
+    the input delayed by exactly one crossfade.
+    """
+    name = 'stand_in'
+
+    def __init__(self, compute_factor: float = 0.0):
+        self.compute_factor = compute_factor
+
+    def convert(self, audio: 'np.ndarray', sample_rate: int, **params) -> 'np.ndarray':
+        if self.compute_factor:
+            time.sleep(len(audio) / sample_rate * self.compute_factor)
+        return audio.copy()
+
+
+class RVCEngine:
+    """
+    Converts audio segments with the preloaded RVC model
+
+    RVC converts files, so each segment goes through a temporary WAV. The
+    model is loaded once per process (or held by the inference server),
+    and conversions are serialized on it.
+    """
+    name = 'rvc'
+
+    def __init__(self, model_path: str, f0_method: str = 'rmvpe'):
+        from .rvc_integration import rvc_cloner
+
+        if model_path != rvc_cloner.current_model and not rvc_cloner.load_model(model_path):
+            raise RuntimeError(f"Failed to load model {model_path}")
+        self.cloner = rvc_cloner
+        self.model_path = model_path
+        self.f0_method = f0_method
+        self._lock = threading.Lock()
+
+    def convert(self, audio: 'np.ndarray', sample_rate: int, **params) -> 'np.ndarray':
+        import librosa
+        import soundfile as sf
+
+        rvc_params = {'sid': 0, 'f0_up_key': params.get('f0_up_key', 0), 'f0_method': self.f0_method,
+                      'index_file': None, 'index_rate': 0, 'filter_radius': 3, 'resample_sr': 0,
+                      'rms_mix_rate': 0.25, 'protect': 0.33}
+        with self._lock, tempfile.TemporaryDirectory() as tmp_dir:
+            input_path = os.path.join(tmp_dir, 'segment.wav')
+            sf.write(input_path, audio, sample_rate)
+            tgt_sr, audio_opt, _, error = self.cloner.run_inference(input_path, rvc_params)
+        if error:
+            raise RuntimeError(f"RVC inference failed: {error}")
+
+        converted = np.asarray(audio_opt)
+        if np.issubdtype(converted.dtype, np.integer):
+            converted = converted.astype(np.float32) / 32768.0
+        converted = librosa.resample(converted.astype(np.float32), orig_sr=tgt_sr, target_sr=sample_rate)
+        return librosa.util.fix_length(converted, size=len(audio))
+
+
+def get_engine():
+    """Return this process's conversion engine, loading the model on first use"""
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            from .rvc_integration import RVC_AVAILABLE, default_model_path
+
+            config = get_config()
+            model_path = default_model_path()
+            use_rvc = config['engine'] == 'rvc' or (
+                config['engine'] == 'auto' and RVC_AVAILABLE and os.path.exists(model_path))
+            if use_rvc:
+                _engine = RVCEngine(model_path, config['f0_method'])
+            else:
+                _engine = StandInEngine(config['stand_in_compute_factor'])
+            logger.info(f"Streaming conversion engine: {_engine.name}")
+        return _engine
+
+
+class StreamingConverter:
+    """
+    Turns a stream of input samples into converted chunks
+
+    Every ``chunk`` new samples are converted along with the ``context``
+    samples before them. The first ``crossfade`` samples emitted for a
+    chunk blend the tail held back from the previous chunk with the same
+    span as converted in this one, so there are no seams where the model's
+    output for neighbouring segments differs.
+    """
+
+    def __init__(self, engine, sample_rate: int, chunk_seconds: float, context_seconds: float,
+                 crossfade_seconds: float, **params):
+        self.engine = engine
+        self.sample_rate = sample_rate
+        self.params = params
+        self.chunk = max(int(chunk_seconds * sample_rate), 1)
+        self.fade = min(int(crossfade_seconds * sample_rate), self.chunk)
+        self.context = max(int(context_seconds * sample_rate), self.fade)
+
+        self.history = np.zeros(self.context, dtype=np.float32)
+        self.pending = np.zeros(0, dtype=np.float32)
+        self.tail = np.zeros(self.fade, dtype=np.float32)
+        self.fade_in = np.linspace(0, 1, self.fade + 2, dtype=np.float32)[1:-1]
+        self.fade_out = 1 - self.fade_in
+
+        self.latencies: List[float] = []
+        self.compute_seconds = 0.0
+        self.input_samples = 0
+
+    @property
+    def algorithmic_latency(self) -> float:
+        """Seconds output lags input before any conversion time"""
+        return (self.chunk + self.fade) / self.sample_rate
+
+    def _convert_chunk(self, chunk: 'np.ndarray') -> 'np.ndarray':
+        window = np.concatenate([self.history, chunk])
+        start = time.perf_counter()
+        converted = self.engine.convert(window, self.sample_rate, **self.params).astype(np.float32)
+        self.compute_seconds += time.perf_counter() - start
+        self.history = window[-self.context:]
+
+        body = converted[self.context - self.fade:]
+        out = body[:self.chunk].copy()
+        out[:self.fade] = self.tail * self.fade_out + body[:self.fade] * self.fade_in
+        self.tail = body[self.chunk:self.chunk + self.fade]
+        return out
+
+    def feed(self, samples: 'np.ndarray') -> List['np.ndarray']:
+        """Add input samples and return the chunks that became ready"""
+        self.input_samples += len(samples)
+        self.pending = np.concatenate([self.pending, samples.astype(np.float32)])
+        ready = []
+        while len(self.pending) >= self.chunk:
+            chunk, self.pending = self.pending[:self.chunk], self.pending[self.chunk:]
+            ready.append(self._convert_chunk(chunk))
+        return ready
+
+    def flush(self) -> 'np.ndarray':
+        """Convert the remaining input and return everything not yet emitted"""
+        remaining = len(self.pending)
+        if remaining:
+            out = self._convert_chunk(np.pad(self.pending, (0, self.chunk - remaining)))
+            self.pending = np.zeros(0, dtype=np.float32)
+            # The held-back tail covers the first fade samples of the padding
+            out = np.concatenate([out, self.tail])[:remaining + self.fade]
+            self.tail = np.zeros(self.fade, dtype=np.float32)
+            return out
+        out, self.tail = self.tail, np.zeros(self.fade, dtype=np.float32)
+        return out
+
+    def summary(self) -> dict:
+        audio_seconds = self.input_samples / self.sample_rate
+        latencies = sorted(self.latencies)
+        return {
+            'type': 'summary',
+            'engine': self.engine.name,
+            'chunks': len(latencies),
+            'audio_seconds': round(audio_seconds, 3),
+            'algorithmic_latency_ms': round(self.algorithmic_latency * 1000, 1),
+            'latency_ms_p50': round(statistics.median(latencies) * 1000, 1) if latencies else None,
+            'latency_ms_p95': round(latencies[int(0.95 * (len(latencies) - 1))] * 1000, 1) if latencies else None,
+            'rtf': round(self.compute_seconds / audio_seconds, 3) if audio_seconds else None,
+        }
+
+
+def _parse_params(scope) -> dict:
+    query = parse_qs(scope.get('query_string', b'').decode())
+    sample_rate = int(query.get('sample_rate', ['16000'])[0])
+    if not MIN_SAMPLE_RATE <= sample_rate <= MAX_SAMPLE_RATE:
+        raise ValueError(f"sample_rate must be between {MIN_SAMPLE_RATE} and {MAX_SAMPLE_RATE}")
+    return {'sample_rate': sample_rate, 'f0_up_key': int(query.get('f0_up_key', ['0'])[0])}
+
+
+async def websocket_application(scope, receive, send):
+    """ASGI application for WebSocket connections"""
+    global _sessions
+    event = await receive()
+    if event['type'] != 'websocket.connect':
+        return
+    if scope['path'] != STREAM_PATH or not STREAMING_AVAILABLE:
+        # Closing before accepting rejects the handshake with a 403
+        await send({'type': 'websocket.close', 'code': 1008})
+        return
+
+    config = get_config()
+    try:
+        params = _parse_params(scope)
+    except ValueError:
+        await send({'type': 'websocket.close', 'code': 1008})
+        return
+    if _sessions >= config['max_sessions']:
+        await send({'type': 'websocket.close', 'code': 1013})
+        return
+
+    _sessions += 1
+    converter = None
+    try:
+        engine = await asyncio.to_thread(get_engine)
+        converter = StreamingConverter(engine, params['sample_rate'], config['chunk_seconds'],
+                                       config['context_seconds'], config['crossfade_seconds'],
+                                       f0_up_key=params['f0_up_key'])
+        await send({'type': 'websocket.accept'})
+        await _serve(converter, receive, send)
+    except Exception as e:
+        logger.error(f"Streaming conversion failed: {str(e)}")
+        await send({'type': 'websocket.close', 'code': 1011})
+    finally:
+        _sessions -= 1
+        if converter is not None:
+            # Redis calls block, so they stay off the event loop
+            await asyncio.to_thread(_record_session, converter)
+
+
+def _record_session(converter: StreamingConverter) -> None:
+    metrics.incr('stream_sessions')
+    metrics.incr('stream_chunks', len(converter.latencies))
+    for latency in converter.latencies[-metrics.LATENCY_SAMPLES:]:
+        metrics.record_latency('stream_chunk', latency)
+
+
+async def _send_chunk(send, converter: StreamingConverter, chunk: 'np.ndarray', received_at: float) -> None:
+    await send({'type': 'websocket.send', 'bytes': chunk.astype('<f4').tobytes()})
+    latency = time.perf_counter() - received_at
+    converter.latencies.append(latency)
+    await send({'type': 'websocket.send', 'text': json.dumps({
+        'type': 'chunk',
+        'seq': len(converter.latencies),
+        'samples': len(chunk),
+        'latency_ms': round(latency * 1000, 1),
+        'rtf': round(latency * converter.sample_rate / max(len(chunk), 1), 3),
+    })})
+
+
+async def _serve(converter: StreamingConverter, receive, send) -> None:
+    max_bytes = MAX_MESSAGE_SECONDS * converter.sample_rate * 4
+    while True:
+        event = await receive()
+        if event['type'] == 'websocket.disconnect':
+            return
+
+        if event.get('bytes') is not None:
+            data = event['bytes']
+            if len(data) > max_bytes or len(data) % 4:
+                await send({'type': 'websocket.close', 'code': 1009})
+                return
+            received_at = time.perf_counter()
+            # Conversion is CPU bound; keep the event loop serving other sockets
+            chunks = await asyncio.to_thread(converter.feed, np.frombuffer(data, dtype='<f4'))
+            for chunk in chunks:
+                await _send_chunk(send, converter, chunk, received_at)
+            continue
+
+        try:
+            message = json.loads(event.get('text') or '{}')
+        except ValueError:
+            message = {}
+        if message.get('type') == 'flush':
+            received_at = time.perf_counter()
+            rest = await asyncio.to_thread(converter.flush)
+            if len(rest):
+                await _send_chunk(send, converter, rest, received_at)
+            await send({'type': 'websocket.send', 'text': json.dumps(converter.summary())})
+        elif message.get('type') == 'stats':
+            await send({'type': 'websocket.send', 'text': json.dumps(converter.summary())})
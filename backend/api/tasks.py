@@ -1,81 +1,215 @@
 import os
 import logging
 import shutil
+import tempfile
+import time
+import uuid
 from celery import shared_task
+from celery.exceptions import SoftTimeLimitExceeded
 from django.conf import settings
-from .models import Job
-from .rvc_integration import rvc_cloner
+from django.db.models import F
+from django.utils import timezone
+from .models import Job, SongUpload
+from .checkpoints import StageManifest
+from .voice_profile import file_sha256
+from . import stem_cache, fingerprint, storage_lifecycle
+from .exceptions import AttemptInterrupted, JobCancelled
+from .rvc_integration import rvc_cloner, default_model_path
+from .quality import TIER_ORDER, downgrade_tier, get_tier
+from .load_shedding import LoadSheddingController
+from . import metrics
 
 logger = logging.getLogger(__name__)
 
-@shared_task
-def process_voice_clone(job_id):
+
+def get_work_root() -> str:
+    """Directory holding the per-job work directories"""
+    return getattr(settings, 'JOB_WORK_ROOT', os.path.join(settings.MEDIA_ROOT, 'processing'))
+
+
+def get_work_dir(job_id) -> str:
+    """Work directory for a job's intermediate files and checkpoints"""
+    return os.path.join(get_work_root(), str(job_id))
+
+
+def reusable_stem_keys(song_sha256: str, tier_name: str) -> list:
+    """
+    Stem cache keys a job at ``tier_name`` can take its stems from
+    
+    Its own tier's key first, then those of the better tiers, so a job
+    downgraded by load shedding still reuses stems separated at the tier
+    it was submitted (or its song uploaded) with.
+    """
+    keys = []
+    for name in TIER_ORDER[TIER_ORDER.index(tier_name):]:
+        tier = get_tier(name)
+        key = stem_cache.stem_key(song_sha256, tier['separation_model'], tier['separation_overlap'])
+        if key not in keys:
+            keys.append(key)
+    return keys
+
+
+@shared_task(bind=True, acks_late=True, reject_on_worker_lost=True,
+             max_retries=getattr(settings, 'JOB_MAX_RETRIES', 2), default_retry_delay=30)
+def process_voice_clone(self, job_id):
     """
     Process the voice cloning job in the background using RVC
     
+    The task is idempotent: every finished stage is checkpointed in the
+    job's work dir, and a retry skips the stages that already completed.
+    Each attempt claims the job once (``Job.attempts``). A message
+    redelivered after its attempt started (the worker crashed or was
+    OOM-killed, ``acks_late``) does not run the pipeline again; it counts
+    as a failed attempt, so the job resumes through a retry and a song
+    that keeps killing workers fails once the retries run out.
+    
     This task:
     1. Updates job status to 'processing'
     2. Separates the song into vocals and instrumental using UVR5
-    3. Clones the vocals to the uploaded voice using RVC
-    4. Mixes the cloned vocals with the instrumental
-    5. Saves the result file to the job
+    3. Builds (or reuses) a FAISS retrieval index from the uploaded voice
+    4. Clones the vocals to the uploaded voice using RVC
+    5. Mixes the cloned vocals with the instrumental
+    6. Saves the result file to the job
+    
+    Stems already in the stem cache (separated ahead of the job from a
+    song upload, or by an earlier job on the same song) replace step 2; a
+    separation of the same song still running elsewhere is waited for.
     """
+    stem_lock = None
     try:
         # Get the job object
         job = Job.objects.get(pk=job_id)
+        if job.status in ('completed', 'cancelled'):
+            logger.info(f"Job {job_id} already {job.status}, skipping")
+            return
         
-        # Update status to processing
-        job.status = 'processing'
-        job.save(update_fields=['status', 'updated_at'])
+        def is_cancelled():
+            return Job.objects.filter(pk=job_id, status='cancelled').exists()
+        
+        # Update status to processing, unless the job was cancelled meanwhile
+        # or this attempt was already started by an earlier delivery
+        attempt = self.request.retries
+        started = Job.objects.filter(pk=job_id, status__in=['queued', 'processing'], attempts=attempt).update(
+            status='processing', attempts=F('attempts') + 1, updated_at=timezone.now())
+        job.refresh_from_db()
+        if not started:
+            if job.status == 'processing' and job.attempts == attempt + 1:
+                metrics.incr('jobs_redelivered')
+                raise AttemptInterrupted(f"Attempt {attempt + 1} was interrupted")
+            logger.info(f"Job {job_id} is no longer queued for attempt {attempt + 1}, skipping")
+            return
         
         # Get file paths
         song_path = job.song_file.path
         voice_path = job.voice_file.path
         
         # Create directory for intermediate files
-        base_dir = os.path.dirname(song_path)
-        work_dir = os.path.join(base_dir, 'processing', str(job.id))
+        work_dir = get_work_dir(job.id)
         os.makedirs(work_dir, exist_ok=True)
+        manifest = StageManifest(work_dir)
         
         # Final output path
         output_path = os.path.join(work_dir, 'output.wav')
         
         # Get RVC model path from settings
-        model_path = getattr(settings, 'RVC_MODEL_PATH', 
-                           os.path.join(settings.BASE_DIR, 'models', 'rvc_model.pth'))
+        model_path = default_model_path()
+        
+        # Pick the tier to run at, downgrading if the queue is backed up. A
+        # retried job keeps the tier of its first attempt so its checkpoints
+        # stay valid.
+        if not job.effective_tier:
+            effective_tier, downgrade_reason = LoadSheddingController().select_tier(job.quality_tier)
+            job.effective_tier = effective_tier
+            job.downgrade_reason = downgrade_reason
+            job.save(update_fields=['effective_tier', 'downgrade_reason', 'updated_at'])
+            if downgrade_reason:
+                logger.warning(f"Job {job_id}: {downgrade_reason}")
+        tier = get_tier(job.effective_tier)
         
-        logger.info(f"Starting voice cloning for job {job_id}")
+        # Reuse cached stems, or claim the separation so a speculative run of
+        # the same song waits for this one instead of duplicating it
+        separation_params = {'model': tier['separation_model'], 'overlap': tier['separation_overlap']}
+        song_sha256 = job.song_upload.sha256 if job.song_upload and job.song_upload.sha256 else file_sha256(song_path)
+        if job.song_sha256 != song_sha256:
+            # The storage lifecycle keeps the stems of active jobs' songs
+            job.song_sha256 = song_sha256
+            job.save(update_fields=['song_sha256', 'updated_at'])
+        stem_key = stem_cache.stem_key(song_sha256, tier['separation_model'], tier['separation_overlap'])
+        if not manifest.completed('separation', separation_params):
+            keys = reusable_stem_keys(song_sha256, tier['name'])
+            stems = next(filter(None, map(stem_cache.lookup, keys)), None)
+            for key in keys:
+                if stems:
+                    break
+                # Returns right away unless that separation is still running
+                stems = stem_cache.wait(key, cancel_check=is_cancelled)
+            if stems:
+                logger.info(f"Using cached stems for job {job_id}")
+                manifest.mark_completed('separation', stem_cache.copy_into(stems, work_dir), separation_params)
+                metrics.incr('stem_cache_hits')
+            else:
+                metrics.incr('stem_cache_misses')
+                # A re-encoded or trimmed copy of a song separated before
+                aligned = fingerprint.find_reusable_stems(song_path, song_sha256, tier['separation_model'],
+                                                          tier['separation_overlap'], work_dir)
+                if aligned:
+                    manifest.mark_completed('separation', aligned, separation_params)
+                    stem_cache.store(stem_key, aligned)
+                elif stem_cache.acquire(stem_key):
+                    stem_lock = stem_key
+        
+        logger.info(f"Starting voice cloning for job {job_id} ({tier['name']} tier)")
         logger.info(f"Song: {song_path}")
         logger.info(f"Voice sample: {voice_path}")
         logger.info(f"Model: {model_path}")
         
         # Process using RVC pipeline
-        success = rvc_cloner.process_full_pipeline(
-            song_path=song_path,
-            voice_sample_path=voice_path,
-            output_path=output_path,
-            work_dir=work_dir,
-            model_path=model_path
-        )
+        with metrics.stage_timer('pipeline'):
+            success = rvc_cloner.process_full_pipeline(
+                song_path=song_path,
+                voice_sample_path=voice_path,
+                output_path=output_path,
+                work_dir=work_dir,
+                model_path=model_path,
+                separation_model=tier['separation_model'],
+                separation_overlap=tier['separation_overlap'],
+                f0_method=tier['f0_method'],
+                manifest=manifest,
+                cancel_check=is_cancelled
+            )
         
         if not success:
             raise Exception("RVC processing pipeline failed")
         
+        if stem_lock:
+            stems = manifest.completed('separation', separation_params)
+            if stems and stem_cache.store(stem_lock, stems):
+                fingerprint.index_song(song_path, song_sha256)
+        
         # Convert to MP3 for final output
-        final_output_path = os.path.join(work_dir, 'output.mp3')
+        encoding_params = {'bitrate': tier['bitrate']}
+        done = manifest.completed('encoding', encoding_params)
+        if done:
+            final_output_path = done['result']
+        else:
+            final_output_path = os.path.join(work_dir, 'output.mp3')
+            
+            # Use ffmpeg for conversion (you may need to install ffmpeg)
+            import subprocess
+            try:
+                subprocess.run([
+                    'ffmpeg', '-i', output_path, 
+                    '-codec:a', 'mp3', '-b:a', tier['bitrate'],
+                    final_output_path, '-y'
+                ], check=True, capture_output=True)
+            except subprocess.CalledProcessError:
+                # Fallback: just rename if ffmpeg fails
+                logger.warning("FFmpeg conversion failed, using original format")
+                final_output_path = output_path
+            manifest.mark_completed('encoding', {'result': final_output_path}, encoding_params)
         
-        # Use ffmpeg for conversion (you may need to install ffmpeg)
-        import subprocess
-        try:
-            subprocess.run([
-                'ffmpeg', '-i', output_path, 
-                '-codec:a', 'mp3', '-b:a', '192k',
-                final_output_path, '-y'
-            ], check=True, capture_output=True)
-        except subprocess.CalledProcessError:
-            # Fallback: just rename if ffmpeg fails
-            logger.warning("FFmpeg conversion failed, using original format")
-            final_output_path = output_path
+        if is_cancelled():
+            raise JobCancelled()
         
         # Save the result file to the job
         with open(final_output_path, 'rb') as f:
@@ -86,6 +220,7 @@ def process_voice_clone(job_id):
         job.save()
         
         logger.info(f"Voice cloning completed successfully for job {job_id}")
+        metrics.incr('jobs_completed')
         
         # Clean up intermediate files
         try:
@@ -93,8 +228,30 @@ def process_voice_clone(job_id):
         except Exception as e:
             logger.warning(f"Failed to clean up work directory: {e}")
         
+    except JobCancelled:
+        logger.info(f"Job {job_id} cancelled, stopping")
+        metrics.incr('jobs_cancelled')
+        shutil.rmtree(get_work_dir(job_id), ignore_errors=True)
+        return
+        
+    except SoftTimeLimitExceeded:
+        # A retry would hit the same limit; fail right away
+        logger.error(f"Job {job_id} exceeded its time limit")
+        Job.objects.filter(pk=job_id).update(status='failed', error_message="Processing time limit exceeded",
+                                             updated_at=timezone.now())
+        metrics.incr('jobs_timed_out')
+        shutil.rmtree(get_work_dir(job_id), ignore_errors=True)
+        raise
+        
     except Exception as e:
-        # If any exception occurs, update job status to failed
+        # Retry while attempts remain; completed stages are kept in the work
+        # dir and skipped on the next run
+        if self.request.retries < self.max_retries:
+            logger.warning(f"Job {job_id} failed (attempt {self.request.retries + 1}), retrying: {e}")
+            metrics.incr('jobs_retried')
+            raise self.retry(exc=e)
+        
+        # Out of retries: update job status to failed
         try:
             job = Job.objects.get(pk=job_id)
             job.status = 'failed'
@@ -102,6 +259,121 @@ def process_voice_clone(job_id):
             job.save(update_fields=['status', 'error_message', 'updated_at'])
         except:
             pass
+        metrics.incr('jobs_failed')
+        
+        # Nothing will resume from the checkpoints any more
+        shutil.rmtree(get_work_dir(job_id), ignore_errors=True)
         
         # Re-raise the exception for Celery to log
         raise
+        
+    finally:
+        if stem_lock:
+            stem_cache.release(stem_lock)
+
+
+@shared_task(acks_late=True)
+def separate_song_upload(upload_id):
+    """
+    Separate an uploaded song into the stem cache ahead of its job
+    
+    Runs on the low-priority separation queue while the user is still
+    recording or uploading their voice. If a job on the same song is
+    already separating it, this waits for that run instead. The song is
+    separated at the tier its job would run at now, after any load
+    shedding downgrade.
+    """
+    upload = SongUpload.objects.filter(pk=upload_id).first()
+    if upload is None:
+        return
+    
+    tier = get_tier(downgrade_tier(upload.quality_tier, LoadSheddingController().current_level()))
+    key = stem_cache.stem_key(upload.sha256, tier['separation_model'], tier['separation_overlap'])
+    
+    if stem_cache.lookup(key) is None:
+        if not stem_cache.acquire(key):
+            stem_cache.wait(key)
+        else:
+            SongUpload.objects.filter(pk=upload_id).update(separation_status='processing',
+                                                           updated_at=timezone.now())
+            os.makedirs(get_work_root(), exist_ok=True)
+            tmp_dir = tempfile.mkdtemp(dir=get_work_root(), prefix=f"song-{upload_id}-")
+            try:
+                aligned = fingerprint.find_reusable_stems(upload.song_file.path, upload.sha256,
+                                                          tier['separation_model'],
+                                                          tier['separation_overlap'], tmp_dir)
+                if aligned:
+                    stem_cache.store(key, aligned)
+                else:
+                    with metrics.stage_timer('speculative_separation'):
+                        vocals_path, instrumental_path = rvc_cloner.separate_vocals(
+                            upload.song_file.path, tmp_dir,
+                            model_name=tier['separation_model'],
+                            overlap=tier['separation_overlap'])
+                    if vocals_path and instrumental_path and stem_cache.store(
+                            key, {'vocals': vocals_path, 'instrumental': instrumental_path}):
+                        fingerprint.index_song(upload.song_file.path, upload.sha256)
+            finally:
+                stem_cache.release(key)
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+    
+    separation_status = 'ready' if stem_cache.lookup(key) else 'failed'
+    SongUpload.objects.filter(pk=upload_id).update(separation_status=separation_status,
+                                                   updated_at=timezone.now())
+    metrics.incr(f"speculative_separation_{separation_status}")
+    logger.info(f"Speculative separation of song upload {upload_id}: {separation_status}")
+
+
+@shared_task
+def sweep_orphaned_work_dirs():
+    """
+    Remove work directories no running or retrying job will use again
+    
+    A directory is removed when its job no longer exists or has finished,
+    and it has not been touched for ``WORK_DIR_GRACE_SECONDS`` (so a job
+    that just failed over to a retry is left alone).
+    """
+    work_root = get_work_root()
+    if not os.path.isdir(work_root):
+        return 0
+    
+    grace = getattr(settings, 'WORK_DIR_GRACE_SECONDS', 3600)
+    removed = 0
+    for name in os.listdir(work_root):
+        path = os.path.join(work_root, name)
+        if not os.path.isdir(path) or time.time() - os.path.getmtime(path) < grace:
+            continue
+        
+        job = Job.objects.filter(pk=name).only('status').first() if _is_uuid(name) else None
+        if job is not None and job.status in ('queued', 'processing'):
+            continue
+        
+        shutil.rmtree(path, ignore_errors=True)
+        removed += 1
+        logger.info(f"Removed orphaned work directory: {path}")
+    
+    return removed
+
+
+@shared_task
+def sweep_storage():
+    """
+    Apply the storage retention periods and disk budget (``STORAGE_LIFECYCLE``)
+    
+    Returns the number of bytes reclaimed.
+    """
+    report = storage_lifecycle.sweep()
+    metrics.incr('storage_reclaimed_bytes', report['reclaimed_bytes'])
+    removed = {category: r['entries'] for category, r in report['removed'].items() if r['entries']}
+    logger.info(f"Storage sweep reclaimed {report['reclaimed_bytes']} bytes (removed {removed or 'nothing'})")
+    if report['over_budget']:
+        logger.warning("Storage still over the disk budget; everything left is in use or recently used")
+    return report['reclaimed_bytes']
+
+
+def _is_uuid(value: str) -> bool:
+    try:
+        uuid.UUID(value)
+        return True
+    except ValueError:
+        return False
@@ -1,3 +1,872 @@
-from django.test import TestCase
+import asyncio
+import hashlib
+import io
+import json
+import os
+import shutil
+import sqlite3
+import subprocess
+import socket
+import sys
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+import soundfile as sf
+from celery.exceptions import Retry, SoftTimeLimitExceeded
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+
+import model_provisioning
+
+from . import (autoscale, chunked_separation, fingerprint, inference_server, load_shedding, rvc_integration,
+               stem_cache, storage_lifecycle, streaming)
+from .checkpoints import StageManifest
+from .exceptions import AttemptInterrupted
+from .models import Job
+from .quality import get_tier
+from .tasks import process_voice_clone, reusable_stem_keys
+from .throttling import BACKLOG_CACHE_KEY, TOKEN_BUCKET_SCRIPT, TOKEN_REFUND_SCRIPT
+
+
+def wav_bytes(seconds=1.0, sample_rate=16000):
+    buffer = io.BytesIO()
+    t = np.arange(int(seconds * sample_rate)) / sample_rate
+    sf.write(buffer, 0.1 * np.sin(2 * np.pi * 220 * t), sample_rate, format='WAV')
+    return buffer.getvalue()
+
+
+class MediaRootMixin:
+    """Runs each test against its own empty MEDIA_ROOT, work dirs and caches included"""
+
+    def setUp(self):
+        super().setUp()
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        settings_override = override_settings(MEDIA_ROOT=self.media_root,
+                                              JOB_WORK_ROOT=os.path.join(self.media_root, 'processing'),
+                                              STEM_CACHE_ROOT=os.path.join(self.media_root, 'stems'),
+                                              FINGERPRINT_DB=os.path.join(self.media_root, 'fingerprints.sqlite3'))
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def create_job(self, **fields):
+        return Job.objects.create(song_file=SimpleUploadedFile('song.wav', wav_bytes()),
+                                  voice_file=SimpleUploadedFile('voice.wav', wav_bytes()),
+                                  consent_accepted=True, **fields)
+
+
+class BulkStatusTests(TestCase):
+
+    @override_settings(BULK_STATUS_MAX_IDS=2)
+    def test_capped_pages_do_not_skip_jobs_with_the_same_timestamp(self):
+        jobs = [Job.objects.create(song_file='s.wav', voice_file='v.wav', client_id='app') for _ in range(5)]
+        Job.objects.update(updated_at=timezone.now())
+
+        seen, params = [], {'client_id': 'app'}
+        for _ in range(5):
+            payload = self.client.get('/api/jobs/status/', params).json()
+            seen += [job['id'] for job in payload['jobs']]
+            params = {'client_id': 'app', 'cursor': payload['next_cursor']}
+            if not payload['more']:
+                break
+
+        self.assertEqual(sorted(seen), sorted(str(job.id) for job in jobs))
+        # Nothing changed since, so the next incremental call is empty
+        self.assertEqual(self.client.get('/api/jobs/status/', params).json()['jobs'], [])
+
+
+@override_settings(UVR_SEPARATION_MODE='uvr')
+class JobListTests(TestCase):
+
+    def page_through(self, limit, **filters):
+        pages, params = [], dict(filters, limit=limit)
+        while True:
+            payload = self.client.get('/api/jobs/list/', params).json()
+            pages.append([job['id'] for job in payload['jobs']])
+            if not payload['next_cursor']:
+                return pages
+            params['cursor'] = payload['next_cursor']
+
+    def test_pages_have_no_duplicates_or_gaps_when_created_at_ties(self):
+        jobs = [Job.objects.create(song_file='s.wav', voice_file='v.wav') for _ in range(7)]
+        tied = timezone.now()
+        Job.objects.filter(pk__in=[job.pk for job in jobs[:5]]).update(created_at=tied)
+        Job.objects.filter(pk__in=[job.pk for job in jobs[5:]]).update(created_at=tied - timedelta(seconds=1))
+
+        pages = self.page_through(limit=2)
+        seen = [job_id for page in pages for job_id in page]
+        self.assertEqual([len(page) for page in pages], [2, 2, 2, 1])
+        self.assertEqual(len(seen), len(set(seen)))
+        self.assertEqual(set(seen), {str(job.id) for job in jobs})
+        # Newest first, ties broken by id descending
+        expected = Job.objects.order_by('-created_at', '-id').values_list('id', flat=True)
+        self.assertEqual(seen, [str(pk) for pk in expected])
+
+    def test_filters_apply_to_every_page(self):
+        for status in ('queued', 'failed', 'queued', 'completed', 'queued'):
+            Job.objects.create(song_file='s.wav', voice_file='v.wav', status=status)
+        seen = [job_id for page in self.page_through(limit=1, status='queued') for job_id in page]
+        self.assertEqual(len(seen), 3)
+
+    def test_limit_is_clamped_to_at_least_one(self):
+        Job.objects.create(song_file='s.wav', voice_file='v.wav')
+        self.assertEqual(len(self.client.get('/api/jobs/list/', {'limit': 0}).json()['jobs']), 1)
+
+
+class TimeLimitTests(MediaRootMixin, TestCase):
+
+    def test_soft_time_limit_in_a_stage_fails_the_job_without_retry(self):
+        job = self.create_job()
+        uvr = mock.Mock()
+        uvr.uvr_wrapper.side_effect = SoftTimeLimitExceeded()
+
+        with mock.patch.object(rvc_integration, 'RVC_AVAILABLE', True), \
+                mock.patch.object(rvc_integration.rvc_cloner, 'uvr', uvr), \
+                mock.patch.object(rvc_integration.rvc_cloner, 'load_model', return_value=True):
+            result = process_voice_clone.apply(args=[str(job.id)])
+
+        self.assertTrue(result.failed())
+        self.assertIsInstance(result.result, SoftTimeLimitExceeded)
+        # A retry would have run separation again
+        self.assertEqual(uvr.uvr_wrapper.call_count, 1)
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'failed')
+        self.assertEqual(job.error_message, "Processing time limit exceeded")
+
+
+class RedeliveryTests(MediaRootMixin, TestCase):
+    """A redelivered message never runs the pipeline of an attempt that already started"""
+
+    def run_delivery(self, job, retries=0):
+        with mock.patch.object(rvc_integration.rvc_cloner, 'process_full_pipeline') as pipeline, \
+                mock.patch.object(process_voice_clone, 'retry', side_effect=Retry()) as retry:
+            result = process_voice_clone.apply(args=[str(job.id)], retries=retries)
+        job.refresh_from_db()
+        return result, pipeline, retry
+
+    def test_redelivery_of_a_started_attempt_is_retried_instead(self):
+        job = self.create_job(status='processing', attempts=1)
+        result, pipeline, retry = self.run_delivery(job)
+
+        pipeline.assert_not_called()
+        retry.assert_called_once()
+        self.assertIsInstance(retry.call_args.kwargs['exc'], AttemptInterrupted)
+        self.assertEqual((job.status, job.attempts), ('processing', 1))
+
+    def test_redelivery_out_of_retries_fails_the_job(self):
+        job = self.create_job(status='processing', attempts=3)
+        result, pipeline, retry = self.run_delivery(job, retries=2)
+
+        self.assertTrue(result.failed())
+        pipeline.assert_not_called()
+        retry.assert_not_called()
+        self.assertEqual(job.status, 'failed')
+
+    def test_message_from_an_earlier_attempt_is_dropped(self):
+        job = self.create_job(status='processing', attempts=2)
+        result, pipeline, retry = self.run_delivery(job)
+
+        self.assertTrue(result.successful())
+        pipeline.assert_not_called()
+        retry.assert_not_called()
+        self.assertEqual((job.status, job.attempts), ('processing', 2))
+
+
+class RateLimiterMixin:
+    """Stands in for the Redis token bucket and records the scripts run on it"""
+
+    def setUp(self):
+        super().setUp()
+        self.redis = mock.Mock()
+        self.redis.eval.return_value = [1, '0']
+        patcher = mock.patch('api.metrics.get_redis', return_value=self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(cache.delete, BACKLOG_CACHE_KEY)
+
+    def scripts_run(self):
+        return [call.args[0] for call in self.redis.eval.call_args_list]
+
+
+class AdmissionTokenTests(RateLimiterMixin, TestCase):
+    """Uploads that are not admitted do not drain the client's token bucket"""
+
+    def test_backlog_rejection_takes_no_token(self):
+        cache.set(BACKLOG_CACHE_KEY, settings.JOB_ADMISSION['max_backlog_seconds'] + 1)
+        response = self.client.post('/api/upload/', {})
+        self.assertEqual(response.status_code, 429)
+        self.assertNotIn(TOKEN_BUCKET_SCRIPT, self.scripts_run())
+
+    def test_invalid_upload_refunds_token(self):
+        cache.set(BACKLOG_CACHE_KEY, 0)
+        response = self.client.post('/api/upload/', {})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.scripts_run(), [TOKEN_BUCKET_SCRIPT, TOKEN_REFUND_SCRIPT])
+        self.assertEqual(self.redis.eval.call_args_list[0].args[2],
+                         self.redis.eval.call_args_list[1].args[2])
+
+
+class TwoPhaseAdmissionTests(RateLimiterMixin, MediaRootMixin, TestCase):
+    """A song upload is admitted like a job and pays for the job created from it"""
+
+    def setUp(self):
+        super().setUp()
+        for task, task_id in (('process_voice_clone', 'job-task'), ('separate_song_upload', 'song-task')):
+            patcher = mock.patch(f'api.views.{task}.apply_async', return_value=mock.Mock(id=task_id))
+            setattr(self, task, patcher.start())
+            self.addCleanup(patcher.stop)
+
+    def upload_song(self):
+        return self.client.post('/api/upload/song/', {'song_file': SimpleUploadedFile('song.wav', wav_bytes())})
+
+    def create_job(self, song_upload):
+        return self.client.post('/api/upload/', {'song_upload': song_upload, 'consent_accepted': True,
+                                                 'voice_file': SimpleUploadedFile('voice.wav', wav_bytes())})
+
+    def test_two_phase_job_takes_one_token(self):
+        cache.set(BACKLOG_CACHE_KEY, 0)
+        song = self.upload_song()
+        self.assertEqual(song.status_code, 201)
+        self.assertEqual(self.scripts_run(), [TOKEN_BUCKET_SCRIPT])
+
+        self.assertEqual(self.create_job(song.json()['id']).status_code, 201)
+        self.assertEqual(self.scripts_run(), [TOKEN_BUCKET_SCRIPT])
+        # Another job on the same song is charged
+        self.assertEqual(self.create_job(song.json()['id']).status_code, 201)
+        self.assertEqual(self.scripts_run(), [TOKEN_BUCKET_SCRIPT, TOKEN_BUCKET_SCRIPT])
+
+    def test_song_upload_is_refused_over_backlog_budget(self):
+        cache.set(BACKLOG_CACHE_KEY, settings.JOB_ADMISSION['max_backlog_seconds'] + 1)
+        self.assertEqual(self.upload_song().status_code, 429)
+        self.separate_song_upload.assert_not_called()
+        self.assertEqual(self.scripts_run(), [])
+
+
+class StatusCacheTests(MediaRootMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+
+    def test_cached_status_is_dropped_once_the_result_file_is_gone(self):
+        job = self.create_job(status='completed')
+        job.result_file.save('output.mp3', ContentFile(b'mp3'))
+        self.assertIsNotNone(self.client.get(f'/api/job/{job.id}/').json()['result_url'])
+
+        # Removed by a sweeper whose cache delete does not reach this process
+        with mock.patch.object(storage_lifecycle.cache, 'delete_many'):
+            storage_lifecycle.remove({'category': 'outputs', 'path': job.result_file.path})
+
+        payload = self.client.get(f'/api/job/{job.id}/').json()
+        self.assertIsNone(payload['result_url'])
+        self.assertEqual(payload['error_message'], 'Result file expired')
+
+    def test_bulk_status_checks_cached_files_off_the_event_loop(self):
+        jobs = [self.create_job(status='completed') for _ in range(3)]
+        for job in jobs:
+            job.result_file.save('output.mp3', ContentFile(b'mp3'))
+            self.client.get(f'/api/job/{job.id}/')
+        ids = ','.join(str(job.id) for job in jobs)
+        with mock.patch.object(storage_lifecycle.cache, 'delete_many'):
+            storage_lifecycle.remove({'category': 'outputs', 'path': jobs[0].result_file.path})
+
+        storage = Job._meta.get_field('result_file').storage
+        exists = storage.exists
+        loops = []
+
+        def checked_exists(name):
+            try:
+                loops.append(asyncio.get_running_loop())
+            except RuntimeError:
+                loops.append(None)
+            return exists(name)
+
+        with mock.patch.object(storage, 'exists', side_effect=checked_exists):
+            payload = self.client.get('/api/jobs/status/', {'ids': ids}).json()
+
+        self.assertEqual(loops, [None] * 3)
+        result_urls = {job['id']: job.get('result_url') for job in payload['jobs']}
+        self.assertIsNone(result_urls[str(jobs[0].id)])
+        self.assertIsNotNone(result_urls[str(jobs[1].id)])
+
+
+class StorageLifecycleTests(MediaRootMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        lifecycle = {'retention_days': dict.fromkeys(storage_lifecycle.CATEGORIES), 'disk_budget_gb': 1e-9}
+        settings_override = override_settings(RVC_INDEX_ROOT=os.path.join(self.media_root, 'indices'),
+                                              STORAGE_LIFECYCLE=lifecycle)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def cache_stems(self, sha256: str) -> str:
+        """Cache stems for ``sha256``, last used two hours ago; returns the key"""
+        stems = {}
+        for name in stem_cache.STEM_NAMES:
+            stems[name] = os.path.join(self.media_root, f"{name}.wav")
+            Path(stems[name]).write_bytes(wav_bytes())
+        key = stem_cache.stem_key(sha256, 'model', 0.25)
+        entry = os.path.dirname(stem_cache.store(key, stems)['vocals'])
+        last_used = time.time() - 7200
+        os.utime(entry, (last_used, last_used))
+        return key
+
+    def test_stems_of_active_jobs_survive_the_disk_budget(self):
+        active_key = self.cache_stems('a' * 64)
+        idle_key = self.cache_stems('b' * 64)
+        self.create_job(status='processing', song_sha256='a' * 64)
+        self.create_job(status='completed', song_sha256='b' * 64)
+
+        report = storage_lifecycle.sweep()
+
+        self.assertEqual(report['removed']['stems']['entries'], 1)
+        self.assertIsNotNone(stem_cache.lookup(active_key))
+        self.assertIsNone(stem_cache.lookup(idle_key))
+
+    def test_stems_looked_up_since_the_scan_are_in_use(self):
+        key = self.cache_stems('c' * 64)
+        [entry] = storage_lifecycle.scan('stems')
+        self.assertFalse(storage_lifecycle._in_use(entry, set(), set()))
+
+        # A job about to copy the stems, or to align them after a fingerprint match
+        stem_cache.lookup(key)
+        self.assertTrue(storage_lifecycle._in_use(entry, set(), set()))
+
+
+class ReusableStemTests(SimpleTestCase):
+
+    def key(self, tier_name):
+        tier = get_tier(tier_name)
+        return stem_cache.stem_key('ab' * 32, tier['separation_model'], tier['separation_overlap'])
+
+    def test_downgraded_job_can_use_stems_of_better_tiers(self):
+        self.assertEqual(reusable_stem_keys('ab' * 32, 'draft'),
+                         [self.key('draft'), self.key('standard'), self.key('studio')])
+
+    def test_job_never_uses_stems_of_cheaper_tiers(self):
+        self.assertEqual(reusable_stem_keys('ab' * 32, 'studio'), [self.key('studio')])
+
+
+@override_settings(STREAMING_CONVERSION={'engine': 'stand_in', 'chunk_seconds': 0.5,
+                                         'context_seconds': 0.5, 'crossfade_seconds': 0.05})
+class StreamingConversionTests(SimpleTestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(streaming, '_engine', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def stream(self, messages, query=b'sample_rate=16000'):
+        """Run a WebSocket session sending ``messages``; returns the binary and text messages received"""
+        events = asyncio.Queue()
+        await events.put({'type': 'websocket.connect'})
+        for message in messages:
+            await events.put({'type': 'websocket.receive', **message})
+        await events.put({'type': 'websocket.disconnect', 'code': 1000})
+        sent = []
+
+        async def send(event):
+            sent.append(event)
+
+        scope = {'type': 'websocket', 'path': '/ws/convert/', 'query_string': query}
+        await streaming.websocket_application(scope, events.get, send)
+        self.assertEqual(sent[0]['type'], 'websocket.accept')
+        audio = [e['bytes'] for e in sent if e.get('bytes') is not None]
+        texts = [json.loads(e['text']) for e in sent if e.get('text') is not None]
+        return np.frombuffer(b''.join(audio), dtype='<f4'), texts
+
+    async def test_stand_in_stream_is_the_input_delayed_by_one_crossfade(self):
+        sample_rate, fade = 16000, 800
+        t = np.arange(int(1.3 * sample_rate)) / sample_rate
+        audio = (0.5 * np.sin(2 * np.pi * 220 * t)).astype('<f4')
+        messages = [{'bytes': audio[i:i + 3200].tobytes()} for i in range(0, len(audio), 3200)]
+        output, texts = await self.stream(messages + [{'text': json.dumps({'type': 'flush'})}])
+
+        expected = np.concatenate([np.zeros(fade, dtype=np.float32), audio])
+        self.assertEqual(len(output), len(expected))
+        np.testing.assert_allclose(output, expected, atol=1e-6)
+
+        chunks = [text for text in texts if text['type'] == 'chunk']
+        self.assertEqual(len(chunks), 3)  # two full chunks, then the flushed rest
+        summary = texts[-1]
+        self.assertEqual(summary['type'], 'summary')
+        self.assertEqual(summary['engine'], 'stand_in')
+        self.assertEqual(summary['chunks'], 3)
+        self.assertEqual(summary['audio_seconds'], 1.3)
+        self.assertEqual(summary['algorithmic_latency_ms'], 550.0)
+        self.assertIsNotNone(summary['latency_ms_p50'])
+        self.assertIsNotNone(summary['rtf'])
+
+    async def test_bad_sample_rate_is_refused(self):
+        events = asyncio.Queue()
+        await events.put({'type': 'websocket.connect'})
+        sent = []
+
+        async def send(event):
+            sent.append(event)
+
+        scope = {'type': 'websocket', 'path': '/ws/convert/', 'query_string': b'sample_rate=100'}
+        await streaming.websocket_application(scope, events.get, send)
+        self.assertEqual(sent, [{'type': 'websocket.close', 'code': 1008}])
+
+
+class ModelFileHandler(BaseHTTPRequestHandler):
+    """Serves ``server.payload`` with Range support; hangs up mid-body while ``server.drops`` > 0"""
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append(self.headers.get('Range'))
+        start = int(self.headers['Range'][len('bytes='):].rstrip('-')) if self.headers.get('Range') else 0
+        body = server.payload[start:]
+        self.send_response(206 if start else 200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if server.drops:
+            server.drops -= 1
+            self.wfile.write(body[:len(body) // 2])
+            self.wfile.flush()
+            self.connection.shutdown(2)
+            return
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ModelProvisioningTests(SimpleTestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), ModelFileHandler)
+        self.server.payload = np.random.default_rng(0).bytes(1024 * 1024)
+        self.server.requests = []
+        self.server.drops = 0
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+        self.tmp_dir = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.tmp_dir, ignore_errors=True)
+        self.sha256 = hashlib.sha256(self.server.payload).hexdigest()
+        # Skip the backoff between retries
+        patcher = mock.patch.object(model_provisioning.time, 'sleep')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def provisioner(self, sha256=None, **kwargs):
+        manifest = [{'name': 'model.onnx', 'url': f'http://127.0.0.1:{self.server.server_port}/model.onnx',
+                     'path': 'uvr5/model.onnx', 'sha256': sha256 or self.sha256}]
+        return model_provisioning.Provisioner(self.tmp_dir / 'models', manifest, **kwargs)
+
+    def test_dropped_download_resumes_with_a_range_request(self):
+        self.server.drops = 1
+        [result] = self.provisioner().provision()
+
+        self.assertEqual(result['status'], 'downloaded')
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertIsNone(self.server.requests[0])
+        resumed_from = int(self.server.requests[1][len('bytes='):].rstrip('-'))
+        self.assertGreater(resumed_from, 0)
+        # Only the missing part was fetched again
+        self.assertEqual(result['bytes'], len(self.server.payload))
+        self.assertEqual((self.tmp_dir / 'models/uvr5/model.onnx').read_bytes(), self.server.payload)
+
+    def test_checksum_mismatch_removes_the_part_file(self):
+        [result] = self.provisioner(sha256='0' * 64).provision()
+
+        self.assertEqual(result['status'], 'failed')
+        self.assertIn('SHA-256 mismatch', result['error'])
+        self.assertFalse((self.tmp_dir / 'models/uvr5/model.onnx').exists())
+        self.assertFalse((self.tmp_dir / 'models/uvr5/model.onnx.part').exists())
+
+    def test_mirror_hit_does_not_fetch(self):
+        mirrored = self.tmp_dir / 'mirror/uvr5/model.onnx'
+        mirrored.parent.mkdir(parents=True)
+        mirrored.write_bytes(self.server.payload)
+
+        [result] = self.provisioner(mirror_dir=self.tmp_dir / 'mirror').provision()
+
+        self.assertEqual(result['status'], 'mirror')
+        self.assertEqual(self.server.requests, [])
+        self.assertEqual((self.tmp_dir / 'models/uvr5/model.onnx').read_bytes(), self.server.payload)
+
+
+# Run in separate processes, each with its own connection, like Celery workers
+DB_WRITER = """
+import sys
+import django
+django.setup()
+from django.utils import timezone
+from api.models import Job
+
+if sys.argv[1] == 'create':
+    print(','.join(str(Job.objects.create(song_file='s.wav', voice_file='v.wav').pk)
+                   for _ in range(int(sys.argv[2]))))
+else:
+    updated = 0
+    for i in range(int(sys.argv[3])):
+        for pk in sys.argv[2].split(','):
+            updated += Job.objects.filter(pk=pk).update(status='processing', error_message=str(i),
+                                                        updated_at=timezone.now())
+    print(updated)
+"""
+
+
+class SQLiteConcurrencyTests(SimpleTestCase):
+
+    def run_writer(self, env, *args):
+        return subprocess.Popen([sys.executable, '-c', DB_WRITER, *map(str, args)], cwd=settings.BASE_DIR,
+                                env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+
+    def test_parallel_status_updates_all_succeed(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir, ignore_errors=True)
+        db_path = os.path.join(tmp_dir, 'db.sqlite3')
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE='music_voice_clone.settings',
+                   DATABASE_URL=f'sqlite:///{db_path}', SQLITE_BUSY_TIMEOUT='20')
+        subprocess.run([sys.executable, 'manage.py', 'migrate', '-v0'], cwd=settings.BASE_DIR,
+                       env=env, check=True, capture_output=True)
+        ids, _ = self.run_writer(env, 'create', 5).communicate()
+        ids = ids.strip()
+
+        workers, rounds = 8, 50
+        writers = [self.run_writer(env, 'update', ids, rounds) for _ in range(workers)]
+        for writer in writers:
+            out, err = writer.communicate(timeout=120)
+            self.assertEqual(writer.returncode, 0, err)
+            self.assertEqual(int(out), rounds * 5)
+
+        with sqlite3.connect(db_path) as conn:
+            self.assertEqual(conn.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+            self.assertEqual(conn.execute("SELECT COUNT(*) FROM api_job WHERE status = 'processing'").fetchone()[0], 5)
+
+
+class BatcherTests(SimpleTestCase):
+
+    def make_batcher(self, max_batch, max_wait, run_batch=None):
+        batches = []
+
+        def record(items):
+            batches.append(list(items))
+            return [item * 2 for item in items]
+
+        return inference_server.Batcher('test', run_batch or record, max_batch, max_wait), batches
+
+    def test_requests_are_grouped_up_to_max_batch(self):
+        batcher, batches = self.make_batcher(max_batch=2, max_wait=0.5)
+        futures = [batcher.submit(i) for i in range(5)]
+
+        self.assertEqual([future.result(timeout=5) for future in futures], [0, 2, 4, 6, 8])
+        self.assertEqual(batches, [[0, 1], [2, 3], [4]])
+
+    def test_partial_batch_runs_after_max_wait(self):
+        batcher, batches = self.make_batcher(max_batch=4, max_wait=0.05)
+        start = time.monotonic()
+        self.assertEqual(batcher.submit(3).result(timeout=5), 6)
+        self.assertGreaterEqual(time.monotonic() - start, 0.05)
+        self.assertEqual(batches, [[3]])
+
+    def test_batch_error_is_raised_by_every_future(self):
+        def fail(items):
+            raise ValueError("model failed")
+
+        batcher, _ = self.make_batcher(max_batch=2, max_wait=0.5, run_batch=fail)
+        futures = [batcher.submit(i) for i in range(2)]
+        for future in futures:
+            with self.assertRaisesRegex(ValueError, "model failed"):
+                future.result(timeout=5)
+
+
+class InferenceServerTests(SimpleTestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir, ignore_errors=True)
+        patcher = mock.patch.object(inference_server, '_client', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_stale_socket_falls_back_to_in_process(self):
+        path = os.path.join(self.tmp_dir, 'inference.sock')
+        # A server that died leaves its socket file behind
+        sock = socket.socket(socket.AF_UNIX)
+        sock.bind(path)
+        sock.close()
+
+        with override_settings(INFERENCE_SERVER={'socket': path, 'authkey': 'test'}):
+            self.assertTrue(os.path.exists(path))
+            self.assertIsNone(inference_server.get_client())
+            served, _ = rvc_integration.RVCVoiceCloner()._call_server('convert', None, 'in.wav', {})
+        self.assertFalse(served)
+
+    def test_conversions_run_concurrently_on_model_copies(self):
+        barrier = threading.Barrier(2, timeout=5)
+        created = []
+
+        class Cloner:
+            current_model = None
+
+            def __init__(self):
+                self.vc = self
+                created.append(self)
+
+            def vc_inference(self, input_audio_path=None, **params):
+                barrier.wait()
+                return input_audio_path
+
+        with mock.patch.object(inference_server, '_serving', False):
+            server = inference_server.InferenceServer(
+                address=os.path.join(self.tmp_dir, 'inference.sock'),
+                config=dict(inference_server.DEFAULT_CONFIG, authkey='test', rvc_copies=2))
+        server._new_cloner = Cloner
+
+        results = []
+        threads = [threading.Thread(target=lambda i=i: results.append(server.handle('convert', (None, i, {}))))
+                   for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # Each pair met at the barrier, which one model copy could not do
+        self.assertEqual(sorted(results), [0, 1, 2, 3])
+        self.assertEqual(len(created), 2)
+
+
+class AutoscaleTests(SimpleTestCase):
+
+    def make_controller(self, size, jobs=(), spare=16):
+        config = dict(autoscale.DEFAULT_CONFIG, queues={'voice_clone': {'min': 1, 'max': 4}})
+        redis_client = autoscale.InMemoryRedis()
+        redis_client.rpush('voice_clone', *jobs)
+        pools = autoscale.SimulatedPools(redis_client, {'voice_clone': size})
+        self.now = 0.0
+        controller = autoscale.AutoscaleController(pools, config, redis_client=redis_client,
+                                                   backlog_fn=pools.backlog, headroom_fn=lambda: spare,
+                                                   clock=lambda: self.now)
+        return controller, pools
+
+    def test_backlog_grows_the_pool_by_max_step_up_to_max(self):
+        controller, pools = self.make_controller(1, jobs=[600] * 10)
+        sizes = []
+        for _ in range(3):
+            controller.tick()
+            sizes.append(pools.sizes['voice_clone'])
+        self.assertEqual(sizes, [3, 4, 4])
+
+    def test_growth_is_limited_by_host_headroom(self):
+        controller, pools = self.make_controller(1, jobs=[600] * 10, spare=0)
+        controller.tick()
+        self.assertEqual(pools.sizes['voice_clone'], 1)
+
+    def test_pool_shrinks_only_after_the_cooldown(self):
+        controller, pools = self.make_controller(4)
+        sizes = []
+        for self.now in (0, 60, 119, 120, 121, 241):
+            controller.tick()
+            sizes.append(pools.sizes['voice_clone'])
+        # Each shrink restarts the cooldown
+        self.assertEqual(sizes, [4, 4, 4, 3, 3, 2])
+
+    def test_pool_never_shrinks_below_min(self):
+        controller, pools = self.make_controller(1)
+        for self.now in range(0, 1200, 120):
+            controller.tick()
+        self.assertEqual(pools.sizes['voice_clone'], 1)
+
+    def test_policy_clamps_to_bounds(self):
+        policy = autoscale.ScalingPolicy(autoscale.DEFAULT_CONFIG)
+        bounds = {'min': 2, 'max': 3}
+        self.assertEqual(policy.desired(bounds, current=2, depth=0, backlog_seconds=0, spare=8), 2)
+        self.assertEqual(policy.desired(bounds, current=3, depth=50, backlog_seconds=1e6, spare=8), 3)
+        # The minimum holds even without headroom
+        self.assertEqual(policy.desired(bounds, current=1, depth=0, backlog_seconds=0, spare=0), 2)
+
+
+class DictRedis:
+    """Just enough of a Redis client for keys read with get and written with set"""
+
+    def __init__(self):
+        self.values = {}
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def set(self, key, value):
+        self.values[key] = str(value).encode()
+
+
+class LoadSheddingTests(SimpleTestCase):
+
+    def setUp(self):
+        patcher = mock.patch('api.metrics.get_redis', return_value=DictRedis())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.controller = load_shedding.LoadSheddingController({'min_seconds_between_changes': 60})
+        self.now = 1000.0
+
+    def levels(self, signals, step=60):
+        """Feed (queue depth, stage latency) observations one interval apart and return the levels"""
+        levels = []
+        for depth, latency in signals:
+            self.now += step
+            with mock.patch.object(self.controller, 'observe',
+                                   return_value={'queue_depth': depth, 'stage_latency': latency}), \
+                    mock.patch('api.load_shedding.time.time', return_value=self.now):
+                levels.append(self.controller.update())
+        return levels
+
+    def test_level_steps_up_under_load_and_stops_at_max(self):
+        self.assertEqual(self.levels([(25, 0), (0, 700), (25, 700)]), [1, 2, 2])
+
+    def test_signals_between_thresholds_hold_the_level(self):
+        self.levels([(25, 0)])
+        # Depth hovering between low (5) and high (20) must not flap
+        self.assertEqual(self.levels([(6, 0), (19, 0), (10, 300), (6, 0)]), [1, 1, 1, 1])
+
+    def test_level_steps_down_only_when_both_signals_are_low(self):
+        self.levels([(25, 0), (25, 0)])
+        self.assertEqual(self.levels([(0, 300), (0, 200), (0, 200)]), [2, 1, 0])
+
+    def test_changes_are_rate_limited(self):
+        # One change per 60 s however the signals swing in between
+        self.assertEqual(self.levels([(25, 0), (25, 0), (0, 0), (0, 0)], step=20), [1, 1, 1, 0])
+
+
+class ScaledSeparator:
+    """Stands in for MDXSeparator: the "vocals" of a window are half of it"""
+
+    def __init__(self, model_name, client=None):
+        self.model_name = model_name
+
+    def demix(self, mix):
+        return 0.5 * mix
+
+
+class ChunkedSeparationTests(SimpleTestCase):
+
+    def test_crossfades_of_neighbouring_windows_sum_to_one(self):
+        for fade in (1, 7, 1000):
+            fade_out = chunked_separation._window_weights(3000, 0, fade)[-fade:]
+            fade_in = chunked_separation._window_weights(3000, fade, 0)[:fade]
+            np.testing.assert_allclose(fade_out + fade_in, 1.0, atol=1e-6)
+
+    @mock.patch.object(chunked_separation, 'supports_model', return_value=True)
+    @mock.patch.object(chunked_separation, 'MDXSeparator', ScaledSeparator)
+    def test_windows_overlap_add_back_to_the_whole_song(self, supports_model):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir, ignore_errors=True)
+        rate = chunked_separation.SAMPLE_RATE
+        mix = np.random.default_rng(0).uniform(-0.5, 0.5, (int(7.3 * rate), 2)).astype(np.float32)
+        paths = [os.path.join(tmp_dir, name) for name in ('song.wav', 'vocals.wav', 'instrumental.wav')]
+        sf.write(paths[0], mix, rate, subtype='FLOAT')
+
+        # 2 s windows overlapping by a quarter, the last one short
+        self.assertTrue(chunked_separation.separate_chunked(*paths, 'UVR_MDXNET_9482', overlap=0.25,
+                                                            window_seconds=2, workers=3))
+        vocals, _ = sf.read(paths[1], dtype='float32')
+        instrumental, _ = sf.read(paths[2], dtype='float32')
+        self.assertEqual(vocals.shape, mix.shape)
+        np.testing.assert_allclose(vocals, 0.5 * mix, atol=1e-4)
+        np.testing.assert_allclose(vocals + instrumental, mix, atol=1e-4)
+
+
+class StageManifestTests(SimpleTestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.work_dir, ignore_errors=True)
+        self.vocals = os.path.join(self.work_dir, 'vocals.wav')
+        Path(self.vocals).write_bytes(b'vocals')
+        StageManifest(self.work_dir).mark_completed('separation', {'vocals': self.vocals}, {'model': 'a'})
+
+    def test_retry_resumes_past_completed_stage(self):
+        manifest = StageManifest(self.work_dir)
+        self.assertEqual(manifest.completed('separation', {'model': 'a'}), {'vocals': self.vocals})
+        self.assertIsNone(manifest.completed('conversion'))
+
+    def test_changed_artifact_reruns_the_stage(self):
+        # Same size, different content: only the hash tells them apart
+        Path(self.vocals).write_bytes(b'VOCALS')
+        self.assertIsNone(StageManifest(self.work_dir).completed('separation', {'model': 'a'}))
+
+    def test_missing_artifact_or_other_params_rerun_the_stage(self):
+        self.assertIsNone(StageManifest(self.work_dir).completed('separation', {'model': 'b'}))
+        os.remove(self.vocals)
+        self.assertIsNone(StageManifest(self.work_dir).completed('separation', {'model': 'a'}))
+
+    def test_unreadable_manifest_starts_over(self):
+        Path(self.work_dir, 'manifest.json').write_text('{"stages": ')
+        self.assertEqual(StageManifest(self.work_dir).stages, {})
+
+
+def synthetic_song(seed, seconds=30.0, sample_rate=44100):
+    """Quarter-second decaying notes of random pitch over a little noise"""
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(0.25 * sample_rate)) / sample_rate
+    notes = []
+    for _ in range(int(seconds / 0.25)):
+        f0 = 110 * 2 ** (rng.integers(0, 36) / 12)
+        tone = sum(np.sin(2 * np.pi * f0 * k * t) / k for k in (1, 2, 3))
+        notes.append(np.exp(-6 * t) * tone + 0.02 * rng.standard_normal(len(t)))
+    return (0.3 * np.concatenate(notes)).astype(np.float32)
+
+
+class FingerprintTests(SimpleTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.tmp_dir = tempfile.mkdtemp()
+        cls.settings_override = override_settings(FINGERPRINT_DB=os.path.join(cls.tmp_dir, 'fingerprints.sqlite3'))
+        cls.settings_override.enable()
+        cls.song = synthetic_song(1)
+        sf.write(cls.path('song.wav'), cls.song, 44100)
+        fingerprint.index_song(cls.path('song.wav'), 'song')
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.settings_override.disable()
+        shutil.rmtree(cls.tmp_dir, ignore_errors=True)
+        super().tearDownClass()
+
+    @classmethod
+    def path(cls, name):
+        return os.path.join(cls.tmp_dir, name)
+
+    def lookup(self, name, **write_args):
+        audio = write_args.pop('audio')
+        sf.write(self.path(name), audio, 44100, **write_args)
+        hashes, _ = fingerprint.fingerprint_file(self.path(name), start=5, duration=15)
+        return fingerprint.match(hashes)
+
+    def test_trimmed_copy_matches_at_its_offset(self):
+        candidates = self.lookup('trimmed.wav', audio=self.song[int(3.3 * 44100):])
+        self.assertEqual([c['sha256'] for c in candidates], ['song'])
+        # Within one fingerprint hop
+        hop_seconds = fingerprint.HOP_LENGTH / fingerprint.FINGERPRINT_SR
+        self.assertAlmostEqual(candidates[0]['offset_seconds'], 3.3, delta=hop_seconds)
+
+    def test_reencoded_copy_matches(self):
+        candidates = self.lookup('reencoded.ogg', audio=0.8 * self.song, format='OGG', subtype='VORBIS')
+        self.assertEqual([c['sha256'] for c in candidates], ['song'])
+        self.assertAlmostEqual(candidates[0]['offset_seconds'], 0.0)
+
+    def test_unrelated_song_does_not_match(self):
+        self.assertEqual(self.lookup('other.wav', audio=synthetic_song(2)), [])
+
+    def test_refine_lag_finds_the_exact_sample(self):
+        lag = int(3.3 * 44100) + 123
+        query = self.song[lag:lag + 20 * 44100]
+        self.assertEqual(fingerprint.refine_lag(query, self.song, coarse=lag - 700), lag)
+        self.assertEqual(fingerprint.refine_lag(query, self.song, coarse=lag + 2000), lag)
@@ -0,0 +1,246 @@
+"""
+Admission control for job creation: per-client token buckets and a global backlog budget
+"""
+import logging
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import FloatField, Sum, Value
+from django.db.models.functions import Coalesce
+from rest_framework.exceptions import ValidationError
+from rest_framework.throttling import BaseThrottle
+
+from . import metrics
+from .models import Job, SongUpload
+from .quality import get_tier
+
+logger = logging.getLogger(__name__)
+
+# Refill and take tokens atomically. KEYS[1] = bucket hash,
+# ARGV = capacity, refill rate (tokens/s), now, cost.
+# Returns {allowed, seconds until enough tokens}.
+TOKEN_BUCKET_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local cost = tonumber(ARGV[4])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or capacity
+local ts = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+local allowed = 0
+local wait = 0
+if tokens >= cost then
+    tokens = tokens - cost
+    allowed = 1
+else
+    wait = (cost - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 60)
+return {allowed, tostring(wait)}
+"""
+
+# Give back tokens taken for a request that was not admitted.
+# KEYS[1] = bucket hash, ARGV = capacity, cost.
+TOKEN_REFUND_SCRIPT = """
+local tokens = tonumber(redis.call('HGET', KEYS[1], 'tokens'))
+if tokens then
+    redis.call('HSET', KEYS[1], 'tokens', math.min(tonumber(ARGV[1]), tokens + tonumber(ARGV[2])))
+end
+return 1
+"""
+
+BACKLOG_CACHE_KEY = 'admission:backlog_seconds'
+
+
+class TokenBucketThrottle(BaseThrottle):
+    """
+    Per-client token bucket kept in Redis
+
+    Each job costs one token; a client may burst up to ``capacity`` jobs
+    and then gets ``refill_per_hour`` more per hour. Clients are the
+    authenticated user when there is one, otherwise the remote address.
+    If Redis is unreachable requests are let through rather than failing.
+    The token taken for a request can be given back with ``refund``.
+    """
+
+    def __init__(self):
+        self.config = getattr(settings, 'JOB_RATE_LIMIT', {})
+        self.wait_seconds = None
+        self.charged_key = None
+
+    def get_client_key(self, request) -> str:
+        user = getattr(request, 'user', None)
+        if user is not None and user.is_authenticated:
+            return f"ratelimit:user:{user.pk}"
+        return f"ratelimit:ip:{self.get_ident(request)}"
+
+    def allow_request(self, request, view) -> bool:
+        client = metrics.get_redis()
+        if client is None:
+            return True
+
+        capacity = self.config.get('capacity', 10)
+        rate = self.config.get('refill_per_hour', 20) / 3600.0
+        key = self.get_client_key(request)
+        try:
+            allowed, wait = client.eval(TOKEN_BUCKET_SCRIPT, 1, key, capacity, rate, time.time(), 1)
+        except Exception as e:
+            logger.warning(f"Rate limiter unavailable, allowing request: {e}")
+            return True
+
+        if allowed:
+            self.charged_key = key
+            return True
+        self.wait_seconds = float(wait)
+        metrics.incr('jobs_rate_limited')
+        return False
+
+    def refund(self):
+        """Give back the token taken by ``allow_request``, if any"""
+        if self.charged_key is None:
+            return
+        key, self.charged_key = self.charged_key, None
+        client = metrics.get_redis()
+        if client is None:
+            return
+        try:
+            client.eval(TOKEN_REFUND_SCRIPT, 1, key, self.config.get('capacity', 10), 1)
+        except Exception as e:
+            logger.warning(f"Could not refund rate limit token: {e}")
+
+    def wait(self):
+        return self.wait_seconds
+
+
+class JobCreationThrottle(TokenBucketThrottle):
+    """
+    Token bucket for job creation that honours tokens taken at song upload
+
+    The first job created from a song upload (``song_upload``) was paid
+    for when the song was uploaded, so two-phase clients get the same job
+    quota as single-request ones. Later jobs reusing that song are charged.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.redeemed_upload = None
+
+    def allow_request(self, request, view) -> bool:
+        try:
+            upload_id = uuid.UUID(str(request.data.get('song_upload') or ''))
+        except ValueError:
+            upload_id = None
+        if upload_id and SongUpload.objects.filter(pk=upload_id, prepaid_job=True).update(prepaid_job=False):
+            self.redeemed_upload = upload_id
+            return True
+        return super().allow_request(request, view)
+
+    def refund(self):
+        if self.redeemed_upload is not None:
+            SongUpload.objects.filter(pk=self.redeemed_upload).update(prepaid_job=True)
+            self.redeemed_upload = None
+        super().refund()
+
+
+def backlog_by_tier() -> dict:
+    """
+    Estimate the compute seconds needed to finish queued and running jobs, per tier
+
+    Sums song duration x the tier's compute cost per audio second in a
+    single grouped query; jobs whose duration could not be probed count
+    with ``default_duration_seconds``.
+    """
+    config = getattr(settings, 'JOB_ADMISSION', {})
+    default_duration = float(config.get('default_duration_seconds', 240))
+    rows = (Job.objects.filter(status__in=['queued', 'processing'])
+            .values('quality_tier')
+            .annotate(audio_seconds=Sum(Coalesce('duration_seconds', Value(default_duration),
+                                                 output_field=FloatField()))))
+    backlog = {}
+    for row in rows:
+        tier = get_tier(row['quality_tier'])
+        backlog[tier['name']] = (backlog.get(tier['name'], 0.0) +
+                                 (row['audio_seconds'] or 0) * tier['compute_per_audio_second'])
+    return backlog
+
+
+def estimated_backlog_seconds() -> float:
+    """Estimate the compute seconds needed to finish all queued and running jobs"""
+    return sum(backlog_by_tier().values())
+
+
+class BacklogAdmissionThrottle(BaseThrottle):
+    """
+    Reject new jobs while the estimated backlog exceeds the configured budget
+
+    Retry-After is the time the configured worker slots need to work the
+    backlog back down under the budget. The estimate is cached for a few
+    seconds so bursts of uploads do not each run the aggregate query.
+    """
+
+    def __init__(self):
+        self.config = getattr(settings, 'JOB_ADMISSION', {})
+        self.wait_seconds = None
+
+    def allow_request(self, request, view) -> bool:
+        max_backlog = self.config.get('max_backlog_seconds')
+        if not max_backlog:
+            return True
+
+        backlog = cache.get(BACKLOG_CACHE_KEY)
+        if backlog is None:
+            backlog = estimated_backlog_seconds()
+            cache.set(BACKLOG_CACHE_KEY, backlog, self.config.get('estimate_cache_seconds', 5))
+
+        if backlog <= max_backlog:
+            return True
+
+        slots = max(self.config.get('worker_slots', 1), 1)
+        self.wait_seconds = min(max((backlog - max_backlog) / slots, 1), 3600)
+        metrics.incr('jobs_rejected_backlog')
+        logger.warning(f"Rejecting job: estimated backlog {backlog:.0f}s exceeds {max_backlog}s")
+        return False
+
+    def wait(self):
+        return self.wait_seconds
+
+
+class AdmissionControlMixin:
+    """
+    View mixin that only charges clients for uploads that are admitted
+
+    DRF consults every throttle even after one has rejected the request,
+    so an upload turned away by the backlog budget would still take a
+    token from the client's bucket. Throttles are checked in the order
+    ``get_throttles`` lists them and checking stops at the first
+    rejection, so list the admission check before the token bucket.
+    Tokens already taken are refunded when a later throttle rejects the
+    request or the upload fails validation.
+    """
+
+    def check_throttles(self, request):
+        self.charged_throttles = []
+        for throttle in self.get_throttles():
+            if not throttle.allow_request(request, self):
+                self.refund_throttles()
+                self.throttled(request, throttle.wait())
+            if hasattr(throttle, 'refund'):
+                self.charged_throttles.append(throttle)
+
+    def refund_throttles(self):
+        for throttle in getattr(self, 'charged_throttles', []):
+            throttle.refund()
+        self.charged_throttles = []
+
+    def tokens_charged(self) -> bool:
+        """True if a token was taken from the client's bucket for this request"""
+        return any(getattr(throttle, 'charged_key', None) for throttle in getattr(self, 'charged_throttles', []))
+
+    def handle_exception(self, exc):
+        if isinstance(exc, ValidationError):
+            self.refund_throttles()
+        return super().handle_exception(exc)
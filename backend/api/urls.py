@@ -1,14 +1,23 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import JobViewSet
+from .views import JobViewSet, SongUploadViewSet
+from . import async_views
 
 router = DefaultRouter()
 router.register(r'jobs', JobViewSet)
+router.register(r'songs', SongUploadViewSet)
 
 urlpatterns = [
+    # Async polling endpoints; listed before the router so 'jobs/status/'
+    # is not taken for a job id
+    path('jobs/status/', async_views.bulk_job_status, name='job-bulk-status'),
+    path('jobs/list/', async_views.job_list, name='job-list-async'),
     path('', include(router.urls)),
     # Custom endpoints
     path('upload/', JobViewSet.as_view({'post': 'create'}), name='upload'),
-    path('job/<uuid:pk>/', JobViewSet.as_view({'get': 'retrieve'}), name='job-status'),
+    path('upload/song/', SongUploadViewSet.as_view({'post': 'create'}), name='upload-song'),
+    path('job/<uuid:pk>/', async_views.job_status, name='job-status'),
+    path('job/<uuid:pk>/cancel/', JobViewSet.as_view({'post': 'cancel'}), name='job-cancel'),
     path('consent/', JobViewSet.as_view({'post': 'consent'}), name='consent'),
+    path('metrics/', JobViewSet.as_view({'get': 'metrics'}), name='metrics'),
 ]
@@ -1,15 +1,48 @@
-from rest_framework import viewsets, status, permissions
+import logging
+from rest_framework import mixins, viewsets, status, permissions
 from rest_framework.response import Response
 from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
 from django.shortcuts import get_object_or_404
-from .models import Job
-from .serializers import JobSerializer, JobStatusSerializer
-from .tasks import process_voice_clone
+from django.utils import timezone
+from django.conf import settings
+from .models import Job, SongUpload
+from .serializers import JobSerializer, JobStatusSerializer, SongUploadSerializer
+from .pagination import JobCursorPagination
+from .filters import filter_jobs
+from .throttling import (AdmissionControlMixin, BacklogAdmissionThrottle, JobCreationThrottle,
+                         TokenBucketThrottle)
+from .tasks import process_voice_clone, separate_song_upload
+from .quality import get_tier, get_time_limits
+from .audio_utils import probe_duration
+from .voice_profile import file_sha256
+from .load_shedding import LoadSheddingController
+from . import metrics
 
-class JobViewSet(viewsets.ModelViewSet):
+logger = logging.getLogger(__name__)
+
+class JobViewSet(AdmissionControlMixin, viewsets.ModelViewSet):
     """ViewSet for handling Job resources"""
     queryset = Job.objects.all().order_by('-created_at')
     permission_classes = [permissions.AllowAny]  # For demo purposes
+    pagination_class = JobCursorPagination
+    
+    def get_throttles(self):
+        """Only job creation is rate limited and subject to admission control"""
+        if self.action == 'create':
+            # Admission first, so uploads rejected for backlog take no token
+            return [BacklogAdmissionThrottle(), JobCreationThrottle()]
+        return []
+    
+    def get_queryset(self):
+        """Apply the status and created_at range filters when listing"""
+        queryset = super().get_queryset()
+        if self.action == 'list':
+            try:
+                queryset = filter_jobs(queryset, self.request.query_params)
+            except ValueError as e:
+                raise ValidationError({'error': str(e)})
+        return queryset
     
     def get_serializer_class(self):
         """Return different serializers based on action"""
@@ -22,9 +55,20 @@ class JobViewSet(viewsets.ModelViewSet):
         serializer = self.get_serializer(data=request.data)
         serializer.is_valid(raise_exception=True)
         job = serializer.save()
+        if job.song_upload and job.song_upload.duration_seconds is not None:
+            job.duration_seconds = job.song_upload.duration_seconds
+        else:
+            job.duration_seconds = probe_duration(job.song_file.path)
         
-        # Start the background task
-        process_voice_clone.delay(str(job.id))
+        # Start the background task on the queue for the job's quality tier,
+        # with time limits scaled to the song length
+        soft_limit, hard_limit = get_time_limits(job.duration_seconds, job.quality_tier)
+        result = process_voice_clone.apply_async(args=[str(job.id)],
+                                                 queue=get_tier(job.quality_tier)['queue'],
+                                                 soft_time_limit=soft_limit,
+                                                 time_limit=hard_limit)
+        job.task_id = result.id
+        job.save(update_fields=['duration_seconds', 'task_id', 'updated_at'])
         
         headers = self.get_success_headers(serializer.data)
         return Response(serializer.data, status=status.HTTP_201_CREATED, headers=headers)
@@ -36,7 +80,78 @@ class JobViewSet(viewsets.ModelViewSet):
         serializer = self.get_serializer(job)
         return Response(serializer.data)
     
+    @action(detail=True, methods=['post'])
+    def cancel(self, request, pk=None):
+        """
+        Cancel a queued or running job
+        
+        Queued tasks are revoked so workers drop them on receipt; a running
+        task notices the new status at its next stage or segment boundary
+        and stops, freeing the worker for the next job.
+        """
+        job = get_object_or_404(Job, pk=pk)
+        cancelled = Job.objects.filter(pk=job.pk, status__in=['queued', 'processing']).update(
+            status='cancelled', updated_at=timezone.now())
+        if not cancelled:
+            return Response({'error': f"Job is already {job.status}"}, status=status.HTTP_409_CONFLICT)
+        
+        if job.task_id:
+            try:
+                process_voice_clone.app.control.revoke(job.task_id)
+            except Exception as e:
+                # The status change alone still stops the task when it starts
+                logger.warning(f"Failed to revoke task {job.task_id}: {e}")
+        
+        job.refresh_from_db()
+        serializer = JobStatusSerializer(job, context=self.get_serializer_context())
+        return Response(serializer.data)
+    
     @action(detail=False, methods=['post'])
     def consent(self, request):
         """Record user's consent (this is mostly a placeholder endpoint)"""
         return Response({'status': 'Consent recorded'}, status=status.HTTP_200_OK)
+    
+    @action(detail=False, methods=['get'])
+    def metrics(self, request):
+        """Report pipeline counters, stage latencies and the load shedding state"""
+        controller = LoadSheddingController()
+        data = metrics.snapshot()
+        data['queues'] = {q: metrics.queue_depth(q) for q in controller.config['queues']}
+        data['load_shedding_level'] = controller.current_level()
+        lookups = data['counters'].get('fingerprint_lookups', 0)
+        if lookups:
+            data['fingerprint_match_rate'] = round(data['counters'].get('fingerprint_matches', 0) / lookups, 3)
+        return Response(data)
+
+
+class SongUploadViewSet(AdmissionControlMixin, mixins.CreateModelMixin, mixins.RetrieveModelMixin,
+                        viewsets.GenericViewSet):
+    """
+    First phase of the two-phase upload: the song on its own
+    
+    The returned id is passed as ``song_upload`` when creating the job.
+    Separation starts right away on the low-priority separation queue, so
+    it overlaps with the user recording or uploading their voice. The
+    upload is admitted like a job: it is refused while the backlog is over
+    budget, and takes the rate limit token of the job it is for.
+    """
+    queryset = SongUpload.objects.all()
+    serializer_class = SongUploadSerializer
+    permission_classes = [permissions.AllowAny]  # For demo purposes
+    
+    def get_throttles(self):
+        if self.action == 'create':
+            return [BacklogAdmissionThrottle(), TokenBucketThrottle()]
+        return []
+    
+    def perform_create(self, serializer):
+        upload = serializer.save(prepaid_job=self.tokens_charged())
+        upload.sha256 = file_sha256(upload.song_file.path)
+        upload.duration_seconds = probe_duration(upload.song_file.path)
+        # Saved before queueing; the task keys the stem cache by the hash
+        upload.save(update_fields=['sha256', 'duration_seconds', 'updated_at'])
+        
+        queue = getattr(settings, 'STEM_CACHE', {}).get('queue', 'separation')
+        result = separate_song_upload.apply_async(args=[str(upload.id)], queue=queue)
+        upload.task_id = result.id
+        upload.save(update_fields=['task_id', 'updated_at'])
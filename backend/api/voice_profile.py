@@ -0,0 +1,190 @@
+"""
+Voice profile stage: content features and FAISS retrieval index per voice sample
+"""
+import hashlib
+import logging
+import os
+import tempfile
+from typing import Optional
+
+import numpy as np
+
+from celery.exceptions import SoftTimeLimitExceeded
+from django.conf import settings
+
+try:
+    import faiss
+    FAISS_AVAILABLE = True
+except ImportError as e:
+    logging.warning(f"FAISS not available: {e}")
+    FAISS_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+# Bump when the feature extraction or index recipe changes so stale
+# cached indices are rebuilt instead of reused
+PROFILE_VERSION = 1
+
+
+def file_sha256(path: str, chunk_size: int = 1024 * 1024) -> str:
+    """Return the hex SHA-256 digest of a file"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def get_index_root() -> str:
+    """Directory holding cached voice indices"""
+    return getattr(settings, 'RVC_INDEX_ROOT',
+                   os.path.join(settings.BASE_DIR, 'models', 'indices'))
+
+
+def get_hubert_path() -> str:
+    """Path of the HuBERT checkpoint"""
+    return getattr(settings, 'RVC_HUBERT_PATH',
+                   os.path.join(settings.BASE_DIR, 'models', 'hubert', 'hubert_base.pt'))
+
+
+def load_hubert_model(vc):
+    """
+    Return the HuBERT content encoder used by the RVC pipeline
+
+    The RVC ``VC`` object loads HuBERT lazily on the first inference call;
+    loading it here and storing it back on ``vc`` means the conversion that
+    follows reuses the same instance.
+    """
+    if getattr(vc, 'hubert_model', None) is None:
+        from rvc.modules.vc.utils import load_hubert
+        vc.hubert_model = load_hubert(vc.config, get_hubert_path())
+    return vc.hubert_model
+
+
+def extract_content_features(vc, audio_path: str) -> np.ndarray:
+    """
+    Extract HuBERT content features from an audio file
+
+    Mirrors the feature extraction done inside the RVC pipeline so the
+    index matches what ``vc_inference`` queries with: layer 9 projected
+    to 256 dims for v1 models, layer 12 (768 dims) for v2 models.
+
+    Args:
+        vc: Loaded RVC ``VC`` instance (``get_vc`` already called)
+        audio_path: Path to the voice sample
+
+    Returns:
+        float32 array of shape (frames, dims)
+    """
+    import torch
+    from rvc.lib.audio import load_audio
+
+    model = load_hubert_model(vc)
+    device = vc.config.device
+    is_half = vc.config.is_half
+    version = getattr(vc, 'version', 'v2')
+
+    audio = load_audio(audio_path, 16000)
+    feats = torch.from_numpy(audio)
+    feats = feats.half() if is_half else feats.float()
+    if feats.dim() == 2:
+        feats = feats.mean(-1)
+    feats = feats.view(1, -1).to(device)
+    padding_mask = torch.BoolTensor(feats.shape).to(device).fill_(False)
+
+    with torch.no_grad():
+        logits = model.extract_features(
+            source=feats,
+            padding_mask=padding_mask,
+            output_layer=9 if version == 'v1' else 12,
+        )
+        feats = model.final_proj(logits[0]) if version == 'v1' else logits[0]
+
+    return feats.squeeze(0).float().cpu().numpy().astype(np.float32)
+
+
+def build_faiss_index(features: np.ndarray):
+    """
+    Build a FAISS index over content features
+
+    Follows the RVC training recipe (IVF with ~16*sqrt(N) lists) for long
+    samples; short samples that cannot train enough IVF centroids fall
+    back to an exact flat index. Both support ``reconstruct_n`` which the
+    RVC pipeline uses to read the vectors back.
+    """
+    n_frames, dims = features.shape
+    n_ivf = min(int(16 * np.sqrt(n_frames)), n_frames // 39)
+
+    if n_ivf >= 1:
+        index = faiss.index_factory(dims, f"IVF{n_ivf},Flat")
+        faiss.extract_index_ivf(index).nprobe = 1
+        index.train(features)
+    else:
+        index = faiss.IndexFlatL2(dims)
+
+    index.add(features)
+    return index
+
+
+def get_voice_index(vc, voice_sample_path: str, index_root: Optional[str] = None) -> Optional[str]:
+    """
+    Return the cached FAISS index for a voice sample, building it if needed
+
+    The cache key is the SHA-256 of the voice file plus the model version
+    and whether HuBERT runs INT8-quantized (its features differ slightly
+    from FP32), so repeat jobs with the same voice skip feature extraction
+    entirely.
+
+    Args:
+        vc: Loaded RVC ``VC`` instance
+        voice_sample_path: Uploaded voice sample
+        index_root: Cache directory (defaults to ``RVC_INDEX_ROOT``)
+
+    Returns:
+        Path to the ``.index`` file, or None if it could not be built
+    """
+    if not FAISS_AVAILABLE:
+        logger.warning("FAISS not available, converting without a retrieval index")
+        return None
+
+    try:
+        index_root = index_root or get_index_root()
+
+        version = getattr(vc, 'version', 'v2')
+        precision = '_int8' if getattr(vc, 'hubert_quantized', False) else ''
+        voice_hash = file_sha256(voice_sample_path)
+        index_dir = os.path.join(index_root, voice_hash[:2])
+        os.makedirs(index_dir, exist_ok=True)
+        index_path = os.path.join(index_dir, f"voice_{voice_hash}_{version}{precision}_p{PROFILE_VERSION}.index")
+
+        if os.path.exists(index_path):
+            logger.info(f"Reusing cached voice index: {index_path}")
+            # Marks the index as recently used for the storage lifecycle
+            os.utime(index_path)
+            return index_path
+
+        logger.info(f"Building voice index for {voice_sample_path}")
+        features = extract_content_features(vc, voice_sample_path)
+        if len(features) == 0:
+            raise ValueError("Voice sample produced no content features")
+        index = build_faiss_index(features)
+
+        # Write to a temp file and rename so concurrent workers never
+        # read a partially written index
+        fd, tmp_path = tempfile.mkstemp(dir=index_dir, suffix='.index.tmp')
+        os.close(fd)
+        try:
+            faiss.write_index(index, tmp_path)
+            os.replace(tmp_path, index_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+        logger.info(f"Voice index built with {index.ntotal} vectors: {index_path}")
+        return index_path
+
+    except SoftTimeLimitExceeded:
+        raise
+    except Exception as e:
+        logger.error(f"Failed to build voice index: {str(e)}")
+        return None
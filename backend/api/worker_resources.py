@@ -0,0 +1,130 @@
+"""
+Per-process CPU thread budgets and shared ONNX Runtime sessions for prefork workers
+"""
+import logging
+import os
+import threading
+from typing import List, Optional
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Environment variables read by the OpenMP / BLAS runtimes behind torch,
+# numpy and ONNX Runtime when they start their thread pools
+THREAD_ENV_VARS = ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'NUMEXPR_NUM_THREADS')
+
+DEFAULT_CONFIG = {
+    'processes': None,  # defaults to the worker's --concurrency
+    'threads_per_process': None,  # defaults to cores // processes
+    'inter_op_threads': 1,
+    'pin_cores': False,
+}
+
+_budget = None
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_config() -> dict:
+    config = dict(DEFAULT_CONFIG)
+    config.update(getattr(settings, 'WORKER_RESOURCES', {}))
+    return config
+
+
+def available_cores() -> List[int]:
+    """Cores this process may run on"""
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def thread_budget(processes: Optional[int] = None) -> dict:
+    """
+    Split the host's cores between ``processes`` worker processes
+
+    Returns:
+        dict with 'processes', 'intra_op' and 'inter_op' thread counts
+    """
+    config = get_config()
+    processes = max(processes or config['processes'] or 1, 1)
+    intra_op = config['threads_per_process'] or max(len(available_cores()) // processes, 1)
+    return {'processes': processes, 'intra_op': intra_op, 'inter_op': config['inter_op_threads']}
+
+
+def current_budget() -> dict:
+    """Budget in force in this process (the whole host if none was configured)"""
+    return _budget or thread_budget(1)
+
+
+def configure_worker(concurrency: int) -> dict:
+    """
+    Set the thread budget in the parent worker before the pool forks
+
+    The environment variables are inherited by the children, so OpenMP and
+    BLAS pools started there get the right size from the outset.
+    """
+    global _budget
+    _budget = thread_budget(get_config()['processes'] or concurrency)
+    for name in THREAD_ENV_VARS:
+        os.environ[name] = str(_budget['intra_op'])
+    logger.info(f"Thread budget: {_budget['intra_op']} intra-op / {_budget['inter_op']} inter-op "
+                f"thread(s) for each of {_budget['processes']} process(es)")
+    return _budget
+
+
+def configure_process(index: Optional[int] = None, budget: Optional[dict] = None) -> None:
+    """
+    Apply the thread budget (and optionally a core set) to the current process
+
+    Args:
+        index: Pool process index; with ``pin_cores`` the process is pinned
+            to its own ``intra_op``-sized slice of the cores
+        budget: Budget to apply instead of the one set by ``configure_worker``
+    """
+    global _budget
+    if budget is not None:
+        _budget = budget
+    budget = current_budget()
+    try:
+        import torch
+        torch.set_num_threads(budget['intra_op'])
+        try:
+            torch.set_num_interop_threads(budget['inter_op'])
+        except RuntimeError:
+            # Only allowed before the inter-op pool has started, which a
+            # forked child may have inherited from a preloading parent
+            logger.debug("Inter-op thread pool already started; keeping its size")
+    except ImportError:
+        pass
+
+    if get_config()['pin_cores'] and index is not None and hasattr(os, 'sched_setaffinity'):
+        cores = available_cores()
+        size = budget['intra_op']
+        start = (index * size) % len(cores)
+        core_set = set(cores[start:start + size]) or set(cores)
+        os.sched_setaffinity(0, core_set)
+        logger.info(f"Pool process {index} pinned to cores {sorted(core_set)}")
+
+
+def get_onnx_session(model_path: str, intra_op_threads: Optional[int] = None):
+    """
+    Return an ONNX Runtime CPU session for ``model_path``, created once per process
+
+    Sessions are thread-safe for ``run``, so one copy serves every task
+    (and every thread within a task) in this process.
+    """
+    import onnxruntime as ort
+
+    threads = intra_op_threads or current_budget()['intra_op']
+    key = (model_path, threads)
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is None:
+            options = ort.SessionOptions()
+            options.intra_op_num_threads = threads
+            options.inter_op_num_threads = 1
+            session = ort.InferenceSession(model_path, sess_options=options,
+                                           providers=['CPUExecutionProvider'])
+            _sessions[key] = session
+        return session
@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+"""
+Model provisioning for worker nodes
+
+Downloads the models in MODEL_MANIFEST concurrently. Interrupted
+downloads resume from their ``.part`` file with HTTP Range requests.
+Every file is checked against its SHA-256 before it is moved into place
+with an atomic rename, so a worker never sees a truncated model.
+
+A mirror directory (e.g. an NFS share, ``--mirror`` or RVC_MODEL_MIRROR)
+is tried before the network and filled after each download, so only the
+first node of a fleet fetches from the internet.
+
+Entries without a hash are pinned on first download. Their hash is
+recorded in ``manifest.lock.json`` (in the mirror when there is one), and
+later downloads on any node must match it.
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+BASE_DIR = Path(__file__).parent
+CHUNK_SIZE = 1024 * 1024
+# Small enough that little is lost when a connection drops mid-chunk
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+LOCK_FILE = 'manifest.lock.json'
+
+# path is relative to the models directory
+MODEL_MANIFEST = [
+    {
+        'name': 'hubert_base.pt',
+        'url': 'https://huggingface.co/rvc-models/hubert-base/resolve/main/hubert_base.pt',
+        'path': 'hubert/hubert_base.pt',
+        'sha256': None,
+    },
+    {
+        'name': 'rmvpe.pt',
+        'url': 'https://huggingface.co/rvc-models/rmvpe/resolve/main/rmvpe.pt',
+        'path': 'rmvpe.pt',
+        'sha256': None,
+    },
+    {
+        'name': 'UVR-MDX-NET-Voc_FT.onnx',
+        'url': 'https://github.com/TRvlvr/model_repo/releases/download/all_public_uvr_models/UVR-MDX-NET-Voc_FT.onnx',
+        'path': 'uvr5/UVR-MDX-NET-Voc_FT.onnx',
+        'sha256': None,
+    },
+    {
+        'name': 'UVR_MDXNET_KARA_2.onnx',
+        'url': 'https://github.com/TRvlvr/model_repo/releases/download/all_public_uvr_models/UVR_MDXNET_KARA_2.onnx',
+        'path': 'uvr5/UVR_MDXNET_KARA_2.onnx',
+        'sha256': None,
+    },
+    {
+        'name': 'UVR_MDXNET_9482.onnx',
+        'url': 'https://github.com/TRvlvr/model_repo/releases/download/all_public_uvr_models/UVR_MDXNET_9482.onnx',
+        'path': 'uvr5/UVR_MDXNET_9482.onnx',
+        'sha256': None,
+    },
+]
+
+
+class ChecksumError(Exception):
+    """A downloaded or mirrored file does not match its expected SHA-256"""
+
+
+def file_sha256(path, chunk_size=CHUNK_SIZE):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _atomic_copy(src, dest):
+    """Copy ``src`` to ``dest`` through a temp file in the destination directory"""
+    dest = Path(dest)
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=dest.parent, prefix=f".{dest.name}.", suffix='.tmp')
+    os.close(fd)
+    try:
+        shutil.copyfile(src, tmp_path)
+        os.replace(tmp_path, dest)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+class Provisioner:
+    """
+    Brings a models directory up to date with a manifest
+
+    Args:
+        models_dir: Where the models go
+        manifest: List of {'name', 'url', 'path', 'sha256'} entries
+        mirror_dir: Optional shared directory checked before downloading
+        workers: Concurrent downloads
+        retries: Attempts per download; each one resumes the last
+        session: requests.Session to use (for tests and proxies)
+    """
+
+    def __init__(self, models_dir, manifest=None, mirror_dir=None, workers=4, retries=3,
+                 timeout=30, session=None):
+        self.models_dir = Path(models_dir)
+        self.manifest = manifest if manifest is not None else MODEL_MANIFEST
+        self.mirror_dir = Path(mirror_dir) if mirror_dir else None
+        self.workers = workers
+        self.retries = retries
+        self.timeout = timeout
+        self.session = session or requests.Session()
+        self._lock = threading.Lock()
+        self._pins = self._load_pins()
+
+    @property
+    def lock_path(self):
+        return (self.mirror_dir or self.models_dir) / LOCK_FILE
+
+    def _load_pins(self):
+        try:
+            with open(self.lock_path) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def _pin(self, name, sha256):
+        with self._lock:
+            # Another node may have pinned entries since we loaded the file
+            pins = self._load_pins()
+            pins.update(self._pins)
+            pins[name] = sha256
+            self._pins = pins
+            self.lock_path.parent.mkdir(parents=True, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.lock_path.parent, suffix='.json.tmp')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(pins, f, indent=2, sort_keys=True)
+            os.replace(tmp_path, self.lock_path)
+
+    def expected_sha256(self, entry):
+        return entry.get('sha256') or self._pins.get(entry['name'])
+
+    def _matches(self, path, expected):
+        if not path.exists():
+            return False
+        return expected is None or file_sha256(path) == expected
+
+    def download(self, url, part_path):
+        """
+        Download ``url`` into ``part_path``, resuming whatever is already there
+
+        Returns:
+            Bytes transferred over the network
+        """
+        transferred = 0
+        for attempt in range(1, self.retries + 1):
+            offset = part_path.stat().st_size if part_path.exists() else 0
+            headers = {'Range': f'bytes={offset}-'} if offset else {}
+            try:
+                with self.session.get(url, headers=headers, stream=True, timeout=self.timeout) as response:
+                    if response.status_code == 416:
+                        # Nothing left past the end of the part file
+                        return transferred
+                    response.raise_for_status()
+                    # A server ignoring Range sends the whole file again
+                    mode = 'ab' if offset and response.status_code == 206 else 'wb'
+                    with open(part_path, mode) as f:
+                        for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                            f.write(chunk)
+                            transferred += len(chunk)
+                return transferred
+            except requests.RequestException as e:
+                if attempt == self.retries:
+                    raise
+                logger.warning(f"Download of {url} interrupted ({e}); resuming (attempt {attempt + 1})")
+                time.sleep(min(2 ** attempt, 30))
+        return transferred
+
+    def provision_one(self, entry):
+        """Make sure one manifest entry is in place; returns a result dict"""
+        name = entry['name']
+        dest = self.models_dir / entry['path']
+        expected = self.expected_sha256(entry)
+        started = time.monotonic()
+        result = {'name': name, 'path': str(dest), 'status': None, 'bytes': 0}
+
+        try:
+            if self._matches(dest, expected):
+                result['status'] = 'present'
+                return result
+
+            mirrored = self.mirror_dir / entry['path'] if self.mirror_dir else None
+            if mirrored is not None and self._matches(mirrored, expected):
+                _atomic_copy(mirrored, dest)
+                if not expected:
+                    # Seeded by hand; pin it so every node gets the same file
+                    self._pin(name, file_sha256(dest))
+                result['status'] = 'mirror'
+                return result
+
+            dest.parent.mkdir(parents=True, exist_ok=True)
+            part_path = dest.with_name(dest.name + '.part')
+            result['bytes'] = self.download(entry['url'], part_path)
+            actual = file_sha256(part_path)
+            if expected and actual != expected:
+                # A corrupt part file would fail every resume; start over next time
+                part_path.unlink()
+                raise ChecksumError(f"SHA-256 mismatch for {name}: expected {expected}, got {actual}")
+            os.replace(part_path, dest)
+
+            if not expected:
+                self._pin(name, actual)
+                logger.info(f"Pinned {name} to SHA-256 {actual}")
+            if mirrored is not None:
+                _atomic_copy(dest, mirrored)
+            result['status'] = 'downloaded'
+            return result
+
+        except Exception as e:
+            result['status'] = 'failed'
+            result['error'] = str(e)
+            logger.error(f"Failed to provision {name}: {e}")
+            return result
+
+        finally:
+            result['seconds'] = round(time.monotonic() - started, 2)
+
+    def provision(self, names=None):
+        """
+        Provision every manifest entry (or only ``names``) concurrently
+
+        Returns:
+            One result dict per entry, in manifest order
+        """
+        entries = [entry for entry in self.manifest if not names or entry['name'] in names]
+        with ThreadPoolExecutor(max_workers=max(self.workers, 1)) as pool:
+            return list(pool.map(self.provision_one, entries))
+
+
+def provision_models(models_dir=None, mirror_dir=None, workers=4, names=None):
+    """Provision the default manifest into ``models_dir`` (default: ./models)"""
+    mirror_dir = mirror_dir or os.environ.get('RVC_MODEL_MIRROR')
+    provisioner = Provisioner(models_dir or BASE_DIR / 'models', mirror_dir=mirror_dir, workers=workers)
+    return provisioner.provision(names)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Download and verify the RVC and UVR5 models")
+    parser.add_argument('--models-dir', default=str(BASE_DIR / 'models'))
+    parser.add_argument('--mirror', help="Shared directory to copy from and fill (default: $RVC_MODEL_MIRROR)")
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--only', help="Comma separated model names")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    names = args.only.split(',') if args.only else None
+    results = provision_models(args.models_dir, args.mirror, args.workers, names)
+    print(json.dumps(results, indent=2))
+    return all(result['status'] != 'failed' for result in results)
+
+
+if __name__ == '__main__':
+    raise SystemExit(0 if main() else 1)
@@ -1,5 +1,6 @@
 import os
 from celery import Celery
+from celery.signals import worker_init, worker_process_init
 
 # Set the default Django settings module for the 'celery' program.
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'music_voice_clone.settings')
@@ -17,3 +18,39 @@ app.autodiscover_tasks()
 @app.task(bind=True, ignore_result=True)
 def debug_task(self):
     print(f'Request: {self.request!r}')
+
+
+@worker_init.connect
+def set_thread_budget(sender=None, **kwargs):
+    """Split the cores between the pool's children before it forks"""
+    from api.worker_resources import configure_worker
+    configure_worker(getattr(sender, 'concurrency', None) or 1)
+
+
+@worker_process_init.connect
+def apply_thread_budget(**kwargs):
+    """Size torch's thread pools (and optionally pin cores) in each child"""
+    from billiard.process import current_process
+    from api.worker_resources import configure_process
+    configure_process(getattr(current_process(), 'index', None))
+
+
+@worker_init.connect
+def keep_database_connections(**kwargs):
+    """Reuse database connections across tasks (the web process does not, see settings)"""
+    from django.conf import settings
+    for database in settings.DATABASES.values():
+        # Pooled connections are returned to the pool instead
+        if 'pool' not in database.get('OPTIONS', {}):
+            database['CONN_MAX_AGE'] = settings.WORKER_DB_CONN_MAX_AGE
+
+
+@worker_init.connect
+def preload_shared_models(**kwargs):
+    """Load RVC weights in the parent worker so prefork children share them"""
+    from django.conf import settings
+    if not getattr(settings, 'RVC_PRELOAD_MODELS', False):
+        return
+
+    from api.rvc_integration import rvc_cloner, default_model_path
+    rvc_cloner.preload_shared(default_model_path())
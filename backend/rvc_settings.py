@@ -11,7 +11,7 @@ RVC_WEIGHT_ROOT = os.path.join(BASE_DIR, 'models', 'weights')
 # RVC Processing Settings
 RVC_SETTINGS = {
     'device': 'cuda:0' if torch.cuda.is_available() else 'cpu',
-    'is_half': True,  # Use FP16 for faster processing (requires compatible GPU)
+    'is_half': torch.cuda.is_available(),  # FP16 on GPU only; CPUs run FP32 or INT8 (below)
     'f0_method': 'rmvpe',  # Default pitch extraction method
     'index_rate': 0.75,
     'filter_radius': 3,
@@ -19,6 +19,11 @@ RVC_SETTINGS = {
     'protect': 0.33,
 }
 
+# Load dynamically quantized INT8 HuBERT and synthesizer weights on CPU-only
+# hosts ('auto'), cached per checkpoint under RVC_QUANTIZED_ROOT
+RVC_CPU_QUANTIZATION = 'auto'
+RVC_QUANTIZED_ROOT = os.path.join(BASE_DIR, 'models', 'quantized')
+
 # UVR5 Model Settings
 UVR5_MODEL_PATH = os.path.join(BASE_DIR, 'models', 'uvr5')
 UVR5_DEFAULT_MODEL = 'UVR-MDX-NET-Voc_FT'
@@ -45,6 +50,7 @@ MODEL_DIRS = [
     os.path.join(BASE_DIR, 'models', 'indices'),
     os.path.join(BASE_DIR, 'models', 'uvr5'),
     os.path.join(BASE_DIR, 'models', 'hubert'),
+    os.path.join(BASE_DIR, 'models', 'quantized'),
 ]
 
 for dir_path in MODEL_DIRS: